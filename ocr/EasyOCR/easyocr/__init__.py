@@ -1,3 +1,4 @@
 from .easyocr import Reader
+from .reader_pool import ReaderPool
 
 __version__ = '1.4.2'
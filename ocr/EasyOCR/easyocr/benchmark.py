@@ -0,0 +1,875 @@
+import argparse
+import importlib
+import os
+import tempfile
+import time
+
+import cv2
+import numpy as np
+import torch
+
+from .craft_utils import getDetBoxes_core, getDetBoxes_core_roi
+from .config import recognition_models
+from .craft import CRAFT
+from .detection import test_net
+from .onnx_backend import export_detector, export_recognizer, OrtDetector, OrtRecognizer
+from .recognition import get_ignore_mask
+from .torchscript_backend import TracedRecognizer
+from .utils import CTCLabelConverter, ctcBeamSearch, ctcBeamSearchBatched, labeling_to_text, get_paragraph,\
+                   group_text_box, rotate_image
+
+
+def synthetic_heatmaps(height=1280, width=1280, n_lines=60, words_per_line=8, seed=0):
+    """
+    Build a CRAFT-like (textmap, linkmap) pair for a dense page: rows of
+    blurred character blobs joined by link blobs.
+    """
+    rng = np.random.RandomState(seed)
+    textmap = np.zeros((height, width), dtype=np.float32)
+    linkmap = np.zeros((height, width), dtype=np.float32)
+    line_h = max(height // (n_lines + 1), 6)
+    for line in range(n_lines):
+        cy = (line + 1) * line_h
+        x = int(rng.randint(0, 20))
+        for _ in range(words_per_line):
+            n_chars = int(rng.randint(1, 8))
+            char_w = int(rng.randint(4, 10))
+            if x + n_chars * char_w >= width:
+                break
+            for c in range(n_chars):
+                cx = x + c * char_w + char_w // 2
+                cv2.circle(textmap, (cx, cy), max(char_w // 2 - 1, 1), 1.0, -1)
+                if c > 0:
+                    cv2.circle(linkmap, (cx - char_w // 2, cy), max(char_w // 4, 1), 1.0, -1)
+            x += n_chars * char_w + int(rng.randint(8, 30))
+    textmap = cv2.GaussianBlur(textmap, (5, 5), 0)
+    linkmap = cv2.GaussianBlur(linkmap, (5, 5), 0)
+    return textmap, linkmap
+
+
+def _timeit(fn, repeat):
+    best = float('inf')
+    out = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        out = fn()
+        best = min(best, time.perf_counter() - start)
+    return best, out
+
+
+def bench_detboxes(height=1280, width=1280, n_lines=60, repeat=3, text_threshold=0.7,
+                   link_threshold=0.4, low_text=0.4, estimate_num_chars=False):
+    textmap, linkmap = synthetic_heatmaps(height, width, n_lines)
+    args = (textmap, linkmap, text_threshold, link_threshold, low_text, estimate_num_chars)
+
+    t_full, (det_full, _, mapper_full) = _timeit(lambda: getDetBoxes_core(*args), repeat)
+    t_roi, (det_roi, _, mapper_roi) = _timeit(lambda: getDetBoxes_core_roi(*args), repeat)
+
+    assert mapper_full == mapper_roi, "mapper mismatch between 'full' and 'roi' engines"
+    assert len(det_full) == len(det_roi), "box count mismatch between 'full' and 'roi' engines"
+    for a, b in zip(det_full, det_roi):
+        np.testing.assert_array_equal(a, b)
+
+    print(f"getDetBoxes_core on {height}x{width} heatmap, {len(det_full)} boxes")
+    print(f"  full: {t_full*1000:.1f} ms")
+    print(f"  roi:  {t_roi*1000:.1f} ms ({t_full/max(t_roi, 1e-9):.1f}x)")
+
+
+def synthetic_ctc_lines(n_lines=64, n_steps=64, n_class=97, noise=1.0, seed=0):
+    """
+    Build recognizer-like softmax outputs [n_lines, n_steps, n_class]: a random
+    character sequence with blanks in between, plus gaussian logit noise.
+    """
+    rng = np.random.RandomState(seed)
+    logits = rng.randn(n_lines, n_steps, n_class).astype(np.float32) * noise
+    for i in range(n_lines):
+        t = 0
+        while t < n_steps:
+            span = int(rng.randint(1, 4))
+            logits[i, t:t + span, int(rng.randint(1, n_class))] += 8.
+            t += span
+            blank = int(rng.randint(0, 3))
+            logits[i, t:t + blank, 0] += 8.
+            t += blank
+    probs = np.exp(logits - logits.max(axis=2, keepdims=True))
+    return probs / probs.sum(axis=2, keepdims=True)
+
+
+def _ctc_log_prob(mat, text, classes):
+    """ log probability of all the CTC paths of text under the softmax output mat [T, C] """
+    target = torch.tensor([[classes.index(char) for char in text]], dtype=torch.long)
+    log_probs = torch.from_numpy(np.log(np.maximum(mat, 1e-30)))[:, None, :]
+    loss = torch.nn.functional.ctc_loss(log_probs, target, [mat.shape[0]], [len(text)], reduction='none')
+    return -float(loss[0])
+
+
+def bench_beamsearch(n_lines=64, n_steps=64, n_class=97, beamWidth=5, repeat=3):
+    """
+    ctcBeamSearch against ctcBeamSearchBatched. The outputs are not expected
+    to be identical: the loop drops characters below 0.5/maxC at each step
+    and does not merge every equal labeling, the batched search is an exact
+    prefix beam search. Lines where they differ are listed with the CTC log
+    probability of both texts, the batched one should not be less likely.
+    """
+    mats = synthetic_ctc_lines(n_lines, n_steps, n_class)
+    classes = ['[blank]'] + [chr(33 + i) for i in range(n_class - 1)]
+    ignore_idx = [0]
+
+    def python_loop():
+        return [ctcBeamSearch(mat, classes, ignore_idx, None, beamWidth=beamWidth) for mat in mats]
+
+    def vectorized():
+        return [labeling_to_text(beams[0], classes, ignore_idx)
+                for beams in ctcBeamSearchBatched(mats, beamWidth=beamWidth)]
+
+    t_loop, text_loop = _timeit(python_loop, repeat)
+    t_vec, text_vec = _timeit(vectorized, repeat)
+    differ = [i for i, (a, b) in enumerate(zip(text_loop, text_vec)) if a != b]
+
+    print(f"CTC beam search, {n_lines} lines x {n_steps} steps x {n_class} classes, beamWidth={beamWidth}")
+    print(f"  python loop: {t_loop*1000/n_lines:.2f} ms/line")
+    print(f"  vectorized:  {t_vec*1000/n_lines:.2f} ms/line ({t_loop/max(t_vec, 1e-9):.1f}x)")
+    print(f"  identical output on {n_lines - len(differ)}/{n_lines} lines; "
+          f"differences are expected (the loop prunes and merges beams approximately):")
+    less_likely = 0
+    for i in differ:
+        p_loop, p_vec = _ctc_log_prob(mats[i], text_loop[i], classes), _ctc_log_prob(mats[i], text_vec[i], classes)
+        less_likely += p_vec < p_loop - 1e-4
+        print(f"    line {i}: loop {text_loop[i]!r} (log p {p_loop:.3f}), vectorized {text_vec[i]!r} (log p {p_vec:.3f})")
+    print(f"  vectorized text less likely than the loop's on {less_likely}/{len(differ)} differing lines")
+
+
+def bench_charset(model='zh_sim_g2', n_lines=64, n_steps=50, repeat=3):
+    """
+    Per-call setup of recognition on a large character set: ignore indices
+    from an allowlist and greedy decoding of n_lines lines.
+    """
+    character = recognition_models['gen2'][model]['characters']
+    converter = CTCLabelConverter(character)
+    allowlist = character[:len(character) // 2]
+    rng = np.random.RandomState(0)
+    indices = rng.randint(0, len(converter.character), (n_lines * n_steps,))
+    lengths = [n_steps] * n_lines
+    cache = {}
+
+    def uncached():
+        ignore_char = ''.join(set(character) - set(allowlist))
+        # every occurrence of an ignored character, some character sets list one twice
+        ignore_idx = [i + 1 for i, char in enumerate(character) if char in ignore_char]
+        texts = []
+        for i in range(n_lines):
+            t = indices[i * n_steps:(i + 1) * n_steps]
+            keep = np.insert(t[1:] != t[:-1], 0, True) & ~np.isin(t, np.array(converter.ignore_idx))
+            texts.append(''.join(np.array(converter.character)[t[keep]]))
+        return sorted(ignore_idx), texts
+
+    def cached():
+        if allowlist not in cache:
+            ignore_char = ''.join(set(character) - set(allowlist))
+            cache[allowlist] = (ignore_char, get_ignore_mask(converter, ignore_char))
+        ignore_mask = cache[allowlist][1]
+        return ignore_mask.nonzero().view(-1).tolist(), converter.decode_greedy(indices, lengths)
+
+    t_cold, (idx_cold, text_cold) = _timeit(uncached, repeat)
+    cached()
+    t_warm, (idx_warm, text_warm) = _timeit(cached, repeat)
+    assert idx_cold == idx_warm and text_cold == text_warm, "cached setup differs from uncached setup"
+
+    print(f"recognition setup for {model} ({len(character)} characters), {n_lines} lines x {n_steps} steps")
+    print(f"  uncached: {t_cold*1000:.2f} ms/call")
+    print(f"  cached:   {t_warm*1000:.2f} ms/call ({t_cold/max(t_warm, 1e-9):.1f}x)")
+
+
+def bench_onnx(network='generation2', height=736, width=1024, n_crops=32, crop_width=256, imgH=64,
+               threads=None, repeat=3):
+    """
+    Export randomly initialized CRAFT and CRNN models to ONNX, check that ONNX
+    Runtime matches torch and compare their speed.
+    """
+    import importlib
+    model_pkg = importlib.import_module("easyocr.model.model" if network == 'generation1' else "easyocr.model.vgg_model")
+    channels = 512 if network == 'generation1' else 256
+    torch.manual_seed(0)
+    detector = CRAFT().eval()
+    recognizer = model_pkg.Model(input_channel=1, output_channel=channels, hidden_size=channels, num_class=97).eval()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        det_path, rec_path = os.path.join(tmp, 'craft.onnx'), os.path.join(tmp, 'recognizer.onnx')
+        export_detector(detector, det_path)
+        export_recognizer(recognizer, rec_path, imgH)
+        ort_detector, ort_recognizer = OrtDetector(det_path, threads), OrtRecognizer(rec_path, threads)
+
+        page = torch.randn(1, 3, height, width)
+        crops = torch.randn(n_crops, 1, imgH, crop_width)
+        with torch.no_grad():
+            t_det, (y_torch, _) = _timeit(lambda: detector(page), repeat)
+            t_rec, p_torch = _timeit(lambda: recognizer(crops, None), repeat)
+        t_det_ort, (y_ort, _) = _timeit(lambda: ort_detector(page), repeat)
+        t_rec_ort, p_ort = _timeit(lambda: ort_recognizer(crops), repeat)
+
+        # parity, also at a width the recognizer graph was not exported with
+        np.testing.assert_allclose(y_torch.numpy(), y_ort.numpy(), rtol=1e-03, atol=1e-04)
+        np.testing.assert_allclose(p_torch.numpy(), p_ort.numpy(), rtol=1e-03, atol=1e-04)
+        other = torch.randn(2, 1, imgH, crop_width * 2 + imgH)
+        with torch.no_grad():
+            np.testing.assert_allclose(recognizer(other, None).numpy(), ort_recognizer(other).numpy(),
+                                       rtol=1e-03, atol=1e-04)
+
+    print(f"torch vs onnxruntime ({network}), outputs match")
+    print(f"  detector {height}x{width}:  torch {t_det*1000:.1f} ms, onnxruntime {t_det_ort*1000:.1f} ms"
+          f" ({t_det/max(t_det_ort, 1e-9):.1f}x)")
+    print(f"  recognizer {n_crops}x{imgH}x{crop_width}: torch {t_rec*1000:.1f} ms, onnxruntime {t_rec_ort*1000:.1f} ms"
+          f" ({t_rec/max(t_rec_ort, 1e-9):.1f}x)")
+
+
+def bench_torchscript(network='generation2', n_crops=32, widths=(128, 256, 512), imgH=64, quantize=False, repeat=3):
+    """
+    Randomly initialized CRNN model, eager against TracedRecognizer: time of
+    the first call (tracing), of the first call with the cached traces and of
+    later calls, with a parity check at every width.
+    """
+    import importlib
+    model_pkg = importlib.import_module("easyocr.model.model" if network == 'generation1' else "easyocr.model.vgg_model")
+    channels = 512 if network == 'generation1' else 256
+    torch.manual_seed(0)
+    recognizer = model_pkg.Model(input_channel=1, output_channel=channels, hidden_size=channels, num_class=97).eval()
+    if quantize:
+        torch.quantization.quantize_dynamic(recognizer, dtype=torch.qint8, inplace=True)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        model_path = os.path.join(tmp, 'recognizer.pth')
+        torch.save(recognizer.state_dict(), model_path)
+        cache_dir = os.path.join(tmp, 'compiled')
+        print(f"eager vs TorchScript ({network}{', int8' if quantize else ''}), {n_crops} crops")
+        for width in widths:
+            crops = torch.randn(n_crops, 1, imgH, width)
+            with torch.no_grad():
+                t_eager, p_eager = _timeit(lambda: recognizer(crops), repeat)
+                t_trace, _ = _timeit(lambda: TracedRecognizer(recognizer, model_path, cache_dir, imgH)(crops), 1)
+                t_cached, _ = _timeit(lambda: TracedRecognizer(recognizer, model_path, cache_dir, imgH)(crops), 1)
+                traced = TracedRecognizer(recognizer, model_path, cache_dir, imgH)
+                traced(crops)
+                t_traced, p_traced = _timeit(lambda: traced(crops), repeat)
+            # the traced int8 model quantizes activations in other kernels than eager
+            np.testing.assert_allclose(p_eager.numpy(), p_traced.numpy(), rtol=1e-03, atol=1e-02 if quantize else 1e-04)
+            print(f"  width {width}: eager {t_eager*1000:.1f} ms, traced {t_traced*1000:.1f} ms"
+                  f" ({t_eager/max(t_traced, 1e-9):.1f}x); first call {t_trace*1000:.0f} ms,"
+                  f" {t_cached*1000:.0f} ms with the cached trace")
+
+
+def _pss_mb(pid):
+    """ proportional set size of a process in MB, shared pages split among their users (Linux only) """
+    try:
+        with open('/proc/%d/smaps_rollup' % pid) as f:
+            return sum(int(line.split()[1]) for line in f if line.startswith('Pss:')) / 1024
+    except OSError:
+        return float('nan')
+
+
+def bench_pool(images, lang_list=('en',), model_storage_directory=None, workers=2, threads=1, repeat=1):
+    """
+    readtext over pages: one Reader with workers*threads torch threads against
+    a ReaderPool, with an equivalence check and the memory of each process.
+    """
+    from .easyocr import Reader
+    from .quantization import image_paths
+    from .reader_pool import ReaderPool
+    paths = image_paths(images)
+    if not paths:
+        raise ValueError("no images found in %s" % ' '.join(images))
+    reader = Reader(list(lang_list), gpu=False, model_storage_directory=model_storage_directory, verbose=False)
+
+    torch.set_num_threads(workers * threads)
+    t_serial, serial = _timeit(lambda: [reader.readtext(path) for path in paths], repeat)
+    with ReaderPool(reader=reader, workers=workers, threads=threads) as pool:
+        pool.map(paths[:workers]) # first-call setup of each worker
+        t_pool, pooled = _timeit(lambda: pool.map(paths), repeat)
+        memory = [_pss_mb(process.pid) for process in pool.processes]
+    assert [str(result) for result in serial] == [str(result) for result in pooled], "ReaderPool results differ"
+
+    print(f"readtext on {len(paths)} pages, results match")
+    print(f"  Reader ({workers*threads} threads): {len(paths)/t_serial:.2f} pages/s")
+    print(f"  ReaderPool ({workers} workers x {threads} threads): {len(paths)/t_pool:.2f} pages/s"
+          f" ({t_serial/max(t_pool, 1e-9):.1f}x)")
+    print(f"  PSS: parent {_pss_mb(os.getpid()):.0f} MB, workers " + ', '.join(f"{m:.0f}" for m in memory) + " MB")
+
+
+def _flat_loaders(network, det_path, rec_path, quantize=False):
+    """ loaders of the detector and of the recognizer saved by bench_flat """
+    from .detection import get_detector
+    from .recognition import get_recognizer
+    channels = 512 if network == 'generation1' else 256
+    network_params = {'input_channel': 1, 'output_channel': channels, 'hidden_size': channels}
+    character = recognition_models['gen2']['english_g2']['characters']
+    return {'detector': lambda: get_detector(det_path, 'cpu', quantize=False),
+            'recognizer': lambda: get_recognizer(network, network_params, character, {}, {}, rec_path,
+                                                 quantize=quantize)[0]}
+
+
+def _load_rss(network, det_path, rec_path, name, quantize):
+    """ run in a fresh process by bench_flat: load one model, run it once and print its RssAnon and RssFile in kB """
+    def rss():
+        with open('/proc/self/status') as f:
+            fields = dict(line.split(':', 1) for line in f)
+        return [int(fields[key].split()[0]) for key in ('RssAnon', 'RssFile')]
+
+    before = rss()
+    model = _flat_loaders(network, det_path, rec_path, quantize)[name]()
+    with torch.no_grad():
+        if name == 'detector':
+            model(torch.rand(1, 3, 320, 480))
+        else:
+            model(torch.rand(2, 1, 64, 256))
+    print(*[after - start for after, start in zip(rss(), before)])
+
+
+def bench_flat(network='generation2', repeat=3):
+    """
+    Load randomly initialized CRAFT and CRNN models from .pth against their
+    flat weights, with a parity check. On Linux, the memory each load adds
+    to a fresh process is measured too: anonymous (private) memory and file
+    pages, which processes mapping the same flat file share.
+
+    Dynamic int8 quantization (quantize=True, get_recognizer's default on
+    CPU) repacks the LSTM and Linear weights into new private tensors; only
+    the convolution weights stay mapped, so the recognizer saves less.
+    """
+    import subprocess
+    import sys
+    from .flat_weights import convert
+    model_pkg = importlib.import_module("easyocr.model.model" if network == 'generation1' else "easyocr.model.vgg_model")
+    channels = 512 if network == 'generation1' else 256
+    network_params = {'input_channel': 1, 'output_channel': channels, 'hidden_size': channels}
+    character = recognition_models['gen2']['english_g2']['characters']
+    torch.manual_seed(0)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        det_path, rec_path = os.path.join(tmp, 'craft.pth'), os.path.join(tmp, 'recognizer.pth')
+        torch.save(CRAFT().state_dict(), det_path)
+        recognizer = model_pkg.Model(num_class=len(character) + 1, **network_params)
+        torch.save({'module.' + k: v for k, v in recognizer.state_dict().items()}, rec_path)
+        loaders = _flat_loaders(network, det_path, rec_path)
+        page, crops = torch.rand(1, 3, 320, 480), torch.rand(2, 1, 64, 256)
+
+        convert(det_path)
+        convert(rec_path)
+
+        def load_pth(load):
+            # hide the flat weights so that the .pth is loaded
+            for path in (det_path, rec_path):
+                os.rename(path[:-4] + '.flat', path[:-4] + '.off')
+            try:
+                return load()
+            finally:
+                for path in (det_path, rec_path):
+                    os.rename(path[:-4] + '.off', path[:-4] + '.flat')
+
+        print(f"load from .pth vs flat weights ({network}), outputs match")
+        for name, load in loaders.items():
+            t_flat, model = _timeit(load, repeat)
+            t_pth, reference = _timeit(lambda: load_pth(load), repeat)
+            with torch.no_grad():
+                if name == 'detector':
+                    assert torch.equal(model(page, feature=False), reference(page, feature=False)), "detector outputs differ"
+                else:
+                    assert torch.equal(model(crops), reference(crops)), "recognizer outputs differ"
+            print(f"  {name}: .pth {t_pth*1000:.0f} ms, flat {t_flat*1000:.0f} ms ({t_pth/max(t_flat, 1e-9):.1f}x)")
+
+        if not os.path.isfile('/proc/self/status'):
+            return
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(
+            [os.path.dirname(os.path.dirname(os.path.abspath(__file__)))] + sys.path))
+
+        def measure(name, quantize):
+            code = 'from easyocr.benchmark import _load_rss; _load_rss(%r, %r, %r, %r, %r)' % (
+                network, det_path, rec_path, name, quantize)
+            output = subprocess.run([sys.executable, '-W', 'ignore', '-c', code], env=env, check=True,
+                                    stdout=subprocess.PIPE, universal_newlines=True).stdout
+            return [int(kb) / 1024 for kb in output.split()[-2:]]
+
+        print("memory added by loading and running the model in a fresh process: anonymous MB / file MB")
+        for name, quantize in (('detector', False), ('recognizer', False), ('recognizer', True)):
+            flat = measure(name, quantize)
+            pth = load_pth(lambda: measure(name, quantize))
+            label = name + (' (quantize)' if quantize else '')
+            print(f"  {label:<24} .pth {pth[0]:6.1f} / {pth[1]:5.1f}, flat {flat[0]:6.1f} / {flat[1]:5.1f}")
+
+
+class _HeatmapNet(object):
+    """ stands in for CRAFT: sleeps for `forward_ms` and returns synthetic score maps """
+
+    def __init__(self, forward_ms):
+        self.forward_ms = forward_ms
+        self.outputs = {}
+
+    def __call__(self, x, feature=True):
+        time.sleep(self.forward_ms / 1000)
+        if x.shape not in self.outputs:
+            maps = [synthetic_heatmaps(x.shape[2] // 2, x.shape[3] // 2, n_lines=x.shape[2] // 24, seed=k)
+                    for k in range(x.shape[0])]
+            self.outputs[x.shape] = np.stack([np.stack(pair) for pair in maps])
+        y = torch.from_numpy(self.outputs[x.shape].copy())
+        if not feature:
+            return y
+        return y.permute(0, 2, 3, 1), None
+
+
+def bench_postprocess(n_images=8, height=1280, width=1280, forward_ms=100, workers=4, component_workers=0,
+                      repeat=3):
+    """
+    test_net with serial vs threaded post-processing, on pages of different
+    sizes (one forward pass per bucket), checking that the boxes are identical.
+    """
+    net = _HeatmapNet(forward_ms)
+    images = [np.zeros((height + 256 * (k % 4), width, 3), dtype=np.uint8) for k in range(n_images)]
+    args = (max(height, width) + 1024, 1., net, images, 0.7, 0.4, 0.4, False, 'cpu')
+
+    test_net(*args)  # generate the heatmaps of every bucket once
+    t_serial, (boxes_serial, _) = _timeit(lambda: test_net(*args), repeat)
+    t_threaded, (boxes_threaded, _) = _timeit(lambda: test_net(*args, postprocess_workers=workers,
+                                                               component_workers=component_workers), repeat)
+
+    for a, b in zip(boxes_serial, boxes_threaded):
+        assert len(a) == len(b), "box count mismatch between serial and threaded post-processing"
+        for box_a, box_b in zip(a, b):
+            np.testing.assert_array_equal(box_a, box_b)
+
+    print(f"test_net on {n_images} pages of {height}..{height + 768}x{width}, "
+          f"{sum(len(b) for b in boxes_serial)} boxes, {forward_ms} ms per forward pass")
+    print(f"  serial:   {t_serial*1000:.1f} ms")
+    print(f"  threaded: {t_threaded*1000:.1f} ms ({t_serial/max(t_threaded, 1e-9):.1f}x, "
+          f"{workers} workers, {component_workers} component workers)")
+
+
+def synthetic_layout(n_columns=3, n_paragraphs=8, lines=6, words=8, seed=0):
+    """
+    Recognition results for a page of paragraphs laid out in columns: words of
+    random width and height with some jitter, in random order.
+    """
+    rng = np.random.RandomState(seed)
+    result = []
+    for column in range(n_columns):
+        y = int(rng.randint(0, 40))
+        for paragraph in range(n_paragraphs):
+            line_h = int(rng.randint(14, 40))
+            for line in range(int(rng.randint(1, lines + 1))):
+                x = column * 800 + int(rng.randint(0, 30))
+                for word in range(int(rng.randint(1, words + 1))):
+                    w = int(rng.randint(line_h, line_h * 3))
+                    if x + w > column * 800 + 700:
+                        break
+                    h = line_h + int(rng.randint(-3, 4))
+                    top = y + int(rng.randint(-3, 4))
+                    box = [[x, top], [x + w, top], [x + w, top + h], [x, top + h]]
+                    result.append((box, 'w%d' % len(result), 1.0))
+                    x += w + int(rng.randint(line_h // 4, line_h))
+                y += int(line_h * rng.uniform(1.1, 1.6))
+            y += int(line_h * rng.uniform(1.5, 4))
+    order = rng.permutation(len(result))
+    return [result[i] for i in order]
+
+
+def get_paragraph_reference(raw_result, x_ths=1, y_ths=0.5, mode = 'ltr'):
+    # the original, rescanning implementation of utils.get_paragraph
+    # create basic attributes
+    box_group = []
+    for box in raw_result:
+        all_x = [int(coord[0]) for coord in box[0]]
+        all_y = [int(coord[1]) for coord in box[0]]
+        min_x = min(all_x)
+        max_x = max(all_x)
+        min_y = min(all_y)
+        max_y = max(all_y)
+        height = max_y - min_y
+        box_group.append([box[1], min_x, max_x, min_y, max_y, height, 0.5*(min_y+max_y), 0]) # last element indicates group
+    # cluster boxes into paragraph
+    current_group = 1
+    while len([box for box in box_group if box[7]==0]) > 0:
+        box_group0 = [box for box in box_group if box[7]==0] # group0 = non-group
+        # new group
+        if len([box for box in box_group if box[7]==current_group]) == 0:
+            box_group0[0][7] = current_group # assign first box to form new group
+        # try to add group
+        else:
+            current_box_group = [box for box in box_group if box[7]==current_group]
+            mean_height = np.mean([box[5] for box in current_box_group])
+            min_gx = min([box[1] for box in current_box_group]) - x_ths*mean_height
+            max_gx = max([box[2] for box in current_box_group]) + x_ths*mean_height
+            min_gy = min([box[3] for box in current_box_group]) - y_ths*mean_height
+            max_gy = max([box[4] for box in current_box_group]) + y_ths*mean_height
+            add_box = False
+            for box in box_group0:
+                same_horizontal_level = (min_gx<=box[1]<=max_gx) or (min_gx<=box[2]<=max_gx)
+                same_vertical_level = (min_gy<=box[3]<=max_gy) or (min_gy<=box[4]<=max_gy)
+                if same_horizontal_level and same_vertical_level:
+                    box[7] = current_group
+                    add_box = True
+                    break
+            # cannot add more box, go to next group
+            if add_box==False:
+                current_group += 1
+    # arrage order in paragraph
+    result = []
+    for i in set(box[7] for box in box_group):
+        current_box_group = [box for box in box_group if box[7]==i]
+        mean_height = np.mean([box[5] for box in current_box_group])
+        min_gx = min([box[1] for box in current_box_group])
+        max_gx = max([box[2] for box in current_box_group])
+        min_gy = min([box[3] for box in current_box_group])
+        max_gy = max([box[4] for box in current_box_group])
+
+        text = ''
+        while len(current_box_group) > 0:
+            highest = min([box[6] for box in current_box_group])
+            candidates = [box for box in current_box_group if box[6]<highest+0.4*mean_height]
+            # get the far left
+            if mode == 'ltr':
+                most_left = min([box[1] for box in candidates])
+                for box in candidates:
+                    if box[1] == most_left: best_box = box
+            elif mode == 'rtl':
+                most_right = max([box[2] for box in candidates])
+                for box in candidates:
+                    if box[2] == most_right: best_box = box
+            text += ' '+best_box[0]
+            current_box_group.remove(best_box)
+
+        result.append([ [[min_gx,min_gy],[max_gx,min_gy],[max_gx,max_gy],[min_gx,max_gy]], text[1:]])
+
+    return result
+
+
+def bench_paragraph(n_columns=3, n_paragraphs=8, lines=6, words=8, n_layouts=20, repeat=3):
+    """
+    get_paragraph against the original implementation: identical output on
+    n_layouts synthetic pages (ltr/rtl, several thresholds), then timings on a
+    dense page.
+    """
+    for seed in range(n_layouts):
+        layout = synthetic_layout(n_columns, n_paragraphs, lines, words, seed)
+        for x_ths, y_ths in [(1, 0.5), (0.5, 0.2), (2, 1)]:
+            for mode in ['ltr', 'rtl']:
+                assert get_paragraph(layout, x_ths, y_ths, mode) == \
+                       get_paragraph_reference(layout, x_ths, y_ths, mode), \
+                       "paragraph mismatch (layout %d, x_ths=%s, y_ths=%s, %s)" % (seed, x_ths, y_ths, mode)
+
+    layout = synthetic_layout(n_columns, n_paragraphs, lines, words, n_layouts)
+    t_ref, _ = _timeit(lambda: get_paragraph_reference(layout), repeat)
+    t_new, result = _timeit(lambda: get_paragraph(layout), repeat)
+    print(f"get_paragraph, {n_layouts} layouts match; {len(layout)} boxes in {len(result)} paragraphs")
+    print(f"  original: {t_ref*1000:.1f} ms")
+    print(f"  sweep:    {t_new*1000:.1f} ms ({t_ref/max(t_new, 1e-9):.1f}x)")
+
+
+def synthetic_polys(n_lines=100, words=20, rotated=0.1, seed=0):
+    """
+    (N, 8) int32 detector polygons for a dense page: lines of word boxes with
+    jittered heights and baselines, and a fraction of rotated boxes.
+    """
+    rng = np.random.RandomState(seed)
+    polys = []
+    for line in range(n_lines):
+        line_h = int(rng.randint(12, 40))
+        y = line * 48 + int(rng.randint(0, 6))
+        x = int(rng.randint(0, 40))
+        for word in range(int(rng.randint(1, words + 1))):
+            w = int(rng.randint(line_h, line_h * 4))
+            h = line_h + int(rng.randint(-4, 5))
+            top = y + int(rng.randint(-3, 4))
+            if rng.rand() < rotated:
+                angle = rng.uniform(0.2, 1.2) * rng.choice([-1, 1])
+                c, s = np.cos(angle), np.sin(angle)
+                corners = np.array([[0, 0], [w, 0], [w, h], [0, h]]) @ np.array([[c, s], [-s, c]])
+                poly = (corners + (x, top)).reshape(-1)
+            else:
+                poly = [x, top, x + w, top, x + w, top + h, x, top + h]
+            polys.append(poly)
+            x += w + int(rng.randint(2, line_h * 2))
+    polys = np.array(polys).astype(np.int32)
+    return polys[rng.permutation(len(polys))]
+
+
+def group_text_box_reference(polys, slope_ths = 0.1, ycenter_ths = 0.5, height_ths = 0.5, width_ths = 1.0, add_margin = 0.05, sort_output = True):
+    # the original, per-box implementation of utils.group_text_box
+    # poly top-left, top-right, low-right, low-left
+    horizontal_list, free_list,combined_list, merged_list = [],[],[],[]
+
+    for poly in polys:
+        slope_up = (poly[3]-poly[1])/np.maximum(10, (poly[2]-poly[0]))
+        slope_down = (poly[5]-poly[7])/np.maximum(10, (poly[4]-poly[6]))
+        if max(abs(slope_up), abs(slope_down)) < slope_ths:
+            x_max = max([poly[0],poly[2],poly[4],poly[6]])
+            x_min = min([poly[0],poly[2],poly[4],poly[6]])
+            y_max = max([poly[1],poly[3],poly[5],poly[7]])
+            y_min = min([poly[1],poly[3],poly[5],poly[7]])
+            horizontal_list.append([x_min, x_max, y_min, y_max, 0.5*(y_min+y_max), y_max-y_min])
+        else:
+            height = np.linalg.norm([poly[6]-poly[0],poly[7]-poly[1]])
+            width = np.linalg.norm([poly[2]-poly[0],poly[3]-poly[1]])
+
+            margin = int(1.44*add_margin*min(width, height))
+
+            theta13 = abs(np.arctan( (poly[1]-poly[5])/np.maximum(10, (poly[0]-poly[4]))))
+            theta24 = abs(np.arctan( (poly[3]-poly[7])/np.maximum(10, (poly[2]-poly[6]))))
+            # do I need to clip minimum, maximum value here?
+            x1 = poly[0] - np.cos(theta13)*margin
+            y1 = poly[1] - np.sin(theta13)*margin
+            x2 = poly[2] + np.cos(theta24)*margin
+            y2 = poly[3] - np.sin(theta24)*margin
+            x3 = poly[4] + np.cos(theta13)*margin
+            y3 = poly[5] + np.sin(theta13)*margin
+            x4 = poly[6] - np.cos(theta24)*margin
+            y4 = poly[7] + np.sin(theta24)*margin
+
+            free_list.append([[x1,y1],[x2,y2],[x3,y3],[x4,y4]])
+    if sort_output:
+        horizontal_list = sorted(horizontal_list, key=lambda item: item[4])
+
+    # combine box
+    new_box = []
+    for poly in horizontal_list:
+
+        if len(new_box) == 0:
+            b_height = [poly[5]]
+            b_ycenter = [poly[4]]
+            new_box.append(poly)
+        else:
+            # comparable height and comparable y_center level up to ths*height
+            if abs(np.mean(b_ycenter) - poly[4]) < ycenter_ths*np.mean(b_height):
+                b_height.append(poly[5])
+                b_ycenter.append(poly[4])
+                new_box.append(poly)
+            else:
+                b_height = [poly[5]]
+                b_ycenter = [poly[4]]
+                combined_list.append(new_box)
+                new_box = [poly]
+    combined_list.append(new_box)
+
+    # merge list use sort again
+    for boxes in combined_list:
+        if len(boxes) == 1: # one box per line
+            box = boxes[0]
+            margin = int(add_margin*min(box[1]-box[0],box[5]))
+            merged_list.append([box[0]-margin,box[1]+margin,box[2]-margin,box[3]+margin])
+        else: # multiple boxes per line
+            boxes = sorted(boxes, key=lambda item: item[0])
+
+            merged_box, new_box = [],[]
+            for box in boxes:
+                if len(new_box) == 0:
+                    b_height = [box[5]]
+                    x_max = box[1]
+                    new_box.append(box)
+                else:
+                    if (abs(np.mean(b_height) - box[5]) < height_ths*np.mean(b_height)) and ((box[0]-x_max) < width_ths *(box[3]-box[2])): # merge boxes
+                        b_height.append(box[5])
+                        x_max = box[1]
+                        new_box.append(box)
+                    else:
+                        b_height = [box[5]]
+                        x_max = box[1]
+                        merged_box.append(new_box)
+                        new_box = [box]
+            if len(new_box) >0: merged_box.append(new_box)
+
+            for mbox in merged_box:
+                if len(mbox) != 1: # adjacent box in same line
+                    # do I need to add margin here?
+                    x_min = min(mbox, key=lambda x: x[0])[0]
+                    x_max = max(mbox, key=lambda x: x[1])[1]
+                    y_min = min(mbox, key=lambda x: x[2])[2]
+                    y_max = max(mbox, key=lambda x: x[3])[3]
+
+                    box_width = x_max - x_min
+                    box_height = y_max - y_min
+                    margin = int(add_margin * (min(box_width, box_height)))
+
+                    merged_list.append([x_min-margin, x_max+margin, y_min-margin, y_max+margin])
+                else: # non adjacent box in same line
+                    box = mbox[0]
+
+                    box_width = box[1] - box[0]
+                    box_height = box[3] - box[2]
+                    margin = int(add_margin * (min(box_width, box_height)))
+
+                    merged_list.append([box[0]-margin,box[1]+margin,box[2]-margin,box[3]+margin])
+    # may need to check if box is really in image
+    return merged_list, free_list
+
+
+def bench_textbox(n_lines=100, words=20, n_layouts=20, repeat=3):
+    """
+    group_text_box against the original implementation: identical boxes on
+    n_layouts synthetic pages and several thresholds, then timings.
+    """
+    for seed in range(n_layouts):
+        polys = synthetic_polys(n_lines, words, seed=seed)
+        for ths in [(0.1, 0.5, 0.5, 0.5, 0.1), (0.2, 0.3, 1.0, 2.0, 0.0), (0.05, 1.0, 0.2, 0.1, 0.2)]:
+            for sort_output in [True, False]:
+                horizontal, free = group_text_box(polys, *ths, sort_output)
+                horizontal_ref, free_ref = group_text_box_reference(list(polys), *ths, sort_output)
+                assert horizontal == horizontal_ref, "horizontal boxes mismatch (layout %d, %s)" % (seed, ths)
+                np.testing.assert_array_equal(np.array(free).reshape(-1, 8), np.array(free_ref).reshape(-1, 8))
+
+    polys = synthetic_polys(n_lines, words, seed=n_layouts)
+    t_ref, (horizontal, free) = _timeit(lambda: group_text_box_reference(list(polys)), repeat)
+    t_new, _ = _timeit(lambda: group_text_box(polys), repeat)
+    print(f"group_text_box, {n_layouts} layouts match; {len(polys)} boxes -> "
+          f"{len(horizontal)} horizontal, {len(free)} free")
+    print(f"  original:   {t_ref*1000:.1f} ms")
+    print(f"  vectorized: {t_new*1000:.1f} ms ({t_ref/max(t_new, 1e-9):.1f}x)")
+
+
+def bench_rotation(n_crops=200, imgH=64, angles=(90, 180, 270, 15), repeat=3, max_error=8.):
+    """
+    Rotation of recognition crops for test-time augmentation: scipy's
+    ndimage.rotate against rotate_image, which must match it exactly for
+    right angles. For other angles, the cv2 cubic warp and scipy's cubic
+    spline differ slightly; their mean absolute difference inside the
+    rotated crop (3 pixels off its edges) must stay below max_error grey
+    levels. A warp that is off by one pixel on these noise crops gives ~70.
+    """
+    from scipy import ndimage
+    rng = np.random.RandomState(0)
+    crops = [(rng.rand(imgH, int(rng.randint(imgH, imgH * 10))) * 255).astype(np.uint8) for _ in range(n_crops)]
+    for angle in angles:
+        t_scipy, rotated_scipy = _timeit(lambda: [ndimage.rotate(crop, angle, reshape=True) for crop in crops], repeat)
+        t_fast, rotated_fast = _timeit(lambda: [rotate_image(crop, angle) for crop in crops], repeat)
+        errors = []
+        for crop, a, b in zip(crops, rotated_scipy, rotated_fast):
+            assert a.shape == b.shape, "rotated shape mismatch at %s degrees" % angle
+            if angle % 90 == 0:
+                np.testing.assert_array_equal(a, b)
+                continue
+            inside = ndimage.rotate(np.ones(crop.shape, np.uint8), angle, reshape=True, order=0) > 0
+            inside = ndimage.binary_erosion(inside, iterations=3)
+            errors.append(np.abs(a.astype(np.float32) - b.astype(np.float32))[inside].mean())
+        error = f", mean abs difference {np.mean(errors):.2f} (max {np.max(errors):.2f})" if errors else ""
+        print(f"rotate {n_crops} crops by {angle} degrees: ndimage {t_scipy*1000:.1f} ms, "
+              f"rotate_image {t_fast*1000:.1f} ms ({t_scipy/max(t_fast, 1e-9):.1f}x){error}")
+        assert not errors or max(errors) < max_error, "rotate_image differs from ndimage.rotate at %s degrees" % angle
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="EasyOCR micro-benchmarks.")
+    subparsers = parser.add_subparsers(dest='target', required=True)
+
+    detboxes = subparsers.add_parser('detboxes', help="connected-component box extraction ('full' vs 'roi')")
+    detboxes.add_argument('--height', type=int, default=1280, help="heatmap height")
+    detboxes.add_argument('--width', type=int, default=1280, help="heatmap width")
+    detboxes.add_argument('--n_lines', type=int, default=60, help="number of synthetic text lines")
+    detboxes.add_argument('--repeat', type=int, default=3, help="number of timed runs (best is reported)")
+    detboxes.add_argument('--estimate_num_chars', action='store_true', help="also count characters per box")
+
+    beamsearch = subparsers.add_parser('beamsearch', help="CTC beam search (python loop vs vectorized)")
+    beamsearch.add_argument('--n_lines', type=int, default=64, help="number of text lines")
+    beamsearch.add_argument('--n_steps', type=int, default=64, help="time-steps per line")
+    beamsearch.add_argument('--n_class', type=int, default=97, help="number of classes including blank")
+    beamsearch.add_argument('--beamWidth', type=int, default=5, help="size of beam search")
+    beamsearch.add_argument('--repeat', type=int, default=3, help="number of timed runs (best is reported)")
+
+    charset = subparsers.add_parser('charset', help="per-call ignore-char and greedy decoding setup (uncached vs cached)")
+    charset.add_argument('--model', type=str, default='zh_sim_g2', help="gen2 recognition model whose characters are used")
+    charset.add_argument('--n_lines', type=int, default=64, help="number of decoded lines")
+    charset.add_argument('--n_steps', type=int, default=50, help="time-steps per line")
+    charset.add_argument('--repeat', type=int, default=3, help="number of timed runs (best is reported)")
+
+    onnx = subparsers.add_parser('onnx', help="detector and recognizer (torch vs onnxruntime), with a parity check")
+    onnx.add_argument('--network', type=str, default='generation2', choices=['generation1', 'generation2'],
+                      help="recognition network")
+    onnx.add_argument('--height', type=int, default=736, help="detector input height")
+    onnx.add_argument('--width', type=int, default=1024, help="detector input width")
+    onnx.add_argument('--n_crops', type=int, default=32, help="number of recognizer crops")
+    onnx.add_argument('--crop_width', type=int, default=256, help="width of the recognizer crops")
+    onnx.add_argument('--threads', type=int, default=None, help="onnxruntime intra-op threads")
+    onnx.add_argument('--repeat', type=int, default=3, help="number of timed runs (best is reported)")
+
+    postprocess = subparsers.add_parser('postprocess', help="detector post-processing (serial vs threaded)")
+    postprocess.add_argument('--n_images', type=int, default=8, help="number of pages")
+    postprocess.add_argument('--height', type=int, default=1280, help="height of the smallest page")
+    postprocess.add_argument('--width', type=int, default=1280, help="page width")
+    postprocess.add_argument('--forward_ms', type=int, default=100, help="simulated forward pass time")
+    postprocess.add_argument('--workers', type=int, default=4, help="post-processing threads")
+    postprocess.add_argument('--component_workers', type=int, default=0, help="threads per heatmap")
+    postprocess.add_argument('--repeat', type=int, default=3, help="number of timed runs (best is reported)")
+
+    paragraph = subparsers.add_parser('paragraph', help="paragraph assembly (original vs sorted sweep), with an equivalence check")
+    paragraph.add_argument('--n_columns', type=int, default=3, help="number of text columns")
+    paragraph.add_argument('--n_paragraphs', type=int, default=8, help="paragraphs per column")
+    paragraph.add_argument('--lines', type=int, default=6, help="maximum lines per paragraph")
+    paragraph.add_argument('--words', type=int, default=8, help="maximum words per line")
+    paragraph.add_argument('--n_layouts', type=int, default=20, help="number of layouts checked for equivalence")
+    paragraph.add_argument('--repeat', type=int, default=3, help="number of timed runs (best is reported)")
+
+    textbox = subparsers.add_parser('textbox', help="line grouping of detected boxes (original vs vectorized), with an equivalence check")
+    textbox.add_argument('--n_lines', type=int, default=100, help="number of text lines")
+    textbox.add_argument('--words', type=int, default=20, help="maximum words per line")
+    textbox.add_argument('--n_layouts', type=int, default=20, help="number of layouts checked for equivalence")
+    textbox.add_argument('--repeat', type=int, default=3, help="number of timed runs (best is reported)")
+
+    rotation = subparsers.add_parser('rotation', help="crop rotation for test-time augmentation (ndimage vs rotate_image)")
+    rotation.add_argument('--n_crops', type=int, default=200, help="number of crops")
+    rotation.add_argument('--angles', type=int, nargs='+', default=[90, 180, 270, 15], help="rotation angles")
+    rotation.add_argument('--repeat', type=int, default=3, help="number of timed runs (best is reported)")
+
+    torchscript = subparsers.add_parser('torchscript', help="recognizer (eager vs traced per width bucket), with a parity check")
+    torchscript.add_argument('--network', type=str, default='generation2', choices=['generation1', 'generation2'],
+                             help="recognition network")
+    torchscript.add_argument('--n_crops', type=int, default=32, help="number of recognizer crops")
+    torchscript.add_argument('--widths', type=int, nargs='+', default=[128, 256, 512], help="crop widths")
+    torchscript.add_argument('--quantize', action='store_true', help="dynamic int8 quantization")
+    torchscript.add_argument('--repeat', type=int, default=3, help="number of timed runs (best is reported)")
+
+    pool = subparsers.add_parser('pool', help="readtext over pages (Reader vs ReaderPool), with an equivalence check")
+    pool.add_argument('--images', type=str, nargs='+', required=True, help="page images or directories")
+    pool.add_argument('--lang', type=str, nargs='+', default=['en'], help="languages of the Reader")
+    pool.add_argument('--model_storage_directory', type=str, default=None, help="directory of the model files")
+    pool.add_argument('--workers', type=int, default=2, help="worker processes")
+    pool.add_argument('--threads', type=int, default=1, help="torch threads per worker")
+    pool.add_argument('--repeat', type=int, default=1, help="number of timed runs (best is reported)")
+
+    flat = subparsers.add_parser('flat', help="model loading (.pth vs memory-mapped flat weights), with a parity check")
+    flat.add_argument('--network', type=str, default='generation2', choices=['generation1', 'generation2'],
+                      help="recognition network")
+    flat.add_argument('--repeat', type=int, default=3, help="number of timed runs (best is reported)")
+
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    if args.target == 'detboxes':
+        bench_detboxes(height=args.height, width=args.width, n_lines=args.n_lines,
+                       repeat=args.repeat, estimate_num_chars=args.estimate_num_chars)
+    elif args.target == 'beamsearch':
+        bench_beamsearch(n_lines=args.n_lines, n_steps=args.n_steps, n_class=args.n_class,
+                         beamWidth=args.beamWidth, repeat=args.repeat)
+    elif args.target == 'charset':
+        bench_charset(model=args.model, n_lines=args.n_lines, n_steps=args.n_steps, repeat=args.repeat)
+    elif args.target == 'onnx':
+        bench_onnx(network=args.network, height=args.height, width=args.width, n_crops=args.n_crops,
+                   crop_width=args.crop_width, threads=args.threads, repeat=args.repeat)
+    elif args.target == 'postprocess':
+        bench_postprocess(n_images=args.n_images, height=args.height, width=args.width,
+                          forward_ms=args.forward_ms, workers=args.workers,
+                          component_workers=args.component_workers, repeat=args.repeat)
+    elif args.target == 'paragraph':
+        bench_paragraph(n_columns=args.n_columns, n_paragraphs=args.n_paragraphs, lines=args.lines,
+                        words=args.words, n_layouts=args.n_layouts, repeat=args.repeat)
+    elif args.target == 'textbox':
+        bench_textbox(n_lines=args.n_lines, words=args.words, n_layouts=args.n_layouts, repeat=args.repeat)
+    elif args.target == 'rotation':
+        bench_rotation(n_crops=args.n_crops, angles=args.angles, repeat=args.repeat)
+    elif args.target == 'torchscript':
+        bench_torchscript(network=args.network, n_crops=args.n_crops, widths=args.widths,
+                          quantize=args.quantize, repeat=args.repeat)
+    elif args.target == 'pool':
+        bench_pool(args.images, lang_list=args.lang, model_storage_directory=args.model_storage_directory,
+                   workers=args.workers, threads=args.threads, repeat=args.repeat)
+    elif args.target == 'flat':
+        bench_flat(network=args.network, repeat=args.repeat)
+
+
+if __name__ == "__main__":
+    main()
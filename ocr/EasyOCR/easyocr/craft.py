@@ -55,7 +55,12 @@ class CRAFT(nn.Module):
         init_weights(self.upconv4.modules())
         init_weights(self.conv_cls.modules())
 
-    def forward(self, x):
+    def forward(self, x, feature=True):
+        """
+        Returns (score maps NHWC, feature map). With feature=False, only the
+        text and link score maps are returned, as one NCHW tensor, and the
+        feature map is freed as soon as they are computed.
+        """
         """ Base network """
         sources = self.basenet(x)
 
@@ -73,8 +78,11 @@ class CRAFT(nn.Module):
 
         y = F.interpolate(y, size=sources[4].size()[2:], mode='bilinear', align_corners=False)
         y = torch.cat([y, sources[4]], dim=1)
-        feature = self.upconv4(y)
+        y = self.upconv4(y)
 
+        if not feature:
+            return self.conv_cls(y)
+        feature = y
         y = self.conv_cls(feature)
 
         return y.permute(0,2,3,1), feature
@@ -84,6 +84,99 @@ def getDetBoxes_core(textmap, linkmap, text_threshold, link_threshold, low_text,
 
     return det, labels, mapper
 
+def getDetBoxes_core_roi(textmap, linkmap, text_threshold, link_threshold, low_text, estimate_num_chars=False, executor=None):
+    # same as getDetBoxes_core, but every component is processed inside its own
+    # (dilation-padded) bounding box from `stats` instead of over the whole heatmap
+    linkmap = linkmap.copy()
+    textmap = textmap.copy()
+
+    """ labeling method """
+    ret, text_score = cv2.threshold(textmap, low_text, 1, 0)
+    ret, link_score = cv2.threshold(linkmap, link_threshold, 1, 0)
+
+    text_score_comb = np.clip(text_score + link_score, 0, 1)
+    nLabels, labels, stats, centroids = cv2.connectedComponentsWithStats(text_score_comb.astype(np.uint8), connectivity=4)
+    link_area = np.logical_and(link_score==1, text_score==0)
+
+    components = [k for k in range(1, nLabels) if stats[k, cv2.CC_STAT_AREA] >= 10]  # size filtering
+    args = (textmap, linkmap, labels, stats, link_area, text_threshold, estimate_num_chars)
+    if executor is None or len(components) < 2:
+        found = _roi_components(components, *args)
+    else:
+        # components are independent: process interleaved chunks of them in the
+        # executor and put the results back in component order
+        n_chunks = min(len(components), 16)
+        chunks = [components[i::n_chunks] for i in range(n_chunks)]
+        found = [None] * len(components)
+        for i, result in enumerate(executor.map(lambda chunk: _roi_components(chunk, *args), chunks)):
+            found[i::n_chunks] = result
+    found = [item for item in found if item is not None]
+
+    det = [box for box, _ in found]
+    mapper = [m for _, m in found]
+    return det, labels, mapper
+
+def _roi_components(components, textmap, linkmap, labels, stats, link_area, text_threshold, estimate_num_chars):
+    """ (box, mapper value) of each kept component of getDetBoxes_core_roi, None for discarded ones """
+    img_h, img_w = textmap.shape
+    found = []
+    for k in components:
+        size = stats[k, cv2.CC_STAT_AREA]
+        x, y = stats[k, cv2.CC_STAT_LEFT], stats[k, cv2.CC_STAT_TOP]
+        w, h = stats[k, cv2.CC_STAT_WIDTH], stats[k, cv2.CC_STAT_HEIGHT]
+        niter = int(math.sqrt(size * min(w, h) / (w * h)) * 2)
+        sx, ex, sy, ey = x - niter, x + w + niter + 1, y - niter, y + h + niter + 1
+        # boundary check
+        if sx < 0 : sx = 0
+        if sy < 0 : sy = 0
+        if ex >= img_w: ex = img_w
+        if ey >= img_h: ey = img_h
+
+        # component mask restricted to the dilation window
+        mask = labels[sy:ey, sx:ex] == k
+        text_roi = textmap[sy:ey, sx:ex]
+
+        # thresholding
+        if np.max(text_roi[mask]) < text_threshold:
+            found.append(None)
+            continue
+
+        # make segmentation map
+        segmap = np.zeros(mask.shape, dtype=np.uint8)
+        segmap[mask] = 255
+        if estimate_num_chars:
+            _, character_locs = cv2.threshold((text_roi - linkmap[sy:ey, sx:ex]) * segmap /255., text_threshold, 1, 0)
+            _, n_chars = label(character_locs)
+            mapped = n_chars
+        else:
+            mapped = k
+        segmap[link_area[sy:ey, sx:ex]] = 0   # remove link area
+        kernel = cv2.getStructuringElement(cv2.MORPH_RECT,(1 + niter, 1 + niter))
+        segmap = cv2.dilate(segmap, kernel)
+
+        # make box
+        np_contours = np.roll(np.array(np.where(segmap!=0)),1,axis=0).transpose().reshape(-1,2)
+        np_contours += (sx, sy)
+        rectangle = cv2.minAreaRect(np_contours)
+        box = cv2.boxPoints(rectangle)
+
+        # align diamond-shape
+        w, h = np.linalg.norm(box[0] - box[1]), np.linalg.norm(box[1] - box[2])
+        box_ratio = max(w, h) / (min(w, h) + 1e-5)
+        if abs(1 - box_ratio) <= 0.1:
+            l, r = min(np_contours[:,0]), max(np_contours[:,0])
+            t, b = min(np_contours[:,1]), max(np_contours[:,1])
+            box = np.array([[l, t], [r, t], [r, b], [l, b]], dtype=np.float32)
+
+        # make clock-wise order
+        startidx = box.sum(axis=1).argmin()
+        box = np.roll(box, 4-startidx, 0)
+        box = np.array(box)
+
+        found.append((box, mapped))
+
+    return found
+
 def getPoly_core(boxes, labels, mapper, linkmap):
     # configs
     num_cp = 5
@@ -230,10 +323,15 @@ def getPoly_core(boxes, labels, mapper, linkmap):
 
     return polys
 
-def getDetBoxes(textmap, linkmap, text_threshold, link_threshold, low_text, poly=False, estimate_num_chars=False):
+def getDetBoxes(textmap, linkmap, text_threshold, link_threshold, low_text, poly=False, estimate_num_chars=False, cc_engine='roi', executor=None):
     if poly and estimate_num_chars:
         raise Exception("Estimating the number of characters not currently supported with poly.")
-    boxes, labels, mapper = getDetBoxes_core(textmap, linkmap, text_threshold, link_threshold, low_text, estimate_num_chars)
+    if cc_engine == 'roi':
+        boxes, labels, mapper = getDetBoxes_core_roi(textmap, linkmap, text_threshold, link_threshold, low_text, estimate_num_chars, executor)
+    elif cc_engine == 'full':
+        boxes, labels, mapper = getDetBoxes_core(textmap, linkmap, text_threshold, link_threshold, low_text, estimate_num_chars)
+    else:
+        raise ValueError("Invalid cc_engine. Supporting engine = 'roi', 'full'")
 
     if poly:
         polys = getPoly_core(boxes, labels, mapper, linkmap)
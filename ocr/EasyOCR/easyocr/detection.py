@@ -5,10 +5,14 @@ from PIL import Image
 from collections import OrderedDict
 
 import cv2
+import math
+import os
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 from .craft_utils import getDetBoxes, adjustResultCoordinates
-from .imgproc import resize_aspect_ratio, normalizeMeanVariance
+from .imgproc import target_size, resize_normalize_into, CanvasPool
 from .craft import CRAFT
+from .flat_weights import load_flat
 
 def copyStateDict(state_dict):
     if list(state_dict.keys())[0].startswith("module"):
@@ -21,39 +25,53 @@ def copyStateDict(state_dict):
         new_state_dict[name] = v
     return new_state_dict
 
-def test_net(canvas_size, mag_ratio, net, image, text_threshold, link_threshold, low_text, poly, device, estimate_num_chars=False):
+def group_by_canvas(shapes, bucket_size=256):
+    """
+    Group image indices by canvas size so each group can share one forward pass.
+    Shapes are bucketed by rounding height and width up to `bucket_size`.
+    """
+    buckets = OrderedDict()
+    for i, (h, w) in enumerate(shapes):
+        key = (math.ceil(h / bucket_size), math.ceil(w / bucket_size))
+        buckets.setdefault(key, []).append(i)
+    return list(buckets.values())
+
+def test_net(canvas_size, mag_ratio, net, image, text_threshold, link_threshold, low_text, poly, device, estimate_num_chars=False, cc_engine='roi', bucket_size=256, canvas_pool=None,
+             postprocess_workers=0, component_workers=0):
+    """
+    With postprocess_workers > 0, the post-processing of each image (getDetBoxes
+    and coordinate adjustment) runs in that many threads while the next bucket
+    goes through the network. With component_workers > 0, the connected
+    components of a heatmap are also split across threads (cc_engine='roi').
+    Results are returned in input order either way.
+    """
     if isinstance(image, np.ndarray) and len(image.shape) == 4:  # image is batch of np arrays
         image_arrs = image
+    elif isinstance(image, list):                                # image is list of np arrays, sizes may differ
+        image_arrs = image
     else:                                                        # image is single numpy array
         image_arrs = [image]
 
-    img_resized_list = []
-    # resize
+    if canvas_pool is None:
+        canvas_pool = CanvasPool()
+
+    sizes, ratio_list = [], []
     for img in image_arrs:
-        img_resized, target_ratio, size_heatmap = resize_aspect_ratio(img, canvas_size,
-                                                                      interpolation=cv2.INTER_LINEAR,
-                                                                      mag_ratio=mag_ratio)
-        img_resized_list.append(img_resized)
-    ratio_h = ratio_w = 1 / target_ratio
-    # preprocessing
-    x = [np.transpose(normalizeMeanVariance(n_img), (2, 0, 1))
-         for n_img in img_resized_list]
-    x = torch.from_numpy(np.array(x))
-    x = x.to(device)
-
-    # forward pass
-    with torch.no_grad():
-        y, feature = net(x)
+        target_h, target_w, target_h32, target_w32, target_ratio = target_size(img.shape[0], img.shape[1],
+                                                                               canvas_size, mag_ratio)
+        sizes.append((target_h, target_w, target_h32, target_w32))
+        ratio_list.append(1 / target_ratio)
 
-    boxes_list, polys_list = [], []
-    for out in y:
-        # make score and link map
-        score_text = out[:, :, 0].cpu().data.numpy()
-        score_link = out[:, :, 1].cpu().data.numpy()
+    component_executor = ThreadPoolExecutor(component_workers) if component_workers > 0 else None
+    executor = ThreadPoolExecutor(postprocess_workers) if postprocess_workers > 0 else None
+
+    def postprocess(i, score_text, score_link):
+        ratio_h = ratio_w = ratio_list[i]
 
         # Post-processing
         boxes, polys, mapper = getDetBoxes(
-            score_text, score_link, text_threshold, link_threshold, low_text, poly, estimate_num_chars)
+            score_text, score_link, text_threshold, link_threshold, low_text, poly, estimate_num_chars, cc_engine,
+            component_executor)
 
         # coordinate adjustment
         boxes = adjustResultCoordinates(boxes, ratio_w, ratio_h)
@@ -66,36 +84,260 @@ def test_net(canvas_size, mag_ratio, net, image, text_threshold, link_threshold,
                 boxes[k] = (boxes[k], mapper[k])
             if polys[k] is None:
                 polys[k] = boxes[k]
-        boxes_list.append(boxes)
-        polys_list.append(polys)
+        return boxes, polys
+
+    results = [None] * len(sizes)
+    try:
+        for indices in group_by_canvas([size[2:] for size in sizes], bucket_size):
+            # resize, pad and normalize every image of the bucket straight into one reused NCHW buffer
+            canvas_h = max(sizes[i][2] for i in indices)
+            canvas_w = max(sizes[i][3] for i in indices)
+            x = canvas_pool.get((len(indices), 3, canvas_h, canvas_w))
+            for k, i in enumerate(indices):
+                resize_normalize_into(image_arrs[i], x[k], sizes[i][0], sizes[i][1],
+                                      cv2.INTER_LINEAR, canvas_pool)
+            x = torch.from_numpy(x)
+            x = x.to(device)
+
+            # forward pass, only the score maps come back to the host, in one copy
+            with torch.no_grad():
+                y = net(x, feature=False)
+            y = y.contiguous().cpu().numpy()
+
+            for i, out in zip(indices, y):
+                # crop the heatmap back to this image's own canvas
+                h, w = sizes[i][2:]
+
+                # make score and link map
+                score_text = out[0, :h // 2, :w // 2]
+                score_link = out[1, :h // 2, :w // 2]
+
+                if executor is None:
+                    results[i] = postprocess(i, score_text, score_link)
+                else:
+                    results[i] = executor.submit(postprocess, i, score_text, score_link)
 
+        if executor is not None:
+            results = [future.result() for future in results]
+    finally:
+        for pool in (executor, component_executor):
+            if pool is not None:
+                pool.shutdown(wait=True)
+
+    boxes_list = [boxes for boxes, polys in results]
+    polys_list = [polys for boxes, polys in results]
     return boxes_list, polys_list
 
-def get_detector(trained_model, device='cpu', quantize=True, cudnn_benchmark=False):
-    net = CRAFT()
+def tile_grid(height, width, tile_size, overlap):
+    """ (y0, x0, y1, x1) of tiles of at most tile_size x tile_size covering the page, overlapping by overlap """
+    step = max(tile_size - overlap, 1)
+    def starts(length):
+        n = max(math.ceil((length - overlap) / step), 1)
+        return sorted(set(min(i * step, max(length - tile_size, 0)) for i in range(n)))
+    return [(y0, x0, min(y0 + tile_size, height), min(x0 + tile_size, width))
+            for y0 in starts(height) for x0 in starts(width)]
 
-    if device == 'cpu':
-        net.load_state_dict(copyStateDict(torch.load(trained_model, map_location=device)))
-        if quantize:
-            try:
-                torch.quantization.quantize_dynamic(net, dtype=torch.qint8, inplace=True)
-            except:
-                pass
+def seam_pairs(x0, y0, x1, y1, candidates):
+    """
+    Pairs (i, j), i < j, of the candidate boxes whose rectangles overlap, found
+    with a grid index of about one box per cell, so that memory grows with the
+    number of candidates rather than its square.
+    """
+    if len(candidates) < 2:
+        return np.zeros((0, 2), dtype=np.int64)
+    cell = max(float(np.median(np.maximum(x1 - x0, y1 - y0)[candidates])), 8.)
+    cx0, cx1 = (x0[candidates] // cell).astype(np.int64), (x1[candidates] // cell).astype(np.int64)
+    cy0, cy1 = (y0[candidates] // cell).astype(np.int64), (y1[candidates] // cell).astype(np.int64)
+    # one entry per (cell, box) that the box covers
+    nx, ny = cx1 - cx0 + 1, cy1 - cy0 + 1
+    box = np.repeat(np.arange(len(candidates)), nx * ny)
+    k = np.arange(len(box)) - np.repeat(np.cumsum(nx * ny) - nx * ny, nx * ny)
+    cx, cy = cx0[box] + k % nx[box], cy0[box] + k // nx[box]
+    cell_id = (cy - cy.min()) * (cx.max() - cx.min() + 1) + (cx - cx.min())
+    order = np.lexsort((box, cell_id))
+    cell_id, box = cell_id[order], box[order]
+
+    pairs = []
+    for d in range(1, len(box)):
+        same = cell_id[d:] == cell_id[:-d]
+        if not same.any():
+            break
+        pairs.append(np.stack([box[:-d][same], box[d:][same]], axis=1))
+    pairs = candidates[np.unique(np.concatenate(pairs), axis=0)] if pairs else np.zeros((0, 2), dtype=np.int64)
+    i, j = pairs[:, 0], pairs[:, 1]
+    overlap = (np.minimum(x1[i], x1[j]) > np.maximum(x0[i], x0[j])) & (np.minimum(y1[i], y1[j]) > np.maximum(y0[i], y0[j]))
+    return pairs[overlap]
+
+def merge_tile_polys(polys, tile_ids, tiles, height, width, margin=4):
+    """
+    Merge boxes found in overlapping tiles (page coordinates).
+    Two boxes from different tiles are merged when their bounding rectangles
+    overlap by at least half of the smaller one (the same text seen twice),
+    or when one of them is cut by an inner tile edge and they continue each
+    other across the seam. Returns the groups of merged box indices, in order
+    of their first box.
+    """
+    n = len(polys)
+    if n == 0:
+        return []
+    pts = np.array([np.asarray(p, dtype=np.float32).reshape(-1, 2) for p in polys])
+    x0, y0 = pts[:, :, 0].min(1), pts[:, :, 1].min(1)
+    x1, y1 = pts[:, :, 0].max(1), pts[:, :, 1].max(1)
+    tiles = np.array(tiles)
+    t = tiles[tile_ids]
+    # cut by an inner tile edge, i.e. an edge that is not the page border
+    cut_x = ((x0 <= t[:, 1] + margin) & (t[:, 1] > 0)) | ((x1 >= t[:, 3] - margin) & (t[:, 3] < width))
+    cut_y = ((y0 <= t[:, 0] + margin) & (t[:, 0] > 0)) | ((y1 >= t[:, 2] - margin) & (t[:, 2] < height))
+
+    # boxes of different tiles only overlap where the extents of their tile
+    # columns (rows), boxes sticking out included, do: keep the boxes reaching
+    # into the extent of another column or row of tiles.
+    seam = np.zeros(n, dtype=bool)
+    for lo, hi, start, end in ((x0, x1, 1, 3), (y0, y1, 0, 2)):
+        starts, first = np.unique(tiles[:, start], return_index=True)
+        k = np.searchsorted(starts, t[:, start])
+        ext_start, ext_end = starts.astype(np.float64), tiles[first, end].astype(np.float64)
+        np.minimum.at(ext_start, k, lo)
+        np.maximum.at(ext_end, k, hi)
+        # furthest end of the columns before each one, nearest start of those after it
+        end_before = np.concatenate([[-np.inf], np.maximum.accumulate(ext_end)[:-1]])
+        start_after = np.concatenate([np.minimum.accumulate(ext_start[::-1])[::-1][1:], [np.inf]])
+        seam |= (lo < end_before[k]) | (hi > start_after[k])
+
+    i, j = seam_pairs(x0, y0, x1, y1, np.nonzero(seam)[0]).T
+    ix = np.minimum(x1[i], x1[j]) - np.maximum(x0[i], x0[j])
+    iy = np.minimum(y1[i], y1[j]) - np.maximum(y0[i], y0[j])
+    area = (x1 - x0) * (y1 - y0)
+    inter = np.clip(ix, 0, None) * np.clip(iy, 0, None)
+    min_w = np.maximum(np.minimum(x1[i] - x0[i], x1[j] - x0[j]), 1)
+    min_h = np.maximum(np.minimum(y1[i] - y0[i], y1[j] - y0[j]), 1)
+    duplicate = inter >= 0.5 * np.maximum(np.minimum(area[i], area[j]), 1)
+    across_x = (cut_x[i] | cut_x[j]) & (ix > 0) & (iy >= 0.5 * min_h)
+    across_y = (cut_y[i] | cut_y[j]) & (iy > 0) & (ix >= 0.5 * min_w)
+    merge = (duplicate | across_x | across_y) & (tile_ids[i] != tile_ids[j])
+
+    parent = list(range(n))
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+    for i, j in zip(i[merge], j[merge]):
+        ri, rj = find(i), find(j)
+        if ri != rj:
+            parent[max(ri, rj)] = min(ri, rj)
+
+    groups = OrderedDict()
+    for i in range(n):
+        groups.setdefault(find(i), []).append(i)
+    return list(groups.values())
+
+def test_net_tiled(net, image, text_threshold, link_threshold, low_text, poly, device, estimate_num_chars=False,
+                   cc_engine='roi', tile_size=1280, tile_overlap=128, tile_batch_size=4, tile_workers=0,
+                   canvas_pool=None, postprocess_workers=0, component_workers=0):
+    """
+    Detect text at native resolution by running CRAFT on overlapping tiles.
+    At most tile_batch_size tiles go through one forward pass, which bounds
+    peak memory; with tile_workers > 0, batches of tiles run in that many
+    threads (peak memory grows accordingly). Boxes are post-processed per tile
+    and merged across tile seams; a merged box is the bounding rectangle of its
+    parts. Returns (boxes_list, polys_list) like test_net.
+    """
+    if isinstance(image, np.ndarray) and len(image.shape) == 4:
+        image_arrs = image
+    elif isinstance(image, list):
+        image_arrs = image
     else:
+        image_arrs = [image]
+    if tile_overlap >= tile_size:
+        raise ValueError("tile_overlap must be smaller than tile_size")
+
+    pages = [tile_grid(img.shape[0], img.shape[1], tile_size, tile_overlap) for img in image_arrs]
+    jobs = [(p, t) for p, tiles in enumerate(pages) for t in range(len(tiles))]
+    chunks = [jobs[k:k + tile_batch_size] for k in range(0, len(jobs), tile_batch_size)]
+
+    def detect_chunk(chunk):
+        tiles = [image_arrs[p][y0:y1, x0:x1] for p, t in chunk for y0, x0, y1, x1 in [pages[p][t]]]
+        # tiles are never larger than the canvas, so they are not resized
+        return test_net(tile_size, 1., net, tiles, text_threshold, link_threshold, low_text, poly,
+                        device, estimate_num_chars, cc_engine, canvas_pool=canvas_pool if tile_workers == 0 else None,
+                        postprocess_workers=postprocess_workers, component_workers=component_workers)[1]
+
+    if tile_workers > 0:
+        with ThreadPoolExecutor(max_workers=tile_workers) as executor:
+            chunk_polys = list(executor.map(detect_chunk, chunks))
+    else:
+        chunk_polys = [detect_chunk(chunk) for chunk in chunks]
+
+    found = [([], [], []) for _ in pages] # polys, num chars, tile ids of each page
+    for chunk, polys_list in zip(chunks, chunk_polys):
+        for (p, t), polys in zip(chunk, polys_list):
+            y0, x0 = pages[p][t][:2]
+            for item in polys:
+                box, num_chars = item if estimate_num_chars else (item, 0)
+                found[p][0].append(np.asarray(box, dtype=np.float32).reshape(-1, 2) + (x0, y0))
+                found[p][1].append(num_chars)
+                found[p][2].append(t)
+
+    boxes_list, polys_list = [], []
+    for img, tiles, (polys, num_chars, tile_ids) in zip(image_arrs, pages, found):
+        merged = []
+        for group in merge_tile_polys(polys, np.array(tile_ids, dtype=np.int64), tiles, img.shape[0], img.shape[1]):
+            if len(group) == 1:
+                box = polys[group[0]]
+            else:
+                pts = np.concatenate([polys[i] for i in group])
+                (l, t), (r, b) = pts.min(0), pts.max(0)
+                box = np.array([[l, t], [r, t], [r, b], [l, b]], dtype=np.float32)
+            if estimate_num_chars:
+                box = (box, max(num_chars[i] for i in group))
+            merged.append(box)
+        boxes_list.append(merged)
+        polys_list.append(merged)
+    return boxes_list, polys_list
+
+def int8_path(model_path):
+    return os.path.splitext(model_path)[0] + '_int8.pth'
+
+def get_detector(trained_model, device='cpu', quantize=True, cudnn_benchmark=False):
+    # CRAFT has no Linear/LSTM layers for dynamic quantization: on CPU, quantize
+    # uses the static int8 model calibrated with `python -m easyocr.quantization`
+    if device == 'cpu' and quantize and os.path.isfile(int8_path(trained_model)):
+        # torch.ao.quantization is only imported when there is an int8 model
+        from .quantization import load_quantized
+        quantized = load_quantized(trained_model, CRAFT())
+        if quantized is not None:
+            return quantized
+
+    # weights converted with `python -m easyocr.flat_weights` are mapped, not loaded
+    net = load_flat(trained_model, CRAFT)
+    if net is None:
+        net = CRAFT()
         net.load_state_dict(copyStateDict(torch.load(trained_model, map_location=device)))
+    if device != 'cpu':
         net = torch.nn.DataParallel(net).to(device)
         cudnn.benchmark = cudnn_benchmark
 
     net.eval()
     return net
 
-def get_textbox(detector, image, canvas_size, mag_ratio, text_threshold, link_threshold, low_text, poly, device, optimal_num_chars=None):
+def get_textbox(detector, image, canvas_size, mag_ratio, text_threshold, link_threshold, low_text, poly, device, optimal_num_chars=None, cc_engine='roi', bucket_size=256, canvas_pool=None,
+                tile_size=None, tile_overlap=128, tile_batch_size=4, tile_workers=0, postprocess_workers=0, component_workers=0):
     result = []
     estimate_num_chars = optimal_num_chars is not None
-    bboxes_list, polys_list = test_net(canvas_size, mag_ratio, detector,
-                                       image, text_threshold,
-                                       link_threshold, low_text, poly,
-                                       device, estimate_num_chars)
+    if tile_size:
+        bboxes_list, polys_list = test_net_tiled(detector, image, text_threshold,
+                                                 link_threshold, low_text, poly,
+                                                 device, estimate_num_chars, cc_engine,
+                                                 tile_size, tile_overlap, tile_batch_size,
+                                                 tile_workers, canvas_pool, postprocess_workers,
+                                                 component_workers)
+    else:
+        bboxes_list, polys_list = test_net(canvas_size, mag_ratio, detector,
+                                           image, text_threshold,
+                                           link_threshold, low_text, poly,
+                                           device, estimate_num_chars, cc_engine, bucket_size, canvas_pool,
+                                           postprocess_workers, component_workers)
     if estimate_num_chars:
         polys_list = [[p for p, _ in sorted(polys, key=lambda x: abs(optimal_num_chars - x[1]))]
                       for polys in polys_list]
@@ -1,11 +1,15 @@
 # -*- coding: utf-8 -*-
 
 from .detection import get_detector, get_textbox
-from .recognition import get_recognizer, get_text
-from .utils import group_text_box, get_image_list, calculate_md5, get_paragraph,\
+from .imgproc import CanvasPool
+from .onnx_backend import load_or_export, export_detector, export_recognizer, OrtDetector, OrtRecognizer
+from .torchscript_backend import TracedRecognizer
+from .recognition import get_recognizer, get_text, get_text_scheduled, get_ignore_mask,\
+                         PreprocessPool, forward_takes_text
+from .utils import group_text_box, get_image_list, verified_md5, get_paragraph,\
                    download_and_unzip, printProgressBar, diff, reformat_input,\
-                   make_rotated_img_list, set_result_with_confidence,\
-                   reformat_input_batched
+                   rotation_tta,\
+                   reformat_input_batched, CTCLabelConverter
 from .config import *
 from bidi.algorithm import get_display
 import numpy as np
@@ -13,7 +17,11 @@ import cv2
 import torch
 import os
 import sys
+import threading
+import time
 from PIL import Image
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from logging import getLogger
 import yaml
 
@@ -32,7 +40,8 @@ class Reader(object):
     def __init__(self, lang_list, gpu=True, model_storage_directory=None,
                  user_network_directory=None, recog_network = 'standard',
                  download_enabled=True, detector=True, recognizer=True,
-                 verbose=True, quantize=True, cudnn_benchmark=False):
+                 verbose=True, quantize=True, cudnn_benchmark=False, verify_in_background=False,
+                 backend='torch', backend_threads=None, compile_recognizer=False):
         """Create an EasyOCR Reader
 
         Parameters:
@@ -49,7 +58,29 @@ class Reader(object):
             EASYOCR_MODULE_PATH (preferred), MODULE_PATH (if defined), or ~/.EasyOCR/.
 
             download_enabled (bool): Enabled downloading of model data via HTTP (default).
+
+            quantize (bool): On CPU, run the recognizer with dynamic int8 quantization and the
+            detector with the static int8 model calibrated by `python -m easyocr.quantization`,
+            when one is cached next to its weights (default).
+
+            verify_in_background (bool): Check the MD5 of existing model files in a background
+            thread while the models are built. Hashes are cached in md5_manifest.json next to
+            the models, so unchanged files are not hashed again.
+
+            backend (string): 'torch' (default) or 'onnxruntime'. With 'onnxruntime' (CPU only),
+            the detector and recognizer are exported to .onnx next to their .pth files on first
+            use and run with ONNX Runtime; a model that cannot be exported runs with torch.
+
+            backend_threads (int): Intra-op threads of the ONNX Runtime sessions
+            (default: torch's thread count).
+
+            compile_recognizer (bool): With the torch backend, run the recognizer as TorchScript
+            traced per batch width bucket (a multiple of the model height). Traces are cached
+            under model_storage_directory/compiled on first use; call warmup() to load them
+            ahead of the first readtext.
         """
+        if backend not in ['torch', 'onnxruntime']:
+            raise ValueError("Invalid backend %s, must be 'torch' or 'onnxruntime'" % backend)
         self.download_enabled = download_enabled
 
         self.model_storage_directory = MODULE_PATH + '/model'
@@ -76,6 +107,17 @@ class Reader(object):
         else:
             self.device = gpu
         self.recognition_models = recognition_models
+        if backend == 'onnxruntime' and self.device != 'cpu':
+            LOGGER.warning('The onnxruntime backend runs on CPU only - using torch on %s.' % self.device)
+            backend = 'torch'
+        self.backend = backend
+        self.backend_threads = backend_threads
+        self.compile_recognizer = compile_recognizer
+        # seconds spent in each stage of the last readtext call
+        self.timings = {}
+        # (kind, path, model info, future md5) of model files checked in the background
+        pending_checks = []
+        verify_executor = ThreadPoolExecutor(max_workers=1) if verify_in_background else None
 
         # check and download detection model
         detector_model = 'craft'
@@ -88,17 +130,13 @@ class Reader(object):
                 LOGGER.warning('Downloading detection model, please wait. '
                                'This may take several minutes depending upon your network connection.')
                 download_and_unzip(detection_models[detector_model]['url'], detection_models[detector_model]['filename'], self.model_storage_directory, verbose)
-                assert calculate_md5(detector_path) == detection_models[detector_model]['md5sum'], corrupt_msg
+                assert verified_md5(detector_path) == detection_models[detector_model]['md5sum'], corrupt_msg
                 LOGGER.info('Download complete')
-            elif calculate_md5(detector_path) != detection_models[detector_model]['md5sum']:
-                if not self.download_enabled:
-                    raise FileNotFoundError("MD5 mismatch for %s and downloads disabled" % detector_path)
-                LOGGER.warning(corrupt_msg)
-                os.remove(detector_path)
-                LOGGER.warning('Re-downloading the detection model, please wait. '
-                               'This may take several minutes depending upon your network connection.')
-                download_and_unzip(detection_models[detector_model]['url'], detection_models[detector_model]['filename'], self.model_storage_directory, verbose)
-                assert calculate_md5(detector_path) == detection_models[detector_model]['md5sum'], corrupt_msg
+            elif verify_executor is not None:
+                pending_checks.append(('detection', detector_path, detection_models[detector_model],\
+                                       verify_executor.submit(verified_md5, detector_path)))
+            elif verified_md5(detector_path) != detection_models[detector_model]['md5sum']:
+                self.redownloadModel('detection', detector_path, detection_models[detector_model], verbose)
 
         # recognition model
         separator_list = {}
@@ -185,18 +223,13 @@ class Reader(object):
                     LOGGER.warning('Downloading recognition model, please wait. '
                                    'This may take several minutes depending upon your network connection.')
                     download_and_unzip(model['url'], model['filename'], self.model_storage_directory, verbose)
-                    assert calculate_md5(model_path) == model['md5sum'], corrupt_msg
+                    assert verified_md5(model_path) == model['md5sum'], corrupt_msg
                     LOGGER.info('Download complete.')
-                elif calculate_md5(model_path) != model['md5sum']:
-                    if not self.download_enabled:
-                        raise FileNotFoundError("MD5 mismatch for %s and downloads disabled" % model_path)
-                    LOGGER.warning(corrupt_msg)
-                    os.remove(model_path)
-                    LOGGER.warning('Re-downloading the recognition model, please wait. '
-                                   'This may take several minutes depending upon your network connection.')
-                    download_and_unzip(model['url'], model['filename'], self.model_storage_directory, verbose)
-                    assert calculate_md5(model_path) == model['md5sum'], corrupt_msg
-                    LOGGER.info('Download complete')
+                elif verify_executor is not None:
+                    pending_checks.append(('recognition', model_path, model,\
+                                           verify_executor.submit(verified_md5, model_path)))
+                elif verified_md5(model_path) != model['md5sum']:
+                    self.redownloadModel('recognition', model_path, model, verbose)
             self.setLanguageList(lang_list, model)
 
         else: # user-defined model
@@ -220,7 +253,9 @@ class Reader(object):
             dict_list[lang] = os.path.join(BASE_PATH, 'dict', lang + ".txt")
 
         if detector:
-            self.detector = get_detector(detector_path, self.device, quantize, cudnn_benchmark=cudnn_benchmark)
+            self.detector = self.loadDetector(detector_path, quantize, cudnn_benchmark)
+            # detector input buffers, reused across calls
+            self.canvas_pool = CanvasPool()
         if recognizer:
             if recog_network == 'generation1':
                 network_params = {
@@ -236,9 +271,70 @@ class Reader(object):
                     }
             else:
                 network_params = recog_config['network_params']
-            self.recognizer, self.converter = get_recognizer(recog_network, network_params,\
-                                                         self.character, separator_list,\
-                                                         dict_list, model_path, device = self.device, quantize=quantize)
+            self.recognizer, self.converter = self.loadRecognizer(recog_network, network_params, separator_list,\
+                                                                  dict_list, model_path, quantize)
+            # LRU of (ignore_char, ignore_mask), keyed by (allowlist, blocklist)
+            self.ignore_cache = OrderedDict()
+            self.ignore_cache_size = 16
+            # preprocessing threads for recognition batches, one pool per worker count, created on first use
+            self.preprocess_pools = {}
+            self.preprocess_lock = threading.Lock()
+
+        # models were built while their files were hashed; rebuild any that did not match
+        for kind, path, model, check in pending_checks:
+            if check.result() != model['md5sum']:
+                self.redownloadModel(kind, path, model, verbose)
+                if kind == 'detection':
+                    self.detector = self.loadDetector(path, quantize, cudnn_benchmark)
+                else:
+                    self.recognizer, self.converter = self.loadRecognizer(recog_network, network_params, separator_list,\
+                                                                          dict_list, path, quantize)
+        if verify_executor is not None:
+            verify_executor.shutdown()
+
+    def loadDetector(self, detector_path, quantize = True, cudnn_benchmark = False):
+        if self.backend == 'onnxruntime':
+            detector = load_or_export(detector_path,
+                                      lambda: get_detector(detector_path, 'cpu', quantize=False),
+                                      export_detector, OrtDetector, self.backend_threads)
+            if detector is not None:
+                return detector
+        return get_detector(detector_path, self.device, quantize, cudnn_benchmark=cudnn_benchmark)
+
+    def loadRecognizer(self, recog_network, network_params, separator_list, dict_list, model_path, quantize = True):
+        self.recognizer_takes_text = False
+        if self.backend == 'onnxruntime':
+            recognizer = load_or_export(model_path,
+                                        lambda: get_recognizer(recog_network, network_params, self.character,\
+                                                               separator_list, dict_list, model_path,\
+                                                               device = 'cpu', quantize = False)[0],
+                                        lambda model, path: export_recognizer(model, path, imgH),
+                                        OrtRecognizer, self.backend_threads)
+            if recognizer is not None:
+                return recognizer, CTCLabelConverter(self.character, separator_list, dict_list)
+        recognizer, converter = get_recognizer(recog_network, network_params, self.character, separator_list,\
+                                               dict_list, model_path, device = self.device, quantize = quantize)
+        # worked out once here, recognizer_predict would otherwise inspect the model on every batch
+        self.recognizer_takes_text = forward_takes_text(recognizer)
+        if self.compile_recognizer:
+            if self.recognizer_takes_text:
+                LOGGER.warning('%s requires the text input and cannot be traced, using torch' % recog_network)
+            else:
+                recognizer = TracedRecognizer(recognizer, model_path, os.path.join(self.model_storage_directory, 'compiled'),\
+                                              imgH, self.device)
+        return recognizer, converter
+
+    def redownloadModel(self, kind, path, model, verbose = True):
+        corrupt_msg = 'MD5 hash mismatch, possible file corruption'
+        if not self.download_enabled:
+            raise FileNotFoundError("MD5 mismatch for %s and downloads disabled" % path)
+        LOGGER.warning(corrupt_msg)
+        os.remove(path)
+        LOGGER.warning('Re-downloading the %s model, please wait. '
+                       'This may take several minutes depending upon your network connection.' % kind)
+        download_and_unzip(model['url'], model['filename'], self.model_storage_directory, verbose)
+        assert verified_md5(path) == model['md5sum'], corrupt_msg
+        LOGGER.info('Download complete')
 
     def setModelLanguage(self, language, lang_list, list_lang, list_lang_string):
         self.model_lang = language
@@ -271,14 +367,28 @@ class Reader(object):
     def detect(self, img, min_size = 20, text_threshold = 0.7, low_text = 0.4,\
                link_threshold = 0.4,canvas_size = 2560, mag_ratio = 1.,\
                slope_ths = 0.1, ycenter_ths = 0.5, height_ths = 0.5,\
-               width_ths = 0.5, add_margin = 0.1, reformat=True, optimal_num_chars=None):
+               width_ths = 0.5, add_margin = 0.1, reformat=True, optimal_num_chars=None,\
+               cc_engine = 'roi', bucket_size = 256, tile_size = None, tile_overlap = 128,\
+               tile_batch_size = 4, tile_workers = 0, postprocess_workers = 0, component_workers = 0):
+        '''
+        With tile_size, large pages are not downscaled to canvas_size: CRAFT runs at native
+        resolution on tiles of tile_size overlapping by tile_overlap, tile_batch_size tiles per
+        forward pass (this bounds peak memory), in tile_workers threads, and boxes are merged
+        across tile seams.
+        With postprocess_workers, heatmaps are turned into boxes in that many threads while the
+        next batch goes through the detector; component_workers also splits the text regions
+        of one heatmap across threads. Results keep the input order.
+        '''
 
         if reformat:
             img, img_cv_grey = reformat_input(img)
 
         text_box_list = get_textbox(self.detector, img, canvas_size, mag_ratio,
                                     text_threshold, link_threshold, low_text,
-                                    False, self.device, optimal_num_chars)
+                                    False, self.device, optimal_num_chars, cc_engine,
+                                    bucket_size, self.canvas_pool, tile_size, tile_overlap,
+                                    tile_batch_size, tile_workers, postprocess_workers,
+                                    component_workers)
 
         horizontal_list_agg, free_list_agg = [], []
         for text_box in text_box_list:
@@ -301,17 +411,19 @@ class Reader(object):
                   workers = 0, allowlist = None, blocklist = None, detail = 1,\
                   rotation_info = None,paragraph = False,\
                   contrast_ths = 0.1,adjust_contrast = 0.5, filter_ths = 0.003,\
-                  y_ths = 0.5, x_ths = 1.0, reformat=True, output_format='standard'):
+                  y_ths = 0.5, x_ths = 1.0, reformat=True, output_format='standard',\
+                  max_retry_ratio = 1.0, max_retry_time = None, rotation_ths = None):
+        '''
+        With rotation_info, crops are first recognized as they are; those below
+        rotation_ths confidence (all of them with None) are then recognized once
+        more for each angle and the most confident reading is kept.
+        '''
 
         if reformat:
             img, img_cv_grey = reformat_input(img_cv_grey)
 
-        if allowlist:
-            ignore_char = ''.join(set(self.character)-set(allowlist))
-        elif blocklist:
-            ignore_char = ''.join(set(blocklist))
-        else:
-            ignore_char = ''.join(set(self.character)-set(self.lang_char))
+        ignore_char, ignore_mask = self.getIgnore(allowlist, blocklist)
+        pool = self.getPreprocessPool(workers)
 
         if self.model_lang in ['chinese_tra','chinese_sim']: decoder = 'greedy'
 
@@ -329,7 +441,9 @@ class Reader(object):
                 image_list, max_width = get_image_list(h_list, f_list, img_cv_grey, model_height = imgH)
                 result0 = get_text(self.character, imgH, int(max_width), self.recognizer, self.converter, image_list,\
                               ignore_char, decoder, beamWidth, batch_size, contrast_ths, adjust_contrast, filter_ths,\
-                              workers, self.device)
+                              workers, self.device, dynamic_width = True, ignore_mask = ignore_mask, pool = pool,\
+                          max_retry_ratio = max_retry_ratio, max_retry_time = max_retry_time,\
+                          takes_text = self.recognizer_takes_text)
                 result += result0
             for bbox in free_list:
                 h_list = []
@@ -337,26 +451,130 @@ class Reader(object):
                 image_list, max_width = get_image_list(h_list, f_list, img_cv_grey, model_height = imgH)
                 result0 = get_text(self.character, imgH, int(max_width), self.recognizer, self.converter, image_list,\
                               ignore_char, decoder, beamWidth, batch_size, contrast_ths, adjust_contrast, filter_ths,\
-                              workers, self.device)
+                              workers, self.device, dynamic_width = True, ignore_mask = ignore_mask, pool = pool,\
+                          max_retry_ratio = max_retry_ratio, max_retry_time = max_retry_time,\
+                          takes_text = self.recognizer_takes_text)
                 result += result0
         # default mode will try to process multiple boxes at the same time
         else:
-            image_list, max_width = get_image_list(horizontal_list, free_list, img_cv_grey, model_height = imgH)
-            image_len = len(image_list)
+            image_list, max_width = get_image_list(horizontal_list, free_list, img_cv_grey, model_height = imgH, pool = pool)
             if rotation_info and image_list:
-                image_list = make_rotated_img_list(rotation_info, image_list)
                 max_width = max(max_width, imgH)
 
-            result = get_text(self.character, imgH, int(max_width), self.recognizer, self.converter, image_list,\
-                          ignore_char, decoder, beamWidth, batch_size, contrast_ths, adjust_contrast, filter_ths,\
-                          workers, self.device)
+            def recognize_lists(image_lists):
+                return [get_text(self.character, imgH, int(max_width), self.recognizer, self.converter, image_list,\
+                                 ignore_char, decoder, beamWidth, batch_size, contrast_ths, adjust_contrast, filter_ths,\
+                                 workers, self.device, dynamic_width = True, ignore_mask = ignore_mask, pool = pool,\
+                                 max_retry_ratio = max_retry_ratio, max_retry_time = max_retry_time,\
+                                 takes_text = self.recognizer_takes_text)
+                        for image_list in image_lists]
+
+            result = recognize_lists([image_list])[0]
+            if rotation_info and image_list:
+                result = rotation_tta([image_list], [result], rotation_info, recognize_lists, rotation_ths)[0]
 
-            if rotation_info and (horizontal_list+free_list):
-                # Reshape result to be a list of lists, each row being for 
-                # one of the rotations (first row being no rotation)
-                result = set_result_with_confidence(
-                    [result[image_len*i:image_len*(i+1)] for i in range(len(rotation_info) + 1)])
+        return self.formatResult(result, detail, paragraph, y_ths, x_ths, output_format)
 
+    def recognize_batched(self, img_cv_grey_list, horizontal_list_agg=None, free_list_agg=None,\
+                          decoder = 'greedy', beamWidth= 5, batch_size = 1,\
+                          workers = 0, allowlist = None, blocklist = None, detail = 1,\
+                          rotation_info = None, paragraph = False,\
+                          contrast_ths = 0.1, adjust_contrast = 0.5, filter_ths = 0.003,\
+                          y_ths = 0.5, x_ths = 1.0, output_format='standard',\
+                          max_retry_ratio = 1.0, max_retry_time = None, rotation_ths = None):
+        '''
+        Recognize text in several images with a single recognition schedule.
+        The crops of all images are sorted by width and run together in batches
+        of batch_size, each batch padded only to its own widest crop.
+        Rotated crops (see recognize) share one more schedule.
+        Returns one result list per image.
+        '''
+        ignore_char, ignore_mask = self.getIgnore(allowlist, blocklist)
+        pool = self.getPreprocessPool(workers)
+
+        if self.model_lang in ['chinese_tra','chinese_sim']: decoder = 'greedy'
+
+        if horizontal_list_agg is None:
+            horizontal_list_agg = [None] * len(img_cv_grey_list)
+        if free_list_agg is None:
+            free_list_agg = [None] * len(img_cv_grey_list)
+
+        image_lists = []
+        for img_cv_grey, horizontal_list, free_list in zip(img_cv_grey_list, horizontal_list_agg, free_list_agg):
+            if (horizontal_list==None) and (free_list==None):
+                y_max, x_max = img_cv_grey.shape
+                horizontal_list = [[0, x_max, 0, y_max]]
+                free_list = []
+            image_list, _ = get_image_list(horizontal_list, free_list, img_cv_grey, model_height = imgH, pool = pool)
+            image_lists.append(image_list)
+
+        def recognize_lists(image_lists):
+            return get_text_scheduled(self.character, imgH, self.recognizer, self.converter, image_lists,\
+                                      ignore_char, decoder, beamWidth, batch_size, contrast_ths, adjust_contrast,\
+                                      filter_ths, workers, self.device, ignore_mask = ignore_mask, pool = pool,\
+                                      max_retry_ratio = max_retry_ratio, max_retry_time = max_retry_time,\
+                                      takes_text = self.recognizer_takes_text)
+
+        result_agg = recognize_lists(image_lists)
+        if rotation_info:
+            result_agg = rotation_tta(image_lists, result_agg, rotation_info, recognize_lists, rotation_ths)
+
+        output = []
+        for result in result_agg:
+            output.append(self.formatResult(result, detail, paragraph, y_ths, x_ths, output_format))
+        return output
+
+    def getIgnoreChar(self, allowlist = None, blocklist = None):
+        if allowlist:
+            ignore_char = ''.join(set(self.character)-set(allowlist))
+        elif blocklist:
+            ignore_char = ''.join(set(blocklist))
+        else:
+            ignore_char = ''.join(set(self.character)-set(self.lang_char))
+        return ignore_char
+
+    def getIgnore(self, allowlist = None, blocklist = None):
+        '''
+        Return (ignore_char, ignore_mask) for this allowlist/blocklist.
+        Both are kept in a small LRU so repeated calls skip the set arithmetic
+        over the character list and the mask construction.
+        '''
+        key = (''.join(allowlist) if allowlist else None, ''.join(blocklist) if blocklist else None)
+        if key in self.ignore_cache:
+            self.ignore_cache.move_to_end(key)
+        else:
+            ignore_char = self.getIgnoreChar(allowlist, blocklist)
+            self.ignore_cache[key] = (ignore_char, get_ignore_mask(self.converter, ignore_char, self.device))
+            if len(self.ignore_cache) > self.ignore_cache_size:
+                self.ignore_cache.popitem(last = False)
+        return self.ignore_cache[key]
+
+    def getPreprocessPool(self, workers = 0):
+        '''
+        Return the Reader's recognition preprocessing pool with this number of
+        workers, reused across calls. Pools are kept per worker count and never
+        shut down, so a concurrent call may still be running on any of them.
+        '''
+        workers = int(workers)
+        with self.preprocess_lock:
+            if workers not in self.preprocess_pools:
+                self.preprocess_pools[workers] = PreprocessPool(workers)
+            return self.preprocess_pools[workers]
+
+    def warmup(self, widths = None, batch_size = 1):
+        '''
+        Run the recognizer once on blank batches of each width, so that the first
+        readtext does not pay for tracing (or loading the cached traces, with
+        compile_recognizer) and for the first-call setup of the backend.
+        widths default to the width buckets up to 16 times the model height.
+        '''
+        if widths is None:
+            widths = range(imgH, 16*imgH + 1, imgH)
+        with torch.no_grad():
+            for width in widths:
+                self.recognizer(torch.zeros(batch_size, 1, imgH, int(width), device = self.device))
+
+    def formatResult(self, result, detail = 1, paragraph = False, y_ths = 0.5, x_ths = 1.0, output_format='standard'):
         if self.model_lang == 'arabic':
             direction_mode = 'rtl'
             result = [list(item) for item in result]
@@ -382,26 +600,45 @@ class Reader(object):
                  text_threshold = 0.7, low_text = 0.4, link_threshold = 0.4,\
                  canvas_size = 2560, mag_ratio = 1.,\
                  slope_ths = 0.1, ycenter_ths = 0.5, height_ths = 0.5,\
-                 width_ths = 0.5, y_ths = 0.5, x_ths = 1.0, add_margin = 0.1, output_format='standard'):
+                 width_ths = 0.5, y_ths = 0.5, x_ths = 1.0, add_margin = 0.1, output_format='standard',\
+                 max_retry_ratio = 1.0, max_retry_time = None, rotation_ths = None,\
+                 tile_size = None, tile_overlap = 128, tile_batch_size = 4, tile_workers = 0,\
+                 postprocess_workers = 0, component_workers = 0):
         '''
         Parameters:
         image: file path or numpy-array or a byte stream object
+        max_retry_ratio: at most this fraction of the text boxes is retried with adjusted contrast
+        max_retry_time: seconds after which no more low contrast text boxes are retried
+        rotation_ths: with rotation_info, only text boxes below this confidence are rotated
+        tile_size: detect at native resolution on overlapping tiles of this size (see detect)
+        postprocess_workers, component_workers: threads for detector post-processing (see detect)
+        Seconds spent decoding, detecting and recognizing are kept in self.timings.
         '''
-        img, img_cv_grey = reformat_input(image)
+        self.timings = timings = {}
+        img, img_cv_grey = reformat_input(image, timings)
 
+        start = time.time()
         horizontal_list, free_list = self.detect(img, min_size, text_threshold,\
                                                  low_text, link_threshold,\
                                                  canvas_size, mag_ratio,\
                                                  slope_ths, ycenter_ths,\
                                                  height_ths,width_ths,\
-                                                 add_margin, False)
+                                                 add_margin, False,\
+                                                 tile_size=tile_size, tile_overlap=tile_overlap,\
+                                                 tile_batch_size=tile_batch_size, tile_workers=tile_workers,\
+                                                 postprocess_workers=postprocess_workers,\
+                                                 component_workers=component_workers)
+        timings['detect'] = time.time() - start
         # get the 1st result from hor & free list as self.detect returns a list of depth 3
         horizontal_list, free_list = horizontal_list[0], free_list[0]
+        start = time.time()
         result = self.recognize(img_cv_grey, horizontal_list, free_list,\
                                 decoder, beamWidth, batch_size,\
                                 workers, allowlist, blocklist, detail, rotation_info,\
                                 paragraph, contrast_ths, adjust_contrast,\
-                                filter_ths, y_ths, x_ths, False, output_format)
+                                filter_ths, y_ths, x_ths, False, output_format,\
+                                max_retry_ratio, max_retry_time, rotation_ths)
+        timings['recognize'] = time.time() - start
 
         return result
     
@@ -469,31 +706,54 @@ class Reader(object):
                          text_threshold = 0.7, low_text = 0.4, link_threshold = 0.4,\
                          canvas_size = 2560, mag_ratio = 1.,\
                          slope_ths = 0.1, ycenter_ths = 0.5, height_ths = 0.5,\
-                         width_ths = 0.5, y_ths = 0.5, x_ths = 1.0, add_margin = 0.1, output_format='standard'):
+                         width_ths = 0.5, y_ths = 0.5, x_ths = 1.0, add_margin = 0.1, output_format='standard',\
+                         bucket_size = 256, max_retry_ratio = 1.0, max_retry_time = None, rotation_ths = None,\
+                         tile_size = None, tile_overlap = 128, tile_batch_size = 4, tile_workers = 0,\
+                         postprocess_workers = 0, component_workers = 0):
         '''
         Parameters:
         image: file path or numpy-array or a byte stream object
-        When sending a list of images, they all must of the same size,
+        When sending a list of images, they may be of different sizes. Images are
+        grouped by canvas size (rounded up to bucket_size) and padded within each
+        group, so the detector runs one forward pass per group.
         the following parameters will automatically resize if they are not None
         n_width: int, new width
         n_height: int, new height
+        bucket_size: int, granularity in pixels used to group images of different sizes
+        max_retry_ratio: at most this fraction of the text boxes is retried with adjusted contrast
+        max_retry_time: seconds after which no more low contrast text boxes are retried
+        rotation_ths: with rotation_info, only text boxes below this confidence are rotated
+        tile_size: detect at native resolution on overlapping tiles of this size (see detect)
+        postprocess_workers, component_workers: threads for detector post-processing (see detect)
+        Seconds spent decoding, detecting and recognizing are kept in self.timings.
         '''
-        img, img_cv_grey = reformat_input_batched(image, n_width, n_height)
+        self.timings = timings = {}
+        img, img_cv_grey = reformat_input_batched(image, n_width, n_height, timings)
 
+        start = time.time()
         horizontal_list_agg, free_list_agg = self.detect(img, min_size, text_threshold,\
                                                          low_text, link_threshold,\
                                                          canvas_size, mag_ratio,\
                                                          slope_ths, ycenter_ths,\
                                                          height_ths, width_ths,\
-                                                         add_margin, False)
-        result_agg = []
+                                                         add_margin, False,\
+                                                         bucket_size=bucket_size, tile_size=tile_size,\
+                                                         tile_overlap=tile_overlap, tile_batch_size=tile_batch_size,\
+                                                         tile_workers=tile_workers,\
+                                                         postprocess_workers=postprocess_workers,\
+                                                         component_workers=component_workers)
+        timings['detect'] = time.time() - start
         # put img_cv_grey in a list if its a single img
-        img_cv_grey = [img_cv_grey] if len(img_cv_grey.shape) == 2 else img_cv_grey
-        for grey_img, horizontal_list, free_list in zip(img_cv_grey, horizontal_list_agg, free_list_agg):
-            result_agg.append(self.recognize(grey_img, horizontal_list, free_list,\
+        if isinstance(img_cv_grey, np.ndarray) and len(img_cv_grey.shape) == 2:
+            img_cv_grey = [img_cv_grey]
+        # recognize the crops of all images together
+        start = time.time()
+        result_agg = self.recognize_batched(img_cv_grey, horizontal_list_agg, free_list_agg,\
                                             decoder, beamWidth, batch_size,\
                                             workers, allowlist, blocklist, detail, rotation_info,\
                                             paragraph, contrast_ths, adjust_contrast,\
-                                            filter_ths, y_ths, x_ths, False, output_format))
+                                            filter_ths, y_ths, x_ths, output_format,\
+                                            max_retry_ratio, max_retry_time, rotation_ths)
+        timings['recognize'] = time.time() - start
 
         return result_agg
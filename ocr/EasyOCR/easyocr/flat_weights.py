@@ -0,0 +1,140 @@
+"""
+Memory-mapped model weights for the detector and recognizers.
+
+The state dict of a .pth file is converted once to a flat file next to it: a
+JSON index (dtype, shape and offset of each tensor) followed by the tensor
+data, each tensor aligned to 64 bytes. load_flat maps that file and binds the
+tensors to the parameters of a model built on the meta device, so nothing is
+read, initialized or copied up front and processes loading the same file
+share its pages. Layers that are quantized after loading do not keep this
+benefit: dynamic int8 quantization of the recognizer on CPU (get_recognizer's
+default) copies its LSTM and Linear weights, most of the generation2 model,
+and only the convolution weights stay mapped. get_detector and
+get_recognizer pick the file up:
+
+    python -m easyocr.flat_weights ~/.EasyOCR/model/craft_mlt_25k.pth ~/.EasyOCR/model/english_g2.pth
+"""
+import argparse
+import json
+import os
+import struct
+import tempfile
+from collections import OrderedDict
+from logging import getLogger
+
+import numpy as np
+import torch
+
+LOGGER = getLogger(__name__)
+
+MAGIC = b'EOCRFLAT'
+ALIGNMENT = 64
+DTYPES = {torch.float32: 'float32', torch.float16: 'float16', torch.float64: 'float64',
+          torch.int64: 'int64', torch.int32: 'int32', torch.int8: 'int8', torch.uint8: 'uint8',
+          torch.bool: 'bool'}
+
+
+def flat_path(model_path):
+    return os.path.splitext(model_path)[0] + '.flat'
+
+
+def _align(n):
+    return -(-n // ALIGNMENT) * ALIGNMENT
+
+
+def strip_module_prefix(state_dict):
+    """ state dict without the 'module.' prefix of models saved from DataParallel """
+    return OrderedDict((name[len('module.'):] if name.startswith('module.') else name, tensor)
+                       for name, tensor in state_dict.items())
+
+
+def save_flat(state_dict, path):
+    index, offset = OrderedDict(), 0
+    for name, tensor in state_dict.items():
+        if tensor.dtype not in DTYPES:
+            raise ValueError("cannot store %s, %s tensors are not supported" % (name, tensor.dtype))
+        nbytes = tensor.numel() * tensor.element_size()
+        index[name] = {'dtype': DTYPES[tensor.dtype], 'shape': list(tensor.shape), 'offset': offset, 'nbytes': nbytes}
+        offset = _align(offset + nbytes)
+    header = json.dumps({'version': 1, 'tensors': index}).encode('utf-8')
+    data_start = _align(len(MAGIC) + 8 + len(header))
+
+    # write to a temporary file first so that a partial file is never loaded
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix='.flat')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(MAGIC + struct.pack('<Q', len(header)) + header)
+            for name, tensor in state_dict.items():
+                f.seek(data_start + index[name]['offset'])
+                f.write(tensor.detach().cpu().contiguous().numpy().tobytes())
+            f.truncate(data_start + offset)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def read_flat(path):
+    """
+    state dict of tensors viewing a copy-on-write map of the flat file at
+    path: pages are read on first use and stay shared until written.
+    """
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError("%s is not a flat weight file" % path)
+        header_size, = struct.unpack('<Q', f.read(8))
+        header = json.loads(f.read(header_size).decode('utf-8'))
+    data_start = _align(len(MAGIC) + 8 + header_size)
+    data = np.memmap(path, dtype=np.uint8, mode='c')
+    state_dict = OrderedDict()
+    for name, entry in header['tensors'].items():
+        start = data_start + entry['offset']
+        array = data[start:start + entry['nbytes']].view(entry['dtype']).reshape(entry['shape'])
+        state_dict[name] = torch.from_numpy(array)
+    return state_dict
+
+
+def convert(model_path):
+    """ write the flat file of the .pth at model_path, returns its path """
+    path = flat_path(model_path)
+    save_flat(strip_module_prefix(torch.load(model_path, map_location='cpu')), path)
+    return path
+
+
+def load_flat(model_path, build):
+    """
+    Model returned by build(), run on the meta device, with the weights of
+    the flat file converted from model_path bound to it. Returns None when
+    there is none, when it is older than model_path or cannot be loaded.
+    """
+    path = flat_path(model_path)
+    if not os.path.isfile(path) or os.path.getmtime(path) < os.path.getmtime(model_path):
+        LOGGER.info('No flat weights for %s, loading it with torch' % model_path)
+        return None
+    try:
+        state_dict = read_flat(path)
+        with torch.device('meta'):
+            model = build()
+        # assign binds the mapped tensors instead of copying them into the parameters
+        model.load_state_dict(state_dict, assign=True)
+        if any(tensor.is_meta for tensor in list(model.parameters()) + list(model.buffers())):
+            raise ValueError("tensors missing from the state dict")
+    except Exception as e:
+        LOGGER.warning('Cannot load the flat weights %s (%s), loading %s with torch' % (path, e, model_path))
+        return None
+    return model
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Convert EasyOCR .pth models to memory-mapped flat weights.")
+    parser.add_argument('models', type=str, nargs='+', help="detector or recognizer weights (.pth)")
+    return parser.parse_args()
+
+
+def main():
+    for model_path in parse_args().models:
+        print(f"{model_path} -> {convert(model_path)}")
+
+
+if __name__ == "__main__":
+    main()
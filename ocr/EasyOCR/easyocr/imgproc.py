@@ -7,6 +7,8 @@ MIT License
 import numpy as np
 from skimage import io
 import cv2
+from collections import OrderedDict
+import threading
 
 def loadImage(img_file):
     img = io.imread(img_file)           # RGB order
@@ -34,9 +36,8 @@ def denormalizeMeanVariance(in_img, mean=(0.485, 0.456, 0.406), variance=(0.229,
     img = np.clip(img, 0, 255).astype(np.uint8)
     return img
 
-def resize_aspect_ratio(img, square_size, interpolation, mag_ratio=1):
-    height, width, channel = img.shape
-
+def target_size(height, width, square_size, mag_ratio=1):
+    """ resized size (h, w), its canvas padded to multiples of 32 (h32, w32) and the resize ratio """
     # magnify image size
     target_size = mag_ratio * max(height, width)
 
@@ -47,15 +48,19 @@ def resize_aspect_ratio(img, square_size, interpolation, mag_ratio=1):
     ratio = target_size / max(height, width)    
 
     target_h, target_w = int(height * ratio), int(width * ratio)
-    proc = cv2.resize(img, (target_w, target_h), interpolation = interpolation)
-
-
-    # make canvas and paste image
     target_h32, target_w32 = target_h, target_w
     if target_h % 32 != 0:
         target_h32 = target_h + (32 - target_h % 32)
     if target_w % 32 != 0:
         target_w32 = target_w + (32 - target_w % 32)
+    return target_h, target_w, target_h32, target_w32, ratio
+
+def resize_aspect_ratio(img, square_size, interpolation, mag_ratio=1):
+    height, width, channel = img.shape
+    target_h, target_w, target_h32, target_w32, ratio = target_size(height, width, square_size, mag_ratio)
+    proc = cv2.resize(img, (target_w, target_h), interpolation = interpolation)
+
+    # make canvas and paste image
     resized = np.zeros((target_h32, target_w32, channel), dtype=np.float32)
     resized[0:target_h, 0:target_w, :] = proc
     target_h, target_w = target_h32, target_w32
@@ -64,6 +69,55 @@ def resize_aspect_ratio(img, square_size, interpolation, mag_ratio=1):
 
     return resized, ratio, size_heatmap
 
+class CanvasPool(object):
+    """
+    Reusable buffers keyed by shape and dtype: the NCHW detector input batches
+    and the images they are resized through. The `max_buffers` most recently
+    used buffers are kept, so pages of a steady size need no new allocation.
+    Each thread has its own buffers, so a pool shared by concurrent calls
+    never hands the same buffer to two of them.
+    """
+
+    def __init__(self, max_buffers=8):
+        self.max_buffers = max_buffers
+        self.local = threading.local()
+
+    def get(self, shape, dtype=np.float32):
+        buffers = getattr(self.local, 'buffers', None)
+        if buffers is None:
+            buffers = self.local.buffers = OrderedDict()
+        key = (tuple(shape), np.dtype(dtype).str)
+        buf = buffers.pop(key, None)
+        if buf is None:
+            buf = np.empty(shape, dtype=dtype)
+        buffers[key] = buf
+        if len(buffers) > self.max_buffers:
+            buffers.popitem(last=False)
+        return buf
+
+def resize_normalize_into(img, out, target_h, target_w, interpolation, pool=None,\
+                          mean=(0.485, 0.456, 0.406), variance=(0.229, 0.224, 0.225)):
+    """
+    Resize an RGB image to (target_h, target_w) and write it normalized, channel
+    first, into out [3, H, W]. The rest of out is filled with normalized zeros,
+    like the padding of resize_aspect_ratio followed by normalizeMeanVariance.
+    """
+    if pool is None:
+        proc = cv2.resize(img, (target_w, target_h), interpolation = interpolation)
+    else:
+        proc = pool.get((target_h, target_w) + img.shape[2:], img.dtype)
+        cv2.resize(img, (target_w, target_h), dst = proc, interpolation = interpolation)
+    for c in range(3):
+        m = np.float32(mean[c] * 255.0)
+        v = np.float32(variance[c] * 255.0)
+        dst = out[c, :target_h, :target_w]
+        np.subtract(proc[:, :, c], m, out = dst, dtype = np.float32)
+        np.divide(dst, v, out = dst)
+        pad = (np.float32(0) - m) / v
+        out[c, target_h:, :] = pad
+        out[c, :target_h, target_w:] = pad
+    return out
+
 def cvt2HeatmapImg(img):
     img = (np.clip(img, 0, 1) * 255).astype(np.uint8)
     img = cv2.applyColorMap(img, cv2.COLORMAP_JET)
@@ -3,7 +3,10 @@ import torch.nn as nn
 import torch.nn.functional as F
 import torch.nn.init as init
 from torchvision import models
-from torchvision.models.vgg import model_urls
+try:
+    from torchvision.models.vgg import model_urls
+except ImportError: # torchvision >= 0.13 keeps the urls with the weights enums
+    model_urls = {'vgg16_bn': 'https://download.pytorch.org/models/vgg16_bn-6c64b313.pth'}
 from collections import namedtuple
 
 def init_weights(modules):
@@ -0,0 +1,148 @@
+"""
+ONNX Runtime inference for the CRAFT detector and the CRNN recognizers.
+
+Graphs are exported from the torch models on first use and stored next to
+their .pth files. OrtDetector and OrtRecognizer can be used in place of the
+torch modules by test_net and recognizer_predict.
+"""
+import os
+import tempfile
+from logging import getLogger
+
+import torch
+
+LOGGER = getLogger(__name__)
+
+
+class DetectorGraph(torch.nn.Module):
+    """ CRAFT returning only the score maps, the feature map is not used for inference """
+
+    def __init__(self, net):
+        super(DetectorGraph, self).__init__()
+        self.net = net
+
+    def forward(self, x):
+        y, feature = self.net(x)
+        return y
+
+
+class RecognizerGraph(torch.nn.Module):
+    """
+    CRNN forward with the (None, 1) adaptive pooling written as a mean over
+    the height, which exports with a dynamic width.
+    """
+
+    def __init__(self, model):
+        super(RecognizerGraph, self).__init__()
+        self.model = model
+
+    def forward(self, x):
+        visual_feature = self.model.FeatureExtraction(x)
+        visual_feature = visual_feature.permute(0, 3, 1, 2).mean(3)
+        contextual_feature = self.model.SequenceModeling(visual_feature)
+        return self.model.Prediction(contextual_feature)
+
+
+def _export(module, dummy_input, path, dynamic_axes, opset_version=12):
+    # write to a temporary file first so that a partial graph is never loaded
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix='.onnx')
+    os.close(fd)
+    kwargs = dict(export_params=True, do_constant_folding=True, opset_version=opset_version,
+                  input_names=['input'], output_names=['output'], dynamic_axes=dynamic_axes)
+    try:
+        with torch.no_grad():
+            try:
+                torch.onnx.export(module.eval(), dummy_input, tmp_path, dynamo=False, **kwargs)
+            except TypeError: # torch without the dynamo exporter
+                torch.onnx.export(module.eval(), dummy_input, tmp_path, **kwargs)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def export_detector(net, path, opset_version=12):
+    _export(DetectorGraph(net), torch.rand(1, 3, 608, 800), path,
+            {'input': {0: 'batch_size', 2: 'height', 3: 'width'},
+             'output': {0: 'batch_size', 1: 'dim1', 2: 'dim2'}}, opset_version)
+
+
+def export_recognizer(model, path, imgH=64, opset_version=12):
+    _export(RecognizerGraph(model), torch.rand(1, 1, imgH, imgH * 4), path,
+            {'input': {0: 'batch_size', 3: 'width'},
+             'output': {0: 'batch_size', 1: 'length'}}, opset_version)
+
+
+def session_options(threads=None):
+    """
+    CPU session options: one inter-op thread, `threads` intra-op threads
+    (default: torch's thread count) and all graph optimizations.
+    """
+    import onnxruntime
+    options = onnxruntime.SessionOptions()
+    options.intra_op_num_threads = threads or torch.get_num_threads()
+    options.inter_op_num_threads = 1
+    options.execution_mode = onnxruntime.ExecutionMode.ORT_SEQUENTIAL
+    options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+    return options
+
+
+class OrtModel(object):
+
+    def __init__(self, path, threads=None):
+        import onnxruntime
+        self.path = path
+        self.session = onnxruntime.InferenceSession(path, session_options(threads),
+                                                    providers=['CPUExecutionProvider'])
+
+    def eval(self):
+        return self
+
+    def run(self, x):
+        return torch.from_numpy(self.session.run(None, {'input': x.cpu().numpy()})[0])
+
+
+class OrtDetector(OrtModel):
+    """ callable like CRAFT: returns (score maps, None), or the NCHW score maps with feature=False """
+
+    def __call__(self, x, feature=True):
+        y = self.run(x)
+        if not feature:
+            return y.permute(0, 3, 1, 2)
+        return y, None
+
+
+class OrtRecognizer(OrtModel):
+    """ callable like the CRNN models; the text input is not used """
+
+    def __call__(self, input, text=None):
+        return self.run(input)
+
+
+def onnx_path(model_path):
+    return os.path.splitext(model_path)[0] + '.onnx'
+
+
+def load_or_export(model_path, build, export, wrapper, threads=None):
+    """
+    Return wrapper(graph) for the ONNX graph stored next to model_path. The
+    graph is exported from the torch model returned by build() when it is
+    missing or older than model_path. Returns None when onnxruntime is not
+    installed or the model cannot be exported, so the caller can fall back to
+    torch.
+    """
+    try:
+        import onnxruntime
+    except ImportError:
+        LOGGER.warning('onnxruntime is not installed, using torch for %s' % model_path)
+        return None
+
+    path = onnx_path(model_path)
+    try:
+        if not os.path.isfile(path) or os.path.getmtime(path) < os.path.getmtime(model_path):
+            LOGGER.info('Exporting %s to ONNX' % model_path)
+            export(build(), path)
+        return wrapper(path, threads)
+    except Exception as e:
+        LOGGER.warning('Cannot run %s with onnxruntime (%s), using torch' % (model_path, e))
+        return None
@@ -0,0 +1,275 @@
+"""
+Post-training static int8 quantization of the CRAFT detector for CPU.
+
+Convolutions are fused with their BatchNorm/ReLU and run in int8; the U-Net
+joins (bilinear upsampling and channel concatenation) stay in float between
+dequantize/quantize stubs. Activation ranges are calibrated on sample
+images, and the quantized model is cached next to the .pth file, where
+get_detector picks it up:
+
+    python -m easyocr.quantization --model ~/.EasyOCR/model/craft_mlt_25k.pth --images examples/
+
+prints an accuracy and throughput report against the fp32 detector.
+"""
+import argparse
+import contextlib
+import os
+import tempfile
+import time
+from logging import getLogger
+
+import cv2
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torch.ao.quantization import QuantStub, DeQuantStub, get_default_qconfig, prepare, convert, fuse_modules
+
+from .craft_utils import getDetBoxes
+from .detection import int8_path
+from .imgproc import loadImage, target_size, resize_normalize_into, CanvasPool
+
+LOGGER = getLogger(__name__)
+
+
+@contextlib.contextmanager
+def quantized_engine(engine):
+    """ run with torch.backends.quantized.engine set to engine, restoring the process-wide setting afterwards """
+    previous = torch.backends.quantized.engine
+    if engine == previous:
+        yield
+        return
+    torch.backends.quantized.engine = engine
+    try:
+        yield
+    finally:
+        torch.backends.quantized.engine = previous
+
+
+class QuantizableCRAFT(nn.Module):
+    """
+    CRAFT with quantize/dequantize stubs around the U-Net joins. Returns
+    (score maps, None) like OrtDetector, the feature map is not used for
+    inference; with feature=False, the NCHW score maps like CRAFT. Runs
+    with its quantized engine (default: torch's).
+    """
+
+    def __init__(self, net, engine=None):
+        super(QuantizableCRAFT, self).__init__()
+        self.engine = engine or torch.backends.quantized.engine
+        self.basenet = net.basenet
+        self.upconv1, self.upconv2 = net.upconv1, net.upconv2
+        self.upconv3, self.upconv4 = net.upconv3, net.upconv4
+        self.conv_cls = net.conv_cls
+        self.quant = QuantStub()
+        self.requant = nn.ModuleList([QuantStub() for _ in range(4)])
+        self.dequant = DeQuantStub()
+
+    def forward(self, x, feature=True):
+        with quantized_engine(self.engine):
+            return self._forward(x, feature)
+
+    def _forward(self, x, feature):
+        """ Base network """
+        sources = [self.dequant(source) for source in self.basenet(self.quant(x))]
+
+        """ U network """
+        y = torch.cat([sources[0], sources[1]], dim=1)
+        y = self.upconv1(self.requant[0](y))
+
+        for k, upconv in enumerate([self.upconv2, self.upconv3, self.upconv4], 1):
+            y = F.interpolate(self.dequant(y), size=sources[k + 1].size()[2:], mode='bilinear', align_corners=False)
+            y = torch.cat([y, sources[k + 1]], dim=1)
+            y = upconv(self.requant[k](y))
+
+        y = self.dequant(self.conv_cls(y))
+        if not feature:
+            return y
+        return y.permute(0,2,3,1), None
+
+
+def fuse_groups(model):
+    """ names of the Conv2d(+BatchNorm2d)(+ReLU) runs inside the Sequential blocks of model """
+    groups = []
+    for name, module in model.named_modules():
+        if not isinstance(module, nn.Sequential):
+            continue
+        children = list(module.named_children())
+        i = 0
+        while i < len(children):
+            if not isinstance(children[i][1], nn.Conv2d):
+                i += 1
+                continue
+            group, i = [children[i][0]], i + 1
+            for kind in (nn.BatchNorm2d, nn.ReLU):
+                if i < len(children) and isinstance(children[i][1], kind):
+                    group.append(children[i][0])
+                    i += 1
+            if len(group) > 1:
+                groups.append(['%s.%s' % (name, child) for child in group])
+    return groups
+
+
+def prepare_detector(net, engine=None):
+    """ fused CRAFT with observers, ready for calibration; net is consumed """
+    model = QuantizableCRAFT(net, engine).eval()
+    fuse_modules(model, fuse_groups(model), inplace=True)
+    model.qconfig = get_default_qconfig(model.engine)
+    return prepare(model, inplace=True)
+
+
+def convert_detector(model):
+    """ int8 CRAFT from the prepared model, weights packed for its engine """
+    with quantized_engine(model.engine):
+        return convert(model, inplace=True)
+
+
+def detector_input(image, canvas_size=2560, mag_ratio=1., canvas_pool=None):
+    """ normalized 1x3xHxW input of test_net for an RGB image """
+    target_h, target_w, target_h32, target_w32, _ = target_size(image.shape[0], image.shape[1], canvas_size, mag_ratio)
+    x = (canvas_pool or CanvasPool()).get((1, 3, target_h32, target_w32))
+    resize_normalize_into(image, x[0], target_h, target_w, cv2.INTER_LINEAR, canvas_pool)
+    return torch.from_numpy(x.copy())
+
+
+def quantize_detector(net, images, canvas_size=2560, mag_ratio=1., engine=None):
+    """ int8 CRAFT calibrated on images (RGB arrays); net is consumed """
+    model = prepare_detector(net, engine)
+    canvas_pool = CanvasPool()
+    with torch.no_grad():
+        for image in images:
+            model(detector_input(image, canvas_size, mag_ratio, canvas_pool))
+    return convert_detector(model)
+
+
+def save_quantized(model, path):
+    # write to a temporary file first so that a partial model is never loaded
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix='.pth')
+    os.close(fd)
+    try:
+        torch.save({'engine': model.engine, 'state_dict': model.state_dict()}, tmp_path)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def load_quantized(model_path, net):
+    """
+    int8 CRAFT from the calibrated model cached for model_path, built in
+    place around the (untrained) CRAFT net, which is consumed. Returns None
+    when there is none, when it is older than model_path or cannot be loaded.
+    """
+    path = int8_path(model_path)
+    if not os.path.isfile(path) or os.path.getmtime(path) < os.path.getmtime(model_path):
+        LOGGER.info('No calibrated int8 detector for %s, using fp32' % model_path)
+        return None
+    try:
+        payload = torch.load(path, map_location='cpu', weights_only=False)
+        if payload['engine'] not in torch.backends.quantized.supported_engines:
+            raise RuntimeError("quantized engine %s is not supported here" % payload['engine'])
+        model = convert_detector(prepare_detector(net, payload['engine']))
+        with quantized_engine(model.engine):
+            model.load_state_dict(payload['state_dict'])
+    except Exception as e:
+        LOGGER.warning('Cannot load the int8 detector %s (%s), using fp32' % (path, e))
+        return None
+    return model.eval()
+
+
+def _rects(score_maps, text_threshold=0.7, link_threshold=0.4, low_text=0.4):
+    boxes, _, _ = getDetBoxes(score_maps[:, :, 0], score_maps[:, :, 1], text_threshold, link_threshold, low_text)
+    return np.array([np.concatenate([box.min(0), box.max(0)]) for box in boxes]).reshape(-1, 4)
+
+
+def _matched(rects, others, iou=0.5):
+    """ number of rects overlapping one of others by at least iou """
+    if len(rects) == 0 or len(others) == 0:
+        return 0
+    lt = np.maximum(rects[:, None, :2], others[None, :, :2])
+    rb = np.minimum(rects[:, None, 2:], others[None, :, 2:])
+    inter = np.prod(np.clip(rb - lt, 0, None), axis=2)
+    area = lambda r: np.prod(r[:, 2:] - r[:, :2], axis=1)
+    union = area(rects)[:, None] + area(others)[None] - inter
+    return int(((inter / np.maximum(union, 1e-6)) >= iou).any(1).sum())
+
+
+def compare_detectors(fp32, int8, images, canvas_size=2560, mag_ratio=1., repeat=1):
+    """
+    Accuracy and throughput of int8 against fp32 on images: score map errors,
+    detected boxes found by both (IoU >= 0.5) and best-of-repeat times.
+    """
+    report = {'images': len(images), 'max_error': 0., 'mean_error': 0., 'boxes': 0, 'matched': 0,
+              'int8_boxes': 0, 'fp32_time': 0., 'int8_time': 0.}
+    canvas_pool = CanvasPool()
+    with torch.no_grad():
+        for image in images:
+            x = detector_input(image, canvas_size, mag_ratio, canvas_pool)
+            outputs = []
+            for name, model in (('fp32', fp32), ('int8', int8)):
+                best = float('inf')
+                for _ in range(repeat):
+                    start = time.perf_counter()
+                    y = model(x)[0][0].numpy()
+                    best = min(best, time.perf_counter() - start)
+                report[name + '_time'] += best
+                outputs.append(y)
+            error = np.abs(outputs[0] - outputs[1])
+            report['max_error'] = max(report['max_error'], float(error.max()))
+            report['mean_error'] += float(error.mean()) / len(images)
+            rects, rects_int8 = _rects(outputs[0]), _rects(outputs[1])
+            report['boxes'] += len(rects)
+            report['int8_boxes'] += len(rects_int8)
+            report['matched'] += _matched(rects, rects_int8)
+    return report
+
+
+def print_report(report):
+    print(f"int8 vs fp32 CRAFT on {report['images']} images")
+    print(f"  score maps: max abs error {report['max_error']:.4f}, mean abs error {report['mean_error']:.5f}")
+    print(f"  boxes: fp32 {report['boxes']}, int8 {report['int8_boxes']}, "
+          f"fp32 boxes found by int8 (IoU >= 0.5) {report['matched']}")
+    print(f"  time: fp32 {report['fp32_time']*1000:.1f} ms, int8 {report['int8_time']*1000:.1f} ms "
+          f"({report['fp32_time']/max(report['int8_time'], 1e-9):.1f}x)")
+
+
+def image_paths(paths):
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files += sorted(os.path.join(path, name) for name in os.listdir(path)
+                            if name.lower().endswith(('.jpg', '.jpeg', '.png', '.bmp', '.tif', '.tiff')))
+        else:
+            files.append(path)
+    return files
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Calibrate an int8 CRAFT detector on sample images.")
+    parser.add_argument('--model', type=str, required=True, help="fp32 detector weights (.pth)")
+    parser.add_argument('--images', type=str, nargs='+', required=True, help="calibration images or directories")
+    parser.add_argument('--max_images', type=int, default=32, help="number of images used for calibration")
+    parser.add_argument('--canvas_size', type=int, default=2560, help="image size for inference")
+    parser.add_argument('--mag_ratio', type=float, default=1., help="image magnification ratio")
+    parser.add_argument('--engine', type=str, default=None, help="quantized engine (default: torch's)")
+    parser.add_argument('--repeat', type=int, default=3, help="timed runs per image in the report (best is reported)")
+    return parser.parse_args()
+
+
+def main():
+    from .detection import get_detector
+    args = parse_args()
+    images = [loadImage(path) for path in image_paths(args.images)[:args.max_images]]
+    if not images:
+        raise ValueError("no calibration images found in %s" % ' '.join(args.images))
+
+    int8 = quantize_detector(get_detector(args.model, 'cpu', quantize=False), images,
+                             args.canvas_size, args.mag_ratio, args.engine)
+    save_quantized(int8, int8_path(args.model))
+    print(f"calibrated on {len(images)} images, saved {int8_path(args.model)}")
+    print_report(compare_detectors(get_detector(args.model, 'cpu', quantize=False), int8, images,
+                                   args.canvas_size, args.mag_ratio, args.repeat))
+
+
+if __name__ == "__main__":
+    main()
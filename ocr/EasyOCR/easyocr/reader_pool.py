@@ -0,0 +1,199 @@
+"""
+Multi-process CPU inference with one copy of the model weights.
+
+ReaderPool builds a Reader once, moves its weights to shared memory and forks
+worker processes that run readtext on whole pages. Each worker runs torch
+with a few intra-op threads, optionally pinned to its own cores, which scales
+better than one process with many threads on small recognition batches.
+"""
+import itertools
+import multiprocessing
+import os
+import queue
+import threading
+import traceback
+
+import torch
+
+from .easyocr import Reader
+
+
+def share_weights(model):
+    """ move the parameters and buffers of a torch model to shared memory """
+    if isinstance(model, torch.nn.Module):
+        for tensor in itertools.chain(model.parameters(), model.buffers()):
+            # tensors mapped from flat weight files (not resizable) share their pages already
+            if tensor.untyped_storage().resizable():
+                tensor.share_memory_()
+    return model
+
+
+def _worker(reader, cpus, threads, tasks, results):
+    # the reader is inherited from the parent on fork, threads of the parent do not survive the fork
+    reader.preprocess_pools = {}
+    reader.preprocess_lock = threading.Lock()
+    if cpus:
+        os.sched_setaffinity(0, cpus)
+    torch.set_num_threads(threads)
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        index, image, kwargs = task
+        try:
+            results.put((index, reader.readtext(image, **kwargs), None))
+        except Exception as e:
+            results.put((index, None, '%s\n%s' % (e, traceback.format_exc())))
+
+
+class ReaderPool(object):
+    """
+    Run readtext over many pages in worker processes sharing one Reader.
+
+    Parameters:
+        lang_list (list): Language codes, as for Reader.
+
+        workers (int): Number of worker processes (default: one per `threads` CPUs).
+
+        threads (int): torch intra-op threads per worker (default 1).
+
+        pin_cpus (bool): Pin each worker to its own `threads` CPUs when there are
+        enough of them (default).
+
+        max_pending (int): Pages queued to the workers at a time by map/imap,
+        at least `workers` (default: twice the number of workers). Further pages
+        are only read from the input iterable as results come back.
+
+        reader (Reader): Share this CPU Reader instead of building one.
+
+        Other keyword arguments are passed to Reader; the pool runs on CPU with
+        the torch backend and an eager recognizer. compile_recognizer is not
+        supported: TorchScript traces hold their own copy of the weights, which
+        would not be shared with the workers.
+    """
+
+    def __init__(self, lang_list=None, workers=None, threads=1, pin_cpus=True, max_pending=None,
+                 reader=None, **reader_kwargs):
+        if threads < 1:
+            raise ValueError("threads must be at least 1, got %s" % threads)
+        if 'fork' not in multiprocessing.get_all_start_methods():
+            raise RuntimeError("ReaderPool forks its workers, which this platform does not support")
+        if reader is None:
+            reader_kwargs['gpu'] = False
+            reader = Reader(lang_list, **reader_kwargs)
+        elif reader.device != 'cpu':
+            raise ValueError("ReaderPool runs on CPU, the reader is on %s" % reader.device)
+        if reader.backend != 'torch':
+            # ONNX Runtime sessions start their threads when created, forked copies have none
+            raise ValueError("ReaderPool runs the torch backend, the reader uses %s" % reader.backend)
+        if reader.compile_recognizer:
+            # traced modules keep their weights as constants, each worker would copy them on first use
+            raise ValueError("ReaderPool does not support compile_recognizer, its traces cannot share weights")
+        self.reader = reader
+        for name in ('detector', 'recognizer'):
+            if hasattr(reader, name):
+                share_weights(getattr(reader, name))
+
+        cpus = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else list(range(os.cpu_count() or 1))
+        self.workers = workers or max(1, len(cpus) // threads)
+        self.threads = threads
+        self.max_pending = max(self.workers, max_pending or 2 * self.workers)
+        if pin_cpus and hasattr(os, 'sched_setaffinity') and len(cpus) >= self.workers * threads:
+            cpu_sets = [set(cpus[i*threads:(i+1)*threads]) for i in range(self.workers)]
+        else:
+            cpu_sets = [None] * self.workers
+
+        context = multiprocessing.get_context('fork')
+        self.tasks, self.results = context.Queue(), context.Queue()
+        self.processes = [context.Process(target=_worker, args=(reader, cpu_set, threads, self.tasks, self.results),
+                                          daemon=True) for cpu_set in cpu_sets]
+        for process in self.processes:
+            process.start()
+        self.lock = threading.Lock()
+        self.closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        """ stop the workers once they have finished their pages """
+        if self.closed:
+            return
+        self.closed = True
+        for _ in self.processes:
+            self.tasks.put(None)
+        for process in self.processes:
+            process.join()
+
+    def terminate(self):
+        """ stop the workers immediately """
+        self.closed = True
+        for process in self.processes:
+            process.terminate()
+            process.join()
+
+    def _result(self):
+        # poll so that a worker that died (e.g. killed for memory) raises instead of hanging
+        while True:
+            try:
+                return self.results.get(timeout=1)
+            except queue.Empty:
+                dead = [process.pid for process in self.processes if not process.is_alive()]
+                if dead:
+                    self.terminate()
+                    raise RuntimeError("ReaderPool workers %s died" % dead)
+
+    def imap(self, images, ordered=True, **kwargs):
+        """
+        Iterate over readtext(image, **kwargs) for each image of the iterable
+        images (file paths, bytes, URLs or arrays). Results come in input order,
+        or as soon as they are ready with ordered=False. At most max_pending
+        pages are in flight; a page that fails raises when its result is due.
+        """
+        if self.closed:
+            raise ValueError("ReaderPool is closed")
+        if not self.lock.acquire(blocking=False):
+            raise RuntimeError("ReaderPool runs one map/imap at a time")
+        images = iter(images)
+        pending, done, next_index, submitted = 0, {}, 0, 0
+        try:
+            exhausted = False
+            while True:
+                # pages waiting for an earlier one count against max_pending too
+                while not exhausted and pending + len(done) < self.max_pending:
+                    try:
+                        image = next(images)
+                    except StopIteration:
+                        exhausted = True
+                        break
+                    self.tasks.put((submitted, image, kwargs))
+                    submitted += 1
+                    pending += 1
+                if pending == 0:
+                    break
+                index, result, error = self._result()
+                pending -= 1
+                if error is not None:
+                    raise RuntimeError("readtext failed on image %d: %s" % (index, error))
+                if not ordered:
+                    yield result
+                    continue
+                done[index] = result
+                while next_index in done:
+                    yield done.pop(next_index)
+                    next_index += 1
+        finally:
+            # results of an abandoned or failed iteration must not reach the next one
+            try:
+                while pending and not self.closed:
+                    self._result()
+                    pending -= 1
+            finally:
+                self.lock.release()
+
+    def map(self, images, **kwargs):
+        """ list of readtext(image, **kwargs) for each image, in input order """
+        return list(self.imap(images, **kwargs))
@@ -1,14 +1,17 @@
 from PIL import Image
 import torch
 import torch.backends.cudnn as cudnn
-import torch.utils.data
 import torch.nn.functional as F
-import torchvision.transforms as transforms
 import numpy as np
 from collections import OrderedDict
 import importlib
+import inspect
 from .utils import CTCLabelConverter
+from .flat_weights import load_flat
 import math
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, Future
+import time
 
 def custom_mean(x):
     return x.prod()**(2.0/np.sqrt(len(x)))
@@ -24,118 +27,171 @@ def adjust_contrast_grey(img, target = 0.4):
         img = img.astype(int)
         ratio = 200./np.maximum(10, high-low)
         img = (img - low + 25)*ratio
-        img = np.maximum(np.full(img.shape, 0) ,np.minimum(np.full(img.shape, 255), img)).astype(np.uint8)
+        img = np.clip(img, 0, 255).astype(np.uint8)
     return img
 
-class NormalizePAD(object):
-
-    def __init__(self, max_size, PAD_type='right'):
-        self.toTensor = transforms.ToTensor()
-        self.max_size = max_size
-        self.max_width_half = math.floor(max_size[2] / 2)
-        self.PAD_type = PAD_type
-
-    def __call__(self, img):
-        img = self.toTensor(img)
-        img.sub_(0.5).div_(0.5)
-        c, h, w = img.size()
-        Pad_img = torch.FloatTensor(*self.max_size).fill_(0)
-        Pad_img[:, :, :w] = img  # right pad
-        if self.max_size[2] != w:  # add border Pad
-            Pad_img[:, :, w:] = img[:, :, w - 1].unsqueeze(2).expand(c, h, self.max_size[2] - w)
-
-        return Pad_img
-
-class ListDataset(torch.utils.data.Dataset):
-
-    def __init__(self, image_list):
-        self.image_list = image_list
-        self.nSamples = len(image_list)
-
-    def __len__(self):
-        return self.nSamples
-
-    def __getitem__(self, index):
-        img = self.image_list[index]
-        return Image.fromarray(img, 'L')
+def aspect_ratio_order(image_list):
+    """ indices of image_list sorted by aspect ratio, so that crops of similar width end up in the same batch """
+    ratios = np.array([img.shape[1] / float(img.shape[0]) for img in image_list])
+    return np.argsort(ratios, kind='stable').tolist()
+
+class PreprocessPool(object):
+    """
+    Long-lived thread pool that collates recognition batches ahead of the
+    recognizer. At most `queue_size` batches are in flight, so memory stays
+    bounded however many crops are queued. With workers=0 batches are
+    collated inline.
+    """
+
+    def __init__(self, workers=1, queue_size=None):
+        self.workers = int(workers)
+        self.queue_size = queue_size or max(2 * self.workers, 1)
+        self.executor = ThreadPoolExecutor(max_workers=self.workers) if self.workers > 0 else None
+
+    def submit(self, fn, *args):
+        """ run fn(*args) on the pool, or inline without workers; returns a Future """
+        if self.executor is not None:
+            return self.executor.submit(fn, *args)
+        future = Future()
+        future.set_result(fn(*args))
+        return future
+
+    def map(self, fn, batches):
+        """ yield fn(batch) for every batch, in order """
+        pending = deque()
+        for batch in batches:
+            pending.append(self.submit(fn, batch))
+            if len(pending) >= self.queue_size:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+            self.executor = None
 
 class AlignCollate(object):
 
-    def __init__(self, imgH=32, imgW=100, keep_ratio_with_pad=False, adjust_contrast = 0.):
+    def __init__(self, imgH=32, imgW=100, keep_ratio_with_pad=False, adjust_contrast = 0., dynamic_width=False):
         self.imgH = imgH
         self.imgW = imgW
         self.keep_ratio_with_pad = keep_ratio_with_pad
         self.adjust_contrast = adjust_contrast
+        self.dynamic_width = dynamic_width
 
     def __call__(self, batch):
-        batch = filter(lambda x: x is not None, batch)
-        images = batch
+        # crops are uint8 arrays (PIL images are accepted too); they are normalized
+        # and padded straight into one preallocated batch array
+        images = [np.asarray(image.convert("L")) if isinstance(image, Image.Image) else image
+                  for image in batch if image is not None]
 
         resized_max_w = self.imgW
-        input_channel = 1
-        transform = NormalizePAD((input_channel, self.imgH, resized_max_w))
-
-        resized_images = []
-        for image in images:
-            w, h = image.size
+        if self.dynamic_width:
+            # pad only to the widest image of this batch, in multiples of imgH
+            max_ratio = max(image.shape[1] / float(image.shape[0]) for image in images)
+            resized_max_w = min(max(math.ceil(max_ratio), 1) * self.imgH, self.imgW)
+
+        image_tensors = np.empty((len(images), 1, self.imgH, resized_max_w), dtype=np.float32)
+        for image, out in zip(images, image_tensors):
+            h, w = image.shape[:2]
             #### augmentation here - change contrast
             if self.adjust_contrast > 0:
-                image = np.array(image.convert("L"))
                 image = adjust_contrast_grey(image, target = self.adjust_contrast)
-                image = Image.fromarray(image, 'L')
 
             ratio = w / float(h)
-            if math.ceil(self.imgH * ratio) > self.imgW:
-                resized_w = self.imgW
+            if math.ceil(self.imgH * ratio) > resized_max_w:
+                resized_w = resized_max_w
             else:
                 resized_w = math.ceil(self.imgH * ratio)
 
-            resized_image = image.resize((resized_w, self.imgH), Image.BICUBIC)
-            resized_images.append(transform(resized_image))
-
-        image_tensors = torch.cat([t.unsqueeze(0) for t in resized_images], 0)
-        return image_tensors
+            # crops from get_image_list already have the model height and are not resized
+            if (resized_w, self.imgH) != (w, h):
+                image = np.asarray(Image.fromarray(image, 'L').resize((resized_w, self.imgH), Image.BICUBIC))
+            normalize_pad_into(image, out[0])
+
+        return torch.from_numpy(image_tensors)
+
+def normalize_pad_into(img, out):
+    """
+    Write uint8 img into the wider float array out: scaled to [-1, 1] and
+    right-padded with its last column.
+    """
+    w = img.shape[1]
+    np.divide(img, np.float32(255), out=out[:, :w], dtype=np.float32)
+    out[:, :w] -= 0.5
+    out[:, :w] /= 0.5
+    out[:, w:] = out[:, w - 1:w]
+
+def get_ignore_mask(converter, ignore_char, device = 'cpu'):
+    """
+    boolean mask over the classes (blank first) that are never predicted:
+    every class of each ignored character, which may appear more than once
+    in the character list
+    """
+    mask = np.isin(converter.character_array, list(ignore_char))
+    return torch.from_numpy(mask).to(device)
+
+def masked_max(preds, ignore_mask):
+    """
+    Softmax over the classes that are not ignored, computed on preds' device.
+    Equivalent to softmax, zeroing ignore_mask and renormalizing.
+    Returns (preds_prob, max_prob, preds_index).
+    """
+    preds = preds.float().masked_fill(ignore_mask.to(preds.device), -float('inf'))
+    preds_prob = F.softmax(preds, dim=2)
+    max_prob, preds_index = preds_prob.max(2)
+    return preds_prob, max_prob, preds_index
+
+def forward_takes_text(model):
+    """ whether model must be called as model(input, text), like custom networks written for the attention models """
+    forward = getattr(getattr(model, 'module', model), 'forward', None) # unwrap DataParallel
+    try:
+        parameters = inspect.signature(forward).parameters.values()
+    except (TypeError, ValueError): # not a module, e.g. OrtRecognizer
+        return False
+    required = [p for p in parameters if p.default is p.empty and\
+                p.kind in (p.POSITIONAL_ONLY, p.POSITIONAL_OR_KEYWORD)]
+    return len(required) > 1
 
 def recognizer_predict(model, converter, test_loader, batch_max_length,\
-                       ignore_idx, char_group_idx, decoder = 'greedy', beamWidth= 5, device = 'cpu'):
+                       ignore_mask, char_group_idx, decoder = 'greedy', beamWidth= 5, device = 'cpu', takes_text = None):
     model.eval()
+    # the CTC models do not use the text input, only custom networks may require it
+    if takes_text is None:
+        takes_text = forward_takes_text(model)
+    # batch width varies per batch, derive max length from it
+    dynamic_length = batch_max_length is None
     result = []
     with torch.no_grad():
         for image_tensors in test_loader:
             batch_size = image_tensors.size(0)
             image = image_tensors.to(device)
-            # For max length prediction
-            length_for_pred = torch.IntTensor([batch_max_length] * batch_size).to(device)
-            text_for_pred = torch.LongTensor(batch_size, batch_max_length + 1).fill_(0).to(device)
-
-            preds = model(image, text_for_pred)
+            if takes_text:
+                if dynamic_length:
+                    batch_max_length = int(image_tensors.size(3)/10)
+                text_for_pred = torch.LongTensor(batch_size, batch_max_length + 1).fill_(0).to(device)
+                preds = model(image, text_for_pred)
+            else:
+                preds = model(image)
 
             # Select max probabilty (greedy decoding) then decode index to character
             preds_size = torch.IntTensor([preds.size(1)] * batch_size)
 
-            ######## filter ignore_char, rebalance
-            preds_prob = F.softmax(preds, dim=2)
-            preds_prob = preds_prob.cpu().detach().numpy()
-            preds_prob[:,:,ignore_idx] = 0.
-            pred_norm = preds_prob.sum(axis=2)
-            preds_prob = preds_prob/np.expand_dims(pred_norm, axis=-1)
-            preds_prob = torch.from_numpy(preds_prob).float().to(device)
+            ######## filter ignore_char, rebalance - on device, only indices and max probs come back
+            preds_prob, max_prob, preds_index = masked_max(preds, ignore_mask)
+            values = max_prob.cpu().numpy()
+            indices = preds_index.cpu().numpy()
 
             if decoder == 'greedy':
-                # Select max probabilty (greedy decoding) then decode index to character
-                _, preds_index = preds_prob.max(2)
-                preds_index = preds_index.view(-1)
-                preds_str = converter.decode_greedy(preds_index.data.cpu().detach().numpy(), preds_size.data)
+                preds_str = converter.decode_greedy(indices.reshape(-1), preds_size.data)
             elif decoder == 'beamsearch':
-                k = preds_prob.cpu().detach().numpy()
+                k = preds_prob.cpu().numpy()
                 preds_str = converter.decode_beamsearch(k, beamWidth=beamWidth)
             elif decoder == 'wordbeamsearch':
-                k = preds_prob.cpu().detach().numpy()
+                k = preds_prob.cpu().numpy()
                 preds_str = converter.decode_wordbeamsearch(k, beamWidth=beamWidth)
 
-            preds_prob = preds_prob.cpu().detach().numpy()
-            values = preds_prob.max(axis=2)
-            indices = preds_prob.argmax(axis=2)
             preds_max_prob = []
             for v,i in zip(values, indices):
                 max_probs = v[i!=0]
@@ -163,71 +219,150 @@ def get_recognizer(recog_network, network_params, character,\
         model_pkg = importlib.import_module("easyocr.model.vgg_model")
     else:
         model_pkg = importlib.import_module(recog_network)
-    model = model_pkg.Model(num_class=num_class, **network_params)
+    # weights converted with `python -m easyocr.flat_weights` are mapped, not loaded;
+    # with quantize, quantize_dynamic repacks the LSTM/Linear weights into private
+    # int8 copies, only the convolution weights stay mapped
+    model = load_flat(model_path, lambda: model_pkg.Model(num_class=num_class, **network_params))
 
     if device == 'cpu':
-        state_dict = torch.load(model_path, map_location=device)
-        new_state_dict = OrderedDict()
-        for key, value in state_dict.items():
-            new_key = key[7:]
-            new_state_dict[new_key] = value
-        model.load_state_dict(new_state_dict)
+        if model is None:
+            model = model_pkg.Model(num_class=num_class, **network_params)
+            state_dict = torch.load(model_path, map_location=device)
+            new_state_dict = OrderedDict()
+            for key, value in state_dict.items():
+                new_key = key[7:]
+                new_state_dict[new_key] = value
+            model.load_state_dict(new_state_dict)
         if quantize:
             try:
                 torch.quantization.quantize_dynamic(model, dtype=torch.qint8, inplace=True)
             except:
                 pass
-    else:
+    elif model is not None:
         model = torch.nn.DataParallel(model).to(device)
+    else:
+        model = torch.nn.DataParallel(model_pkg.Model(num_class=num_class, **network_params)).to(device)
         model.load_state_dict(torch.load(model_path, map_location=device))
 
     return model, converter
 
 def get_text(character, imgH, imgW, recognizer, converter, image_list,\
              ignore_char = '',decoder = 'greedy', beamWidth =5, batch_size=1, contrast_ths=0.1,\
-             adjust_contrast=0.5, filter_ths = 0.003, workers = 1, device = 'cpu'):
-    batch_max_length = int(imgW/10)
+             adjust_contrast=0.5, filter_ths = 0.003, workers = 1, device = 'cpu', dynamic_width = False,\
+             ignore_mask = None, pool = None, max_retry_ratio = 1.0, max_retry_time = None, takes_text = None):
+    # with dynamic_width, crops are sorted by aspect ratio and each batch is padded
+    # only to its own width (at most imgW); results are returned in input order.
+    # Crops below contrast_ths are retried with adjusted contrast in the same batch
+    # stream: they are queued into the next batches. At most max_retry_ratio of the
+    # crops are retried, and none once max_retry_time seconds have passed.
+    # takes_text is forward_takes_text(recognizer), worked out here when not given.
+    batch_max_length = None if dynamic_width else int(imgW/10)
+    start_time = time.time()
 
     char_group_idx = {}
-    ignore_idx = []
-    for char in ignore_char:
-        try: ignore_idx.append(character.index(char)+1)
-        except: pass
+    if ignore_mask is None:
+        ignore_mask = get_ignore_mask(converter, ignore_char, device)
+    if takes_text is None:
+        takes_text = forward_takes_text(recognizer)
+    own_pool = pool is None
+    if own_pool:
+        pool = PreprocessPool(workers)
 
     coord = [item[0] for item in image_list]
     img_list = [item[1] for item in image_list]
-    AlignCollate_normal = AlignCollate(imgH=imgH, imgW=imgW, keep_ratio_with_pad=True)
-    test_data = ListDataset(img_list)
-    test_loader = torch.utils.data.DataLoader(
-        test_data, batch_size=batch_size, shuffle=False,
-        num_workers=int(workers), collate_fn=AlignCollate_normal, pin_memory=True)
-
-    # predict first round
-    result1 = recognizer_predict(recognizer, converter, test_loader,batch_max_length,\
-                                 ignore_idx, char_group_idx, decoder, beamWidth, device = device)
-
-    # predict second round
-    low_confident_idx = [i for i,item in enumerate(result1) if (item[1] < contrast_ths)]
-    if len(low_confident_idx) > 0:
-        img_list2 = [img_list[i] for i in low_confident_idx]
-        AlignCollate_contrast = AlignCollate(imgH=imgH, imgW=imgW, keep_ratio_with_pad=True, adjust_contrast=adjust_contrast)
-        test_data = ListDataset(img_list2)
-        test_loader = torch.utils.data.DataLoader(
-                        test_data, batch_size=batch_size, shuffle=False,
-                        num_workers=int(workers), collate_fn=AlignCollate_contrast, pin_memory=True)
-        result2 = recognizer_predict(recognizer, converter, test_loader, batch_max_length,\
-                                     ignore_idx, char_group_idx, decoder, beamWidth, device = device)
+
+    collate = AlignCollate(imgH=imgH, imgW=imgW, keep_ratio_with_pad=True, dynamic_width=dynamic_width)
+    def collate_batch(batch):
+        images = []
+        for i, retry in batch:
+            img = img_list[i]
+            if retry: img = adjust_contrast_grey(img, target = adjust_contrast)
+            images.append(img)
+        return collate(images)
+
+    if dynamic_width: order = aspect_ratio_order(img_list)
+    else: order = list(range(len(img_list)))
+    order = deque(order)
+    retry_queue = deque()
+    max_retry = int(max_retry_ratio * len(img_list))
+    n_retry = 0
+
+    def next_batch():
+        # pending retries first: their crops are no wider than the ones still to come
+        batch = []
+        while retry_queue and len(batch) < batch_size:
+            batch.append((retry_queue.popleft(), True))
+        while order and len(batch) < batch_size:
+            batch.append((order.popleft(), False))
+        return batch
+
+    result1 = [None] * len(img_list)
+    result2 = {}
+    pending = deque()
+    while True:
+        while len(pending) < pool.queue_size:
+            batch = next_batch()
+            if not batch: break
+            pending.append((batch, pool.submit(collate_batch, batch)))
+        if not pending: break
+
+        batch, future = pending.popleft()
+        preds = recognizer_predict(recognizer, converter, [future.result()], batch_max_length,\
+                                   ignore_mask, char_group_idx, decoder, beamWidth, device = device, takes_text = takes_text)
+        for (i, retry), pred in zip(batch, preds):
+            if retry:
+                result2[i] = pred
+                continue
+            result1[i] = pred
+            if pred[1] < contrast_ths and n_retry < max_retry and\
+               (max_retry_time is None or time.time() - start_time < max_retry_time):
+                retry_queue.append(i)
+                n_retry += 1
+        if max_retry_time is not None and time.time() - start_time >= max_retry_time:
+            retry_queue.clear()
+
+    if own_pool:
+        pool.shutdown()
 
     result = []
-    for i, zipped in enumerate(zip(coord, result1)):
-        box, pred1 = zipped
-        if i in low_confident_idx:
-            pred2 = result2[low_confident_idx.index(i)]
-            if pred1[1]>pred2[1]:
-                result.append( (box, pred1[0], pred1[1]) )
-            else:
-                result.append( (box, pred2[0], pred2[1]) )
+    for i, (box, pred1) in enumerate(zip(coord, result1)):
+        pred2 = result2.get(i)
+        if pred2 is not None and pred1[1] <= pred2[1]:
+            result.append( (box, pred2[0], pred2[1]) )
         else:
             result.append( (box, pred1[0], pred1[1]) )
 
     return result
+
+def batch_width(img_list, imgH):
+    """ smallest multiple of imgH wide enough for every image once resized to height imgH """
+    max_ratio = max(img.shape[1] / float(img.shape[0]) for img in img_list)
+    return max(math.ceil(max_ratio), 1) * imgH
+
+def get_text_scheduled(character, imgH, recognizer, converter, image_lists,\
+                       ignore_char = '',decoder = 'greedy', beamWidth =5, batch_size=1, contrast_ths=0.1,\
+                       adjust_contrast=0.5, filter_ths = 0.003, workers = 1, device = 'cpu', ignore_mask = None,\
+                       pool = None, max_retry_ratio = 1.0, max_retry_time = None, takes_text = None):
+    """
+    Recognize the crops of several pages in one schedule.
+    Crops from every page are pooled and recognized by a single get_text call,
+    which sorts them by aspect ratio and pads each batch only to its own widest
+    crop. Results are scattered back and returned as one list per page, in the
+    original crop order.
+    """
+    flat = [(page, i) for page, image_list in enumerate(image_lists) for i in range(len(image_list))]
+    results = [[None] * len(image_list) for image_list in image_lists]
+    if not flat:
+        return results
+
+    flat_list = [image_lists[page][i] for page, i in flat]
+    imgW = batch_width([item[1] for item in flat_list], imgH)
+    flat_result = get_text(character, imgH, imgW, recognizer, converter, flat_list,\
+                           ignore_char, decoder, beamWidth, batch_size, contrast_ths,\
+                           adjust_contrast, filter_ths, workers, device, dynamic_width = True, ignore_mask = ignore_mask,\
+                           pool = pool, max_retry_ratio = max_retry_ratio, max_retry_time = max_retry_time,\
+                           takes_text = takes_text)
+    for (page, i), res in zip(flat, flat_result):
+        results[page][i] = res
+
+    return results
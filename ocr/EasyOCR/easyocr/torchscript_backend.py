@@ -0,0 +1,108 @@
+"""
+TorchScript inference for the CRNN recognizers.
+
+The recognizer is traced once per width bucket, a multiple of imgH like the
+widths of dynamic_width batches, and the traces are stored under
+<model_storage_directory>/compiled so that later runs only load them. A
+loaded trace is frozen and optimized for inference. TracedRecognizer can be
+used in place of the torch model by recognizer_predict.
+"""
+import os
+import tempfile
+import threading
+import warnings
+from logging import getLogger
+
+import torch
+
+LOGGER = getLogger(__name__)
+
+
+def trace_recognizer(model, width, imgH=64, device='cpu'):
+    """ trace of model(input) for 1x1ximgHxwidth inputs; the graph runs any batch size and width """
+    dummy_input = torch.zeros(1, 1, imgH, width, device=device)
+    with torch.no_grad(), warnings.catch_warnings():
+        warnings.simplefilter('ignore', torch.jit.TracerWarning)
+        return torch.jit.trace(model.eval(), dummy_input)
+
+
+def save_trace(module, path):
+    # write to a temporary file first so that a partial trace is never loaded
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix='.pt')
+    os.close(fd)
+    try:
+        torch.jit.save(module, tmp_path)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+class TracedRecognizer(object):
+    """
+    callable like the CRNN models; the text input is not used. Each batch is
+    run by the module of its width bucket, which is loaded from the cache or
+    traced from model on first use. Widths are rounded up to the bucket, a
+    batch is not padded: buckets only keep the shapes each module sees (and
+    the graph TorchScript specializes for them) apart.
+    """
+
+    def __init__(self, model, model_path, cache_dir, imgH=64, device='cpu'):
+        self.model = getattr(model, 'module', model) # unwrap DataParallel
+        self.model_path = model_path
+        self.cache_dir = cache_dir
+        self.imgH = imgH
+        self.device = device
+        # the weights differ with dynamic quantization, keep their traces apart
+        quantized = any(type(module).__module__.startswith('torch.ao.nn.quantized')
+                        for module in self.model.modules())
+        self.name = '%s_%s_%s' % (os.path.splitext(os.path.basename(model_path))[0],
+                                  torch.device(device).type, 'int8' if quantized else 'fp32')
+        self.modules = {}
+        self.lock = threading.Lock()
+
+    def eval(self):
+        return self
+
+    def bucket(self, width):
+        return -(-width // self.imgH) * self.imgH
+
+    def trace_path(self, width):
+        return os.path.join(self.cache_dir, '%s_w%d.pt' % (self.name, width))
+
+    def __call__(self, input, text=None):
+        width = self.bucket(input.size(3))
+        module = self.modules.get(width)
+        if module is None:
+            with self.lock:
+                module = self.modules.get(width)
+                if module is None:
+                    module = self.modules[width] = self.load(width)
+        return module(input)
+
+    def load(self, width):
+        """
+        Optimized module of the width bucket. Traces older than the model
+        weights are replaced; the eager model is used when it cannot be traced.
+        """
+        path = self.trace_path(width)
+        module = None
+        if os.path.isfile(path) and os.path.getmtime(path) >= os.path.getmtime(self.model_path):
+            try:
+                module = torch.jit.load(path, map_location=self.device)
+            except Exception as e:
+                LOGGER.warning('Cannot load the traced recognizer %s (%s), tracing it again' % (path, e))
+        if module is None:
+            LOGGER.info('Tracing %s for width %d' % (self.model_path, width))
+            try:
+                module = trace_recognizer(self.model, width, self.imgH, self.device)
+            except Exception as e:
+                LOGGER.warning('Cannot trace %s (%s), using torch' % (self.model_path, e))
+                return self.model
+            try:
+                os.makedirs(self.cache_dir, exist_ok=True)
+                save_trace(module, path)
+            except OSError as e:
+                LOGGER.warning('Cannot cache the traced recognizer %s (%s)' % (path, e))
+        # frozen and optimized modules cannot be saved, so this runs on every load
+        return torch.jit.optimize_for_inference(module.eval())
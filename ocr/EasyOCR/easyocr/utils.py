@@ -6,9 +6,15 @@ import numpy as np
 import math
 import cv2
 from PIL import Image, JpegImagePlugin
-from scipy import ndimage
 import hashlib
+import json
 import sys, os
+import io
+import mmap
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
 from zipfile import ZipFile
 from .imgproc import loadImage
 
@@ -17,6 +23,11 @@ if sys.version_info[0] == 2:
 else:
     from urllib.request import urlretrieve
 
+try:
+    import fcntl
+except ImportError: # Windows
+    fcntl = None
+
 def consecutive(data, mode ='first', stepsize=1):
     group = np.split(data, np.where(np.diff(data) != stepsize)[0]+1)
     group = [item for item in group if len(item)>0]
@@ -270,6 +281,237 @@ def ctcBeamSearch(mat, classes, ignore_idx, lm, beamWidth=25, dict_list = []):
     return res
 
 
+def ctcBeamSearchBatched(mats, beamWidth=25, lengths=None, top_k=1):
+    """
+    Vectorized CTC prefix beam search in log-space over a batch of matrices.
+    mats: [N, T, C] character probabilities, blank at index 0
+    lengths: number of valid time-steps for each matrix (default: all T)
+    top_k: number of best labelings to return for each matrix
+    returns a list of N lists of label tuples, best first
+    """
+    mats = np.asarray(mats, dtype=np.float32)
+    N, T, C = mats.shape
+    if lengths is None:
+        lengths = np.full(N, T)
+    lengths = np.asarray(lengths)
+    K = max(beamWidth, top_k)
+    hash_base = np.uint64(1000003)
+    rows = np.arange(N)[:, None]
+    slots = np.arange(K)[None, :]
+
+    with np.errstate(divide='ignore'):
+        log_mats = np.log(mats)
+
+    # beams are kept sorted by total score; slot 0 starts as the empty labeling
+    pb = np.full((N, K), -np.inf, dtype=np.float32)
+    pb[:, 0] = 0.
+    pnb = np.full((N, K), -np.inf, dtype=np.float32)
+    length = np.zeros((N, K), dtype=np.int64)
+    last = np.zeros((N, K), dtype=np.int64)
+    hashes = np.zeros((N, K), dtype=np.uint64)       # hash of the labeling
+    parent_hashes = np.zeros((N, K), dtype=np.uint64) # hash of the labeling without its last char
+
+    # back-pointers to rebuild the labelings at the end
+    src_hist, char_hist = [], []
+
+    for t in range(T):
+        active = t < lengths
+        if not active.any():
+            break
+        lp = log_mats[:, t, :]
+
+        # only the beamWidth best beams are extended
+        pb_k, pnb_k = pb.copy(), pnb.copy()
+        pb_k[:, beamWidth:] = -np.inf
+        pnb_k[:, beamWidth:] = -np.inf
+        tot = np.logaddexp(pb_k, pnb_k)
+        alive = tot > -np.inf
+        has_last = length > 0
+        lp_last = np.take_along_axis(lp, last, axis=1)
+
+        # same labeling: end with a blank, or repeat the last char
+        stay_pb = tot + lp[:, :1]
+        stay_pnb = np.where(has_last, pnb_k + lp_last, -np.inf)
+
+        # extend the labeling with char c, a repeated char needs a blank in between
+        ext = tot[:, :beamWidth, None] + lp[:, None, :]
+        rep_rows, rep_beams = np.nonzero(has_last[:, :beamWidth])
+        ext[rep_rows, rep_beams, last[rep_rows, rep_beams]] = \
+            pb_k[rep_rows, rep_beams] + lp_last[rep_rows, rep_beams]
+        ext[:, :, 0] = -np.inf
+
+        # an extension equal to a labeling already in the beam is merged into it
+        match = (parent_hashes[:, :, None] == hashes[:, None, :beamWidth]) &\
+                has_last[:, :, None] & alive[:, None, :beamWidth]
+        m_rows, m_beams, m_parents = np.nonzero(match)
+        m_chars = last[m_rows, m_beams]
+        stay_pnb[m_rows, m_beams] = np.logaddexp(stay_pnb[m_rows, m_beams], ext[m_rows, m_parents, m_chars])
+        ext[m_rows, m_parents, m_chars] = -np.inf
+
+        # keep the K best candidates
+        scores = np.concatenate([np.logaddexp(stay_pb, stay_pnb), ext.reshape(N, -1)], axis=1)
+        sel = np.argpartition(-scores, K - 1, axis=1)[:, :K]
+        sel = np.take_along_axis(sel, np.argsort(-np.take_along_axis(scores, sel, axis=1), axis=1, kind='stable'), axis=1)
+
+        is_ext = sel >= K
+        ext_idx = np.where(is_ext, sel - K, 0)
+        src = np.where(is_ext, ext_idx // C, sel)
+        char = np.where(is_ext, ext_idx % C, -1)
+
+        new_pb = np.where(is_ext, -np.inf, stay_pb[rows, src]).astype(np.float32)
+        new_pnb = np.where(is_ext, ext.reshape(N, -1)[rows, ext_idx], stay_pnb[rows, src]).astype(np.float32)
+        src_hash = hashes[rows, src]
+        new_hashes = np.where(is_ext, src_hash * hash_base + (char + 1).astype(np.uint64), src_hash)
+        new_parent = np.where(is_ext, src_hash, parent_hashes[rows, src])
+        new_length = length[rows, src] + is_ext
+        new_last = np.where(is_ext, char, last[rows, src])
+
+        # finished matrices keep their state
+        keep = ~active[:, None]
+        src = np.where(keep, slots, src)
+        char = np.where(keep, -1, char)
+        pb = np.where(keep, pb, new_pb)
+        pnb = np.where(keep, pnb, new_pnb)
+        hashes = np.where(keep, hashes, new_hashes)
+        parent_hashes = np.where(keep, parent_hashes, new_parent)
+        length = np.where(keep, length, new_length)
+        last = np.where(keep, last, new_last)
+
+        src_hist.append(src)
+        char_hist.append(char)
+
+    # follow the back-pointers to recover the labelings
+    labels = np.full((N, K, len(src_hist)), -1, dtype=np.int64)
+    idx = np.broadcast_to(slots, (N, K))
+    for t in range(len(src_hist) - 1, -1, -1):
+        labels[:, :, t] = char_hist[t][rows, idx]
+        idx = src_hist[t][rows, idx]
+
+    tot = np.logaddexp(pb, pnb)
+    result = []
+    for n in range(N):
+        beams = []
+        for k in range(K):
+            if len(beams) == top_k: break
+            if k > 0 and tot[n, k] == -np.inf: break
+            beams.append(tuple(labels[n, k][labels[n, k] >= 0]))
+        result.append(beams)
+    return result
+
+def labeling_to_text(labeling, classes, ignore_idx):
+    "map a collapsed labeling to text, dropping blank and separators"
+    return ''.join([classes[l] for l in labeling if l not in ignore_idx])
+
+
+class DictTrie(object):
+    """
+    Prefix trie of a word list stored as flat arrays.
+    Edge i goes from node edge_parent[i] to node i+1 with character edge_char[i]
+    (a unicode code point); node 0 is the root. After bind(), edges are also
+    indexed by class, sorted by (parent, class), for vectorized lookups.
+    """
+
+    def __init__(self, edge_parent, edge_char, terminal):
+        self.edge_parent = np.asarray(edge_parent, dtype=np.int32)
+        self.edge_char = np.asarray(edge_char, dtype=np.int32)
+        self.terminal = np.asarray(terminal, dtype=bool)
+        self.num_class = None
+
+    def __len__(self):
+        return int(self.terminal.sum())
+
+    @classmethod
+    def from_words(cls, words):
+        edge_parent, edge_char, terminal = [], [], [False]
+        stack, prev = [0], ''
+        # sorted words share their prefix with the previous word
+        for word in sorted(set(word for word in words if word)):
+            common = 0
+            for a, b in zip(prev, word):
+                if a != b: break
+                common += 1
+            del stack[common + 1:]
+            for char in word[common:]:
+                edge_parent.append(stack[-1])
+                edge_char.append(ord(char))
+                stack.append(len(terminal))
+                terminal.append(False)
+            terminal[stack[-1]] = True
+            prev = word
+        return cls(edge_parent, edge_char, terminal)
+
+    @classmethod
+    def load(cls, dict_paths, cache_dir=None):
+        """
+        Build the trie of one or more dictionary files, cached as .npz in
+        cache_dir (default: dict_cache/ next to the dictionary directory).
+        The cache is rebuilt when a dictionary file changes.
+        """
+        dict_paths = sorted(dict_paths)
+        if cache_dir is None:
+            cache_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(dict_paths[0]))), 'dict_cache')
+        names = [os.path.splitext(os.path.basename(path))[0] for path in dict_paths]
+        cache_path = os.path.join(cache_dir, '+'.join(names) + '.npz')
+        signature = json.dumps([[os.path.basename(path), os.path.getsize(path), int(os.path.getmtime(path))]\
+                                for path in dict_paths])
+
+        try:
+            with np.load(cache_path) as data:
+                if str(data['signature']) == signature:
+                    return cls(data['edge_parent'], data['edge_char'], data['terminal'])
+        except (OSError, KeyError, ValueError):
+            pass
+
+        words = []
+        for dict_path in dict_paths:
+            with open(dict_path, "r", encoding = "utf-8-sig") as input_file:
+                words += input_file.read().splitlines()
+        trie = cls.from_words(words)
+
+        # write to a temporary file first so concurrent readers never see a partial cache
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            tmp_path = '%s.%d.tmp' % (cache_path, os.getpid())
+            with open(tmp_path, 'wb') as f:
+                np.savez(f, edge_parent=trie.edge_parent, edge_char=trie.edge_char,\
+                         terminal=trie.terminal, signature=np.array(signature))
+            os.replace(tmp_path, cache_path)
+        except OSError:
+            pass
+        return trie
+
+    def bind(self, char_to_idx, num_class):
+        "index edges by class; characters without a class are dropped"
+        unique_chars, inverse = np.unique(self.edge_char, return_inverse=True)
+        char_class = np.array([char_to_idx.get(chr(c), -1) for c in unique_chars], dtype=np.int64)
+        edge_class = char_class[inverse] if len(unique_chars) else np.zeros(0, dtype=np.int64)
+        valid = edge_class >= 0
+        edge_key = self.edge_parent[valid].astype(np.int64) * num_class + edge_class[valid]
+        order = np.argsort(edge_key, kind='stable')
+
+        self.num_class = num_class
+        self.edge_key = edge_key[order]
+        self.edge_class = edge_class[valid][order]
+        self.edge_child = (np.nonzero(valid)[0][order] + 1).astype(np.int64)
+        self.node_start = np.searchsorted(self.edge_key, np.arange(len(self.terminal) + 1, dtype=np.int64) * num_class)
+        return self
+
+    def child(self, nodes, classes):
+        "child node of each (node, class) pair, -1 if there is none"
+        key = np.asarray(nodes, dtype=np.int64) * self.num_class + classes
+        pos = np.minimum(np.searchsorted(self.edge_key, key), max(len(self.edge_key) - 1, 0))
+        if len(self.edge_key) == 0:
+            return np.full(key.shape, -1, dtype=np.int64)
+        return np.where(self.edge_key[pos] == key, self.edge_child[pos], -1)
+
+    def contains(self, labeling):
+        "True if the class labeling is a complete word"
+        node = 0
+        for c in labeling:
+            node = int(self.child(node, c))
+            if node < 0: return False
+        return bool(self.terminal[node])
+
 class CTCLabelConverter(object):
     """ Convert between text-label and text-index """
 
@@ -282,31 +524,35 @@ class CTCLabelConverter(object):
             self.dict[char] = i + 1
 
         self.character = ['[blank]'] + dict_character  # dummy '[blank]' token for CTCLoss (index 0)
+        self.character_array = np.array(self.character)
 
         self.separator_list = separator_list
         separator_char = []
         for lang, sep in separator_list.items():
             separator_char += sep
         self.ignore_idx = [0] + [i+1 for i,item in enumerate(separator_char)]
+        self.ignore_array = np.array(self.ignore_idx)
 
-        ####### latin dict
-        if len(separator_list) == 0:
-            dict_list = []
-            for lang, dict_path in dict_pathlist.items():
-                try:
-                    with open(dict_path, "r", encoding = "utf-8-sig") as input_file:
-                        word_count =  input_file.read().splitlines()
-                    dict_list += word_count
-                except:
-                    pass
-        else:
-            dict_list = {}
-            for lang, dict_path in dict_pathlist.items():
-                with open(dict_path, "r", encoding = "utf-8-sig") as input_file:
-                    word_count =  input_file.read().splitlines()
-                dict_list[lang] = word_count
+        # dictionaries are compiled into tries on first use of wordbeamsearch
+        self.dict_pathlist = dict_pathlist
+        self._dict_trie = None
 
-        self.dict_list = dict_list
+    @property
+    def dict_trie(self):
+        """
+        Without separators: one trie over all existing dictionaries (None if there
+        is none). With separators: a dict of language -> trie.
+        """
+        if self._dict_trie is None:
+            num_class = len(self.character)
+            ####### latin dict
+            if len(self.separator_list) == 0:
+                dict_paths = [path for path in self.dict_pathlist.values() if os.path.isfile(path)]
+                self._dict_trie = DictTrie.load(dict_paths).bind(self.dict, num_class) if dict_paths else False
+            else:
+                self._dict_trie = {lang: DictTrie.load([dict_path]).bind(self.dict, num_class)\
+                                   for lang, dict_path in self.dict_pathlist.items()}
+        return self._dict_trie or None
 
     def encode(self, text, batch_max_length=25):
         """convert text-label into text-index.
@@ -333,28 +579,26 @@ class CTCLabelConverter(object):
             # Returns a boolean array where true is when the value is not repeated
             a = np.insert(~((t[1:]==t[:-1])),0,True)
             # Returns a boolean array where true is when the value is not in the ignore_idx list
-            b = ~np.isin(t,np.array(self.ignore_idx))
+            b = ~np.isin(t,self.ignore_array)
             # Combine the two boolean array
             c = a & b
             # Gets the corresponding character according to the saved indexes
-            text = ''.join(np.array(self.character)[t[c.nonzero()]])
+            text = ''.join(self.character_array[t[c.nonzero()]])
             texts.append(text)
             index += l
         return texts
 
     def decode_beamsearch(self, mat, beamWidth=5):
-        texts = []
-        for i in range(mat.shape[0]):
-            t = ctcBeamSearch(mat[i], self.character, self.ignore_idx, None, beamWidth=beamWidth)
-            texts.append(t)
-        return texts
+        labelings = ctcBeamSearchBatched(mat, beamWidth=beamWidth)
+        return [labeling_to_text(beams[0], self.character, self.ignore_idx) for beams in labelings]
 
-    def decode_wordbeamsearch(self, mat, beamWidth=5):
-        texts = []
+    def decode_wordbeamsearch(self, mat, beamWidth=5, maxCandidate=20):
         argmax = np.argmax(mat, axis = 2)
 
+        # collect the words of every line, then beam search them in one batch
+        words = [] # (line index, matrix, trie)
+        joiners = []
         for i in range(mat.shape[0]):
-            string = ''
             # without separators - use space as separator
             if len(self.separator_list) == 0:
                 space_idx = self.dict[' ']
@@ -363,25 +607,43 @@ class CTCLabelConverter(object):
                 group = np.split(data, np.where(np.diff(data) != 1)[0]+1)
                 group = [ list(item) for item in group if len(item)>0]
 
-                for j, list_idx in enumerate(group):
-                    matrix = mat[i, list_idx,:]
-                    t = ctcBeamSearch(matrix, self.character, self.ignore_idx, None,\
-                                      beamWidth=beamWidth, dict_list=self.dict_list)
-                    if j == 0: string += t
-                    else: string += ' '+t
+                for list_idx in group:
+                    words.append((i, mat[i, list_idx,:], self.dict_trie))
+                joiners.append(' ')
 
             # with separators
             else:
-                words = word_segmentation(argmax[i])
-
-                for word in words:
+                for word in word_segmentation(argmax[i]):
                     matrix = mat[i, word[1][0]:word[1][1]+1,:]
-                    if word[0] == '': dict_list = []
-                    else: dict_list = self.dict_list[word[0]]
-                    t = ctcBeamSearch(matrix, self.character, self.ignore_idx, None, beamWidth=beamWidth, dict_list=dict_list)
-                    string += t
-            texts.append(string)
-        return texts
+                    if word[0] == '': trie = None
+                    else: trie = self.dict_trie[word[0]]
+                    words.append((i, matrix, trie))
+                joiners.append('')
+
+        # unconstrained search; like ctcBeamSearch, the first of the maxCandidate
+        # best beams that is a dictionary word wins, otherwise the best beam
+        texts = []
+        if words:
+            lengths = [len(matrix) for _, matrix, _ in words]
+            padded = np.zeros((len(words), max(max(lengths), 1), mat.shape[2]), dtype=np.float32)
+            for j, (_, matrix, _) in enumerate(words):
+                padded[j, :len(matrix)] = matrix
+            labelings = ctcBeamSearchBatched(padded, beamWidth=beamWidth, lengths=lengths, top_k=maxCandidate)
+
+            for (_, _, trie), beams in zip(words, labelings):
+                best = beams[0]
+                if trie is not None:
+                    for labeling in beams:
+                        # look the text up, i.e. the labeling without ignored classes
+                        if trie.contains([l for l in labeling if l not in self.ignore_idx]):
+                            best = labeling
+                            break
+                texts.append(labeling_to_text(best, self.character, self.ignore_idx))
+
+        line_words = [[] for _ in range(mat.shape[0])]
+        for (i, _, _), text in zip(words, texts):
+            line_words[i].append(text)
+        return [joiner.join(texts) for joiner, texts in zip(joiners, line_words)]
 
 def four_point_transform(image, rect):
     (tl, tr, br, bl) = rect
@@ -407,108 +669,68 @@ def four_point_transform(image, rect):
 
 def group_text_box(polys, slope_ths = 0.1, ycenter_ths = 0.5, height_ths = 0.5, width_ths = 1.0, add_margin = 0.05, sort_output = True):
     # poly top-left, top-right, low-right, low-left
-    horizontal_list, free_list,combined_list, merged_list = [],[],[],[]
-
-    for poly in polys:
-        slope_up = (poly[3]-poly[1])/np.maximum(10, (poly[2]-poly[0]))
-        slope_down = (poly[5]-poly[7])/np.maximum(10, (poly[4]-poly[6]))
-        if max(abs(slope_up), abs(slope_down)) < slope_ths:
-            x_max = max([poly[0],poly[2],poly[4],poly[6]])
-            x_min = min([poly[0],poly[2],poly[4],poly[6]])
-            y_max = max([poly[1],poly[3],poly[5],poly[7]])
-            y_min = min([poly[1],poly[3],poly[5],poly[7]])
-            horizontal_list.append([x_min, x_max, y_min, y_max, 0.5*(y_min+y_max), y_max-y_min])
+    polys = np.asarray(polys) if len(polys) else np.zeros((0, 8), dtype=np.int32)
+    if polys.ndim != 2:
+        polys = np.array([np.asarray(poly).reshape(-1)[:8] for poly in polys])
+    p = polys[:, :8].T
+
+    slope_up = (p[3]-p[1])/np.maximum(10, (p[2]-p[0]))
+    slope_down = (p[5]-p[7])/np.maximum(10, (p[4]-p[6]))
+    horizontal = np.maximum(abs(slope_up), abs(slope_down)) < slope_ths
+
+    # free boxes: widen along their own sides
+    f = p[:, ~horizontal]
+    height = np.sqrt((f[6]-f[0])**2.+(f[7]-f[1])**2.)
+    width = np.sqrt((f[2]-f[0])**2.+(f[3]-f[1])**2.)
+    margin = (1.44*add_margin*np.minimum(width, height)).astype(np.int64)
+    theta13 = abs(np.arctan( (f[1]-f[5])/np.maximum(10, (f[0]-f[4]))))
+    theta24 = abs(np.arctan( (f[3]-f[7])/np.maximum(10, (f[2]-f[6]))))
+    free = np.stack([f[0] - np.cos(theta13)*margin, f[1] - np.sin(theta13)*margin,
+                     f[2] + np.cos(theta24)*margin, f[3] - np.sin(theta24)*margin,
+                     f[4] + np.cos(theta13)*margin, f[5] + np.sin(theta13)*margin,
+                     f[6] - np.cos(theta24)*margin, f[7] + np.sin(theta24)*margin], axis=1)
+    free_list = free.reshape(-1, 4, 2).tolist()
+
+    # horizontal boxes as x_min, x_max, y_min, y_max
+    h = p[:, horizontal]
+    x_min, x_max = h[0:8:2].min(0), h[0:8:2].max(0)
+    y_min, y_max = h[1:8:2].min(0), h[1:8:2].max(0)
+    ycenter, b_height = 0.5*(y_min+y_max), y_max-y_min
+    order = np.argsort(ycenter, kind='stable') if sort_output else np.arange(len(ycenter))
+    ycenters, heights = ycenter[order].tolist(), b_height[order].tolist()
+
+    # combine box: comparable y_center level up to ths*height of the running line
+    # (the sums are of half-pixels, so the running means are exact)
+    line = np.zeros(len(order), dtype=np.int64)
+    for k in range(len(order)):
+        if k > 0 and abs(sum_y/count - ycenters[k]) < ycenter_ths*(sum_h/count):
+            line[k] = line[k-1]
+            sum_y, sum_h, count = sum_y + ycenters[k], sum_h + heights[k], count + 1
         else:
-            height = np.linalg.norm([poly[6]-poly[0],poly[7]-poly[1]])
-            width = np.linalg.norm([poly[2]-poly[0],poly[3]-poly[1]])
-
-            margin = int(1.44*add_margin*min(width, height))
-
-            theta13 = abs(np.arctan( (poly[1]-poly[5])/np.maximum(10, (poly[0]-poly[4]))))
-            theta24 = abs(np.arctan( (poly[3]-poly[7])/np.maximum(10, (poly[2]-poly[6]))))
-            # do I need to clip minimum, maximum value here?
-            x1 = poly[0] - np.cos(theta13)*margin
-            y1 = poly[1] - np.sin(theta13)*margin
-            x2 = poly[2] + np.cos(theta24)*margin
-            y2 = poly[3] - np.sin(theta24)*margin
-            x3 = poly[4] + np.cos(theta13)*margin
-            y3 = poly[5] + np.sin(theta13)*margin
-            x4 = poly[6] - np.cos(theta24)*margin
-            y4 = poly[7] + np.sin(theta24)*margin
-
-            free_list.append([[x1,y1],[x2,y2],[x3,y3],[x4,y4]])
-    if sort_output:
-        horizontal_list = sorted(horizontal_list, key=lambda item: item[4])
-
-    # combine box
-    new_box = []
-    for poly in horizontal_list:
-
-        if len(new_box) == 0:
-            b_height = [poly[5]]
-            b_ycenter = [poly[4]]
-            new_box.append(poly)
+            line[k] = line[k-1] + 1 if k > 0 else 0
+            sum_y, sum_h, count = ycenters[k], heights[k], 1
+
+    # merge adjacent boxes of comparable height in each line, from left to right
+    by_x = np.lexsort((x_min[order], line))
+    order, line = order[by_x], line[by_x].tolist()
+    lefts, rights, heights = x_min[order].tolist(), x_max[order].tolist(), b_height[order].tolist()
+    starts = []
+    for k in range(len(order)):
+        if k > 0 and line[k] == line[k-1] and abs(sum_h/count - heights[k]) < height_ths*(sum_h/count) \
+                and (lefts[k]-rights[k-1]) < width_ths*heights[k]:
+            sum_h, count = sum_h + heights[k], count + 1
         else:
-            # comparable height and comparable y_center level up to ths*height
-            if abs(np.mean(b_ycenter) - poly[4]) < ycenter_ths*np.mean(b_height):
-                b_height.append(poly[5])
-                b_ycenter.append(poly[4])
-                new_box.append(poly)
-            else:
-                b_height = [poly[5]]
-                b_ycenter = [poly[4]]
-                combined_list.append(new_box)
-                new_box = [poly]
-    combined_list.append(new_box)
-
-    # merge list use sort again
-    for boxes in combined_list:
-        if len(boxes) == 1: # one box per line
-            box = boxes[0]
-            margin = int(add_margin*min(box[1]-box[0],box[5]))
-            merged_list.append([box[0]-margin,box[1]+margin,box[2]-margin,box[3]+margin])
-        else: # multiple boxes per line
-            boxes = sorted(boxes, key=lambda item: item[0])
-
-            merged_box, new_box = [],[]
-            for box in boxes:
-                if len(new_box) == 0:
-                    b_height = [box[5]]
-                    x_max = box[1]
-                    new_box.append(box)
-                else:
-                    if (abs(np.mean(b_height) - box[5]) < height_ths*np.mean(b_height)) and ((box[0]-x_max) < width_ths *(box[3]-box[2])): # merge boxes
-                        b_height.append(box[5])
-                        x_max = box[1]
-                        new_box.append(box)
-                    else:
-                        b_height = [box[5]]
-                        x_max = box[1]
-                        merged_box.append(new_box)
-                        new_box = [box]
-            if len(new_box) >0: merged_box.append(new_box)
-
-            for mbox in merged_box:
-                if len(mbox) != 1: # adjacent box in same line
-                    # do I need to add margin here?
-                    x_min = min(mbox, key=lambda x: x[0])[0]
-                    x_max = max(mbox, key=lambda x: x[1])[1]
-                    y_min = min(mbox, key=lambda x: x[2])[2]
-                    y_max = max(mbox, key=lambda x: x[3])[3]
-
-                    box_width = x_max - x_min
-                    box_height = y_max - y_min
-                    margin = int(add_margin * (min(box_width, box_height)))
-
-                    merged_list.append([x_min-margin, x_max+margin, y_min-margin, y_max+margin])
-                else: # non adjacent box in same line
-                    box = mbox[0]
-
-                    box_width = box[1] - box[0]
-                    box_height = box[3] - box[2]
-                    margin = int(add_margin * (min(box_width, box_height)))
-
-                    merged_list.append([box[0]-margin,box[1]+margin,box[2]-margin,box[3]+margin])
+            starts.append(k)
+            sum_h, count = heights[k], 1
+
+    merged_list = []
+    if starts:
+        m_x_min = np.minimum.reduceat(x_min[order], starts)
+        m_x_max = np.maximum.reduceat(x_max[order], starts)
+        m_y_min = np.minimum.reduceat(y_min[order], starts)
+        m_y_max = np.maximum.reduceat(y_max[order], starts)
+        margin = (add_margin*np.minimum(m_x_max-m_x_min, m_y_max-m_y_min)).astype(np.int64)
+        merged_list = np.stack([m_x_min-margin, m_x_max+margin, m_y_min-margin, m_y_max+margin], axis=1).tolist()
     # may need to check if box is really in image
     return merged_list, free_list
 
@@ -535,44 +757,64 @@ def compute_ratio_and_resize(img,width,height,model_height):
     return img,ratio
 
 
-def get_image_list(horizontal_list, free_list, img, model_height = 64, sort_output = True):
-    image_list = []
+def get_image_list(horizontal_list, free_list, img, model_height = 64, sort_output = True, pool = None, chunk_size = 64):
+    """
+    Crop every box and resize it to model_height. The geometry of all boxes
+    (clipping, rectified sizes, aspect ratios) is computed at once; the crops
+    themselves are made in chunks of chunk_size boxes, in `pool` when given
+    (anything with an ordered map(fn, items), e.g. a PreprocessPool).
+    """
     maximum_y,maximum_x = img.shape
 
-    max_ratio_hori, max_ratio_free = 1,1
-    for box in free_list:
-        rect = np.array(box, dtype = "float32")
-        transformed_img = four_point_transform(img, rect)
-        ratio = calculate_ratio(transformed_img.shape[1],transformed_img.shape[0])
-        new_width = int(model_height*ratio)
-        if new_width == 0:
-            pass
-        else:
-            crop_img,ratio = compute_ratio_and_resize(transformed_img,transformed_img.shape[1],transformed_img.shape[0],model_height)
-            image_list.append( (box,crop_img) ) # box = [[x1,y1],[x2,y2],[x3,y3],[x4,y4]]
-            max_ratio_free = max(ratio, max_ratio_free)
+    # free boxes are rectified to the size of their longest sides
+    rects = np.array(free_list, dtype = "float32").reshape(-1, 4, 2)
+    (tl, tr, br, bl) = rects.transpose(1, 0, 2)
+    max_widths = np.maximum(np.sqrt(((br - bl) ** 2).sum(1)).astype(int), np.sqrt(((tr - tl) ** 2).sum(1)).astype(int))
+    max_heights = np.maximum(np.sqrt(((tr - br) ** 2).sum(1)).astype(int), np.sqrt(((tl - bl) ** 2).sum(1)).astype(int))
+
+    # horizontal boxes are clipped to the image
+    bounds = np.array(horizontal_list, dtype=np.int64).reshape(-1, 4)
+    x_min, x_max = np.maximum(0, bounds[:, 0]), np.minimum(bounds[:, 1], maximum_x)
+    y_min, y_max = np.maximum(0, bounds[:, 2]), np.minimum(bounds[:, 3], maximum_y)
+
+    def crop_free(i):
+        max_width, max_height = int(max_widths[i]), int(max_heights[i])
+        ratio = calculate_ratio(max_width, max_height)
+        if int(model_height*ratio) == 0:
+            return None
+        dst = np.array([[0, 0],[max_width - 1, 0],[max_width - 1, max_height - 1],[0, max_height - 1]], dtype = "float32")
+        transformed_img = cv2.warpPerspective(img, cv2.getPerspectiveTransform(rects[i], dst), (max_width, max_height))
+        crop_img,ratio = compute_ratio_and_resize(transformed_img,max_width,max_height,model_height)
+        return free_list[i], crop_img, ratio # box = [[x1,y1],[x2,y2],[x3,y3],[x4,y4]]
+
+    def crop_horizontal(i):
+        left, right, top, bottom = int(x_min[i]), int(x_max[i]), int(y_min[i]), int(y_max[i])
+        width, height = right - left, bottom - top
+        ratio = calculate_ratio(width,height)
+        if int(model_height*ratio) == 0:
+            return None
+        crop_img,ratio = compute_ratio_and_resize(img[top : bottom, left:right],width,height,model_height)
+        return [[left,top],[right,top],[right,bottom],[left,bottom]], crop_img, ratio
 
+    jobs = [(crop_free, i) for i in range(len(rects))] + [(crop_horizontal, i) for i in range(len(bounds))]
+    chunks = [jobs[k:k + chunk_size] for k in range(0, len(jobs), chunk_size)]
+    crop_chunk = lambda chunk: [crop(i) for crop, i in chunk]
+    crops = [item for chunk in (pool.map(crop_chunk, chunks) if pool is not None else map(crop_chunk, chunks))
+             for item in chunk]
 
-    max_ratio_free = math.ceil(max_ratio_free)
-
-    for box in horizontal_list:
-        x_min = max(0,box[0])
-        x_max = min(box[1],maximum_x)
-        y_min = max(0,box[2])
-        y_max = min(box[3],maximum_y)
-        crop_img = img[y_min : y_max, x_min:x_max]
-        width = x_max - x_min
-        height = y_max - y_min
-        ratio = calculate_ratio(width,height)
-        new_width = int(model_height*ratio)
-        if new_width == 0:
-            pass
+    image_list = []
+    max_ratio_hori, max_ratio_free = 1,1
+    for (crop, i), item in zip(jobs, crops):
+        if item is None:
+            continue
+        image_list.append(item[:2])
+        if crop is crop_free:
+            max_ratio_free = max(item[2], max_ratio_free)
         else:
-            crop_img,ratio = compute_ratio_and_resize(crop_img,width,height,model_height)
-            image_list.append( ( [[x_min,y_min],[x_max,y_min],[x_max,y_max],[x_min,y_max]] ,crop_img) )
-            max_ratio_hori = max(ratio, max_ratio_hori)
+            max_ratio_hori = max(item[2], max_ratio_hori)
 
     max_ratio_hori = math.ceil(max_ratio_hori)
+    max_ratio_free = math.ceil(max_ratio_free)
     max_ratio = max(max_ratio_hori, max_ratio_free)
     max_width = math.ceil(max_ratio)*model_height
 
@@ -588,81 +830,176 @@ def download_and_unzip(url, filename, model_storage_directory, verbose=True):
         zipObj.extract(filename, model_storage_directory)
     os.remove(zip_path)
 
-def calculate_md5(fname):
+def calculate_md5(fname, chunk_size = 1 << 20):
     hash_md5 = hashlib.md5()
-    with open(fname, "rb") as f:
-        for chunk in iter(lambda: f.read(4096), b""):
-            hash_md5.update(chunk)
+    buf = bytearray(chunk_size)
+    view = memoryview(buf)
+    with open(fname, "rb", buffering=0) as f:
+        for n in iter(lambda: f.readinto(buf), 0):
+            hash_md5.update(view[:n])
     return hash_md5.hexdigest()
 
+_manifest_lock = threading.Lock()
+
+@contextmanager
+def manifest_lock(manifest_path):
+    """ exclusive access to the manifest for this process's threads and, where fcntl exists, other processes """
+    with _manifest_lock:
+        if fcntl is None:
+            yield
+            return
+        try:
+            lock_file = open(manifest_path + '.lock', 'a')
+        except OSError: # read-only model directory, the manifest cannot be written either
+            yield
+            return
+        with lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+def read_manifest(manifest_path):
+    try:
+        with open(manifest_path, "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    return manifest if isinstance(manifest, dict) else {}
+
+def verified_md5(fname, manifest_path = None):
+    """
+    MD5 of fname, cached in a JSON manifest (default: md5_manifest.json next to
+    the file) keyed by path and validated by size, mtime and inode, so that an
+    unchanged file is not hashed again. Readers hashing files concurrently,
+    in threads or processes, each add their entry without losing the others.
+    """
+    fname = os.path.abspath(fname)
+    if manifest_path is None:
+        manifest_path = os.path.join(os.path.dirname(fname), 'md5_manifest.json')
+    st = os.stat(fname)
+    signature = [st.st_size, st.st_mtime_ns, st.st_ino]
+
+    entry = read_manifest(manifest_path).get(fname)
+    if isinstance(entry, dict) and entry.get('signature') == signature:
+        return entry['md5']
+
+    md5 = calculate_md5(fname)
+    # read again under the lock: other entries may have been written while hashing
+    try:
+        with manifest_lock(manifest_path):
+            manifest = read_manifest(manifest_path)
+            manifest[fname] = {'signature': signature, 'md5': md5}
+            # write to a temporary file first so that readers never see a partial manifest
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(manifest_path)), suffix='.tmp')
+            try:
+                with os.fdopen(fd, "w", encoding="utf-8") as f:
+                    json.dump(manifest, f, indent=1)
+                os.replace(tmp_path, manifest_path)
+            finally:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+    except OSError:
+        pass
+    return md5
+
 def diff(input_list):
     return max(input_list)-min(input_list)
 
 def get_paragraph(raw_result, x_ths=1, y_ths=0.5, mode = 'ltr'):
     # create basic attributes
-    box_group = []
+    texts, bounds = [], []
     for box in raw_result:
         all_x = [int(coord[0]) for coord in box[0]]
         all_y = [int(coord[1]) for coord in box[0]]
-        min_x = min(all_x)
-        max_x = max(all_x)
-        min_y = min(all_y)
-        max_y = max(all_y)
-        height = max_y - min_y
-        box_group.append([box[1], min_x, max_x, min_y, max_y, height, 0.5*(min_y+max_y), 0]) # last element indicates group
-    # cluster boxes into paragraph
-    current_group = 1
-    while len([box for box in box_group if box[7]==0]) > 0:
-        box_group0 = [box for box in box_group if box[7]==0] # group0 = non-group
-        # new group
-        if len([box for box in box_group if box[7]==current_group]) == 0:
-            box_group0[0][7] = current_group # assign first box to form new group
-        # try to add group
-        else:
-            current_box_group = [box for box in box_group if box[7]==current_group]
-            mean_height = np.mean([box[5] for box in current_box_group])
-            min_gx = min([box[1] for box in current_box_group]) - x_ths*mean_height
-            max_gx = max([box[2] for box in current_box_group]) + x_ths*mean_height
-            min_gy = min([box[3] for box in current_box_group]) - y_ths*mean_height
-            max_gy = max([box[4] for box in current_box_group]) + y_ths*mean_height
-            add_box = False
-            for box in box_group0:
-                same_horizontal_level = (min_gx<=box[1]<=max_gx) or (min_gx<=box[2]<=max_gx)
-                same_vertical_level = (min_gy<=box[3]<=max_gy) or (min_gy<=box[4]<=max_gy)
-                if same_horizontal_level and same_vertical_level:
-                    box[7] = current_group
-                    add_box = True
-                    break
+        texts.append(box[1])
+        bounds.append([min(all_x), max(all_x), min(all_y), max(all_y)])
+    if not bounds:
+        return []
+    bounds = np.array(bounds, dtype=np.int64)
+    min_x, max_x, min_y, max_y = bounds.T
+    height = max_y - min_y
+    ycenter = 0.5*(min_y+max_y)
+
+    # cluster boxes into paragraph: a group starts with the first free box and
+    # repeatedly takes the first free box that has an x edge and a y edge within
+    # the group bounds, widened by x_ths/y_ths times the mean height of the group.
+    # Candidates come from a sweep over the y edges of the free boxes, sorted once
+    # and compacted as boxes get grouped, instead of rescanning every box.
+    group = np.zeros(len(bounds), dtype=np.int64) # 0 = not grouped yet
+    def sweep_index():
+        free = np.nonzero(group == 0)[0]
+        by_min_y = free[np.argsort(min_y[free], kind='stable')]
+        by_max_y = free[np.argsort(max_y[free], kind='stable')]
+        return by_min_y, min_y[by_min_y], by_max_y, max_y[by_max_y]
+    by_min_y, sorted_min_y, by_max_y, sorted_max_y = sweep_index()
+    stale = 0
+    current_group = 0
+    for first in range(len(bounds)):
+        if group[first]:
+            continue
+        current_group += 1
+        group[first] = current_group
+        g_min_x, g_max_x, g_min_y, g_max_y = bounds[first]
+        g_height, g_count = height[first], 1
+        while True:
+            mean_height = g_height / g_count
+            min_gx = g_min_x - x_ths*mean_height
+            max_gx = g_max_x + x_ths*mean_height
+            min_gy = g_min_y - y_ths*mean_height
+            max_gy = g_max_y + y_ths*mean_height
+            candidates = np.concatenate([
+                by_min_y[np.searchsorted(sorted_min_y, min_gy, 'left'):np.searchsorted(sorted_min_y, max_gy, 'right')],
+                by_max_y[np.searchsorted(sorted_max_y, min_gy, 'left'):np.searchsorted(sorted_max_y, max_gy, 'right')]])
+            candidates = candidates[group[candidates] == 0]
+            c_min_x, c_max_x = min_x[candidates], max_x[candidates]
+            candidates = candidates[((min_gx <= c_min_x) & (c_min_x <= max_gx)) | ((min_gx <= c_max_x) & (c_max_x <= max_gx))]
             # cannot add more box, go to next group
-            if add_box==False:
-                current_group += 1
+            if len(candidates) == 0:
+                break
+            i = candidates.min()
+            group[i] = current_group
+            g_min_x, g_max_x = min(g_min_x, min_x[i]), max(g_max_x, max_x[i])
+            g_min_y, g_max_y = min(g_min_y, min_y[i]), max(g_max_y, max_y[i])
+            g_height, g_count = g_height + height[i], g_count + 1
+            stale += 1
+            if stale > 32 and 2*stale > len(by_min_y):
+                by_min_y, sorted_min_y, by_max_y, sorted_max_y = sweep_index()
+                stale = 0
+
     # arrage order in paragraph
     result = []
-    for i in set(box[7] for box in box_group):
-        current_box_group = [box for box in box_group if box[7]==i]
-        mean_height = np.mean([box[5] for box in current_box_group])
-        min_gx = min([box[1] for box in current_box_group])
-        max_gx = max([box[2] for box in current_box_group])
-        min_gy = min([box[3] for box in current_box_group])
-        max_gy = max([box[4] for box in current_box_group])
-
-        text = ''
-        while len(current_box_group) > 0:
-            highest = min([box[6] for box in current_box_group])
-            candidates = [box for box in current_box_group if box[6]<highest+0.4*mean_height]
-            # get the far left
-            if mode == 'ltr':
-                most_left = min([box[1] for box in candidates])
-                for box in candidates:
-                    if box[1] == most_left: best_box = box
-            elif mode == 'rtl':
-                most_right = max([box[2] for box in candidates])
-                for box in candidates:
-                    if box[2] == most_right: best_box = box
-            text += ' '+best_box[0]
-            current_box_group.remove(best_box)
-
-        result.append([ [[min_gx,min_gy],[max_gx,min_gy],[max_gx,max_gy],[min_gx,max_gy]], text[1:]])
+    ycenter, left_x, right_x = ycenter.tolist(), min_x.tolist(), max_x.tolist()
+    for g in range(1, current_group + 1):
+        members = np.nonzero(group == g)[0].tolist()
+        mean_height = np.mean(height[members])
+        # far left first (far right for rtl), the last box in input order on ties
+        left = {i: (left_x[i] if mode == 'ltr' else -right_x[i], -i) for i in members}
+        by_center = sorted(members, key=lambda i: ycenter[i])
+        # like list.remove, taking a box takes the first one equal to it
+        duplicates = {}
+        for i in members:
+            duplicates.setdefault((texts[i],) + tuple(bounds[i].tolist()), []).append(i)
+        taken = set()
+        top = 0
+        words = []
+        for _ in range(len(members)):
+            while by_center[top] in taken:
+                top += 1
+            threshold = ycenter[by_center[top]]+0.4*mean_height
+            best = None
+            for i in by_center[top:]:
+                if ycenter[i] >= threshold:
+                    break
+                if i not in taken and (best is None or left[i] < left[best]):
+                    best = i
+            words.append(texts[best])
+            taken.add(duplicates[(texts[best],) + tuple(bounds[best].tolist())].pop(0))
+
+        min_gx, max_gx = int(min_x[members].min()), int(max_x[members].max())
+        min_gy, max_gy = int(min_y[members].min()), int(max_y[members].max())
+        result.append([ [[min_gx,min_gy],[max_gx,min_gy],[max_gx,max_gy],[min_gx,max_gy]], ' '.join(words)])
 
     return result
 
@@ -687,21 +1024,46 @@ def printProgressBar(prefix='', suffix='', decimals=1, length=100, fill='█'):
 
     return progress_hook
 
-def reformat_input(image):
+def decode_image(data):
+    """
+    Decode an encoded image held in a bytes-like object (bytes, bytearray,
+    memoryview, mmap) once and without copying it.
+    Returns (RGB image, grey image); grey is derived from the decoded color buffer.
+    """
+    buf = np.frombuffer(data, np.uint8)
+    img = cv2.imdecode(buf, cv2.IMREAD_COLOR)
+    del buf # release the buffer so that an mmap can be closed
+    if img is None: # format not supported by OpenCV
+        img = np.array(Image.open(io.BytesIO(data)).convert('RGB'))
+        return img, cv2.cvtColor(img, cv2.COLOR_RGB2GRAY)
+    return cv2.cvtColor(img, cv2.COLOR_BGR2RGB), cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+
+def read_image(path):
+    """ decode an image file once through a read-only memory map; returns (RGB image, grey image) """
+    with open(path, 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            img = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+    if img is None: # format not supported by OpenCV
+        img = loadImage(path)
+        return img, cv2.cvtColor(img, cv2.COLOR_RGB2GRAY)
+    return cv2.cvtColor(img, cv2.COLOR_BGR2RGB), cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+
+def reformat_input(image, timings = None):
+    """
+    Returns (img, img_cv_grey): a color image for the detector and a grey
+    image for the recognizer. Encoded inputs are decoded once. If a dict
+    is given as timings, the time spent here is added to timings['decode'].
+    """
+    start = time.time()
     if type(image) == str:
         if image.startswith('http://') or image.startswith('https://'):
             tmp, _ = urlretrieve(image , reporthook=printProgressBar(prefix = 'Progress:', suffix = 'Complete', length = 50))
-            img_cv_grey = cv2.imread(tmp, cv2.IMREAD_GRAYSCALE)
+            img, img_cv_grey = read_image(tmp)
             os.remove(tmp)
         else:
-            img_cv_grey = cv2.imread(image, cv2.IMREAD_GRAYSCALE)
-            image = os.path.expanduser(image)
-        img = loadImage(image)  # can accept URL
-    elif type(image) == bytes:
-        nparr = np.frombuffer(image, np.uint8)
-        img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-        img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
-        img_cv_grey = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+            img, img_cv_grey = read_image(os.path.expanduser(image))
+    elif isinstance(image, (bytes, bytearray, memoryview, mmap.mmap)):
+        img, img_cv_grey = decode_image(image)
 
     elif type(image) == np.ndarray:
         if len(image.shape) == 2: # grayscale
@@ -724,13 +1086,16 @@ def reformat_input(image):
     else:
         raise ValueError('Invalid input type. Supporting format = string(file path or url), bytes, numpy array')
 
+    if timings is not None:
+        timings['decode'] = timings.get('decode', 0.) + time.time() - start
     return img, img_cv_grey
 
 
-def reformat_input_batched(image, n_width=None, n_height=None):
+def reformat_input_batched(image, n_width=None, n_height=None, timings=None):
     """
     reformats an image or list of images or a 4D numpy image array &
     returns a list of corresponding img, img_cv_grey nd.arrays
+    (or plain lists of nd.arrays when the images have different sizes)
     image:
         [file path, numpy-array, byte stream object,
         list of file paths, list of numpy-array, 4D numpy array,
@@ -740,39 +1105,78 @@ def reformat_input_batched(image, n_width=None, n_height=None):
         # process image batches if image is list of image np arr, paths, bytes
         img, img_cv_grey = [], []
         for single_img in image:
-            clr, gry = reformat_input(single_img)
+            clr, gry = reformat_input(single_img, timings)
             if n_width is not None and n_height is not None:
                 clr = cv2.resize(clr, (n_width, n_height))
                 gry = cv2.resize(gry, (n_width, n_height))
             img.append(clr)
             img_cv_grey.append(gry)
-        img, img_cv_grey = np.array(img), np.array(img_cv_grey)
-        # ragged tensors created when all input imgs are not of the same size
-        if len(img.shape) == 1 and len(img_cv_grey.shape) == 1:
-            raise ValueError("The input image array contains images of different sizes. " +
-                             "Please resize all images to same shape or pass n_width, n_height to auto-resize")
+        # images of different sizes are kept as lists, the detector groups them by size
+        if len(set(clr.shape for clr in img)) == 1:
+            img, img_cv_grey = np.array(img), np.array(img_cv_grey)
     else:
-        img, img_cv_grey = reformat_input(image)
+        img, img_cv_grey = reformat_input(image, timings)
     return img, img_cv_grey
 
 
 
+def rotate_image(img, angle):
+    """
+    Rotate img counter-clockwise by angle degrees on a canvas that holds the
+    whole rotated image, like ndimage.rotate(img, angle, reshape=True).
+    Right angles are exact transposes/flips; other angles use a cv2 cubic warp.
+    """
+    angle = angle % 360
+    if angle % 90 == 0:
+        return np.ascontiguousarray(np.rot90(img, int(angle // 90)))
+    height, width = img.shape[:2]
+    theta = np.deg2rad(angle)
+    c, s = np.cos(theta), np.sin(theta)
+    bounds = np.array([[c, s], [-s, c]]) @ [[0, 0, height, height], [0, width, 0, width]]
+    out_height, out_width = (np.ptp(bounds, axis=1) + 0.5).astype(int)
+    M = cv2.getRotationMatrix2D(((width - 1) / 2, (height - 1) / 2), angle, 1.0)
+    M[0, 2] += (out_width - 1) / 2 - (width - 1) / 2
+    M[1, 2] += (out_height - 1) / 2 - (height - 1) / 2
+    return cv2.warpAffine(img, M, (int(out_width), int(out_height)), flags=cv2.INTER_CUBIC,
+                          borderMode=cv2.BORDER_CONSTANT, borderValue=0)
+
 def make_rotated_img_list(rotationInfo, img_list):
 
     result_img_list = img_list[:]
 
     # add rotated images to original image_list
-    max_ratio=1
-    
     for angle in rotationInfo:
         for img_info in img_list : 
-            rotated = ndimage.rotate(img_info[1], angle, reshape=True) 
-            height,width = rotated.shape
-            ratio = calculate_ratio(width,height)
-            max_ratio = max(max_ratio,ratio)
-            result_img_list.append((img_info[0], rotated))
+            result_img_list.append((img_info[0], rotate_image(img_info[1], angle)))
     return result_img_list
 
+def rotation_tta(image_lists, result_lists, rotation_info, recognize, rotation_ths = None):
+    """
+    Test-time augmentation over rotations, one list per page. Only the crops
+    whose confidence in result_lists is below rotation_ths (every crop with
+    None) are rotated by each angle of rotation_info; all rotated crops are
+    recognized with a single recognize(rotated_lists) call and the most
+    confident reading of each crop is kept.
+    """
+    selected = [[i for i, result in enumerate(results) if rotation_ths is None or result[2] < rotation_ths]
+                for results in result_lists]
+    if not any(selected):
+        return result_lists
+    rotated_lists = [make_rotated_img_list(rotation_info, [image_list[i] for i in indices])[len(indices):]
+                     for image_list, indices in zip(image_lists, selected)]
+    rotated_results = recognize(rotated_lists)
+
+    output = []
+    for results, indices, rotated in zip(result_lists, selected, rotated_results):
+        results = list(results)
+        if indices:
+            n = len(indices)
+            best = set_result_with_confidence([[results[i] for i in indices]] +
+                                              [rotated[n*a:n*(a+1)] for a in range(len(rotation_info))])
+            for i, result in zip(indices, best):
+                results[i] = result
+        output.append(results)
+    return output
 
 def set_result_with_confidence(results):
     """ Select highest confidence augmentation for TTA